@@ -0,0 +1,236 @@
+"""
+Compression ratio and CPU cost per content type for the storage compression
+stage (`ktg_storage.compression`).
+
+Runs on synthetic samples of the text-like types we store (or on files given
+with --file) and reports, per type and encoding, the compression ratio and
+the CPU time spent compressing and decompressing. zstd is only measured when
+`zstandard` is installed.
+
+    python -m benchmarks.compression --size-mb 8 --output reports/compression.json
+    python -m benchmarks.compression --file text/csv=export.csv
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+
+
+def _csv(size):
+    rows = []
+    total = 0
+    index = 0
+    while total < size:
+        row = f"{index},user{index % 977},{random.random():.6f}," \
+            f"2024-01-{index % 28 + 1:02d},{random.choice(['ok', 'failed'])}\n"
+        rows.append(row)
+        total += len(row)
+        index += 1
+
+    return "".join(rows).encode()[:size]
+
+
+def _json(size):
+    items = []
+    total = 0
+    index = 0
+    while total < size:
+        item = json.dumps({
+            "id": index,
+            "name": f"item-{index}",
+            "price": round(random.uniform(1, 500), 2),
+            "tags": random.sample(["a", "b", "c", "d", "e"], 2),
+        })
+        items.append(item)
+        total += len(item) + 1
+        index += 1
+
+    return ("[" + ",".join(items) + "]").encode()[:size]
+
+
+def _log(size):
+    levels = ["INFO", "DEBUG", "WARNING", "ERROR"]
+    lines = []
+    total = 0
+    index = 0
+    while total < size:
+        line = f"2024-01-01T00:{index // 60 % 60:02d}:{index % 60:02d}Z " \
+            f"{random.choice(levels)} worker-{index % 8} request " \
+            f"{random.getrandbits(64):016x} took {random.randint(1, 900)}ms\n"
+        lines.append(line)
+        total += len(line)
+        index += 1
+
+    return "".join(lines).encode()[:size]
+
+
+def _svg(size):
+    shapes = []
+    total = 0
+    while total < size:
+        shape = f'<circle cx="{random.randint(0, 1000)}" ' \
+            f'cy="{random.randint(0, 1000)}" r="{random.randint(1, 50)}" ' \
+            f'fill="#{random.getrandbits(24):06x}"/>\n'
+        shapes.append(shape)
+        total += len(shape)
+
+    return ('<svg xmlns="http://www.w3.org/2000/svg">\n'
+            + "".join(shapes) + "</svg>").encode()
+
+
+def _tiff(size):
+    from PIL import Image
+    from PIL import ImageDraw
+
+    side = max(int((size / 3) ** 0.5), 16)
+    img = Image.new("RGB", (side, side), (240, 240, 240))
+    draw = ImageDraw.Draw(img)
+    for _ in range(200):
+        x, y = random.randint(0, side), random.randint(0, side)
+        draw.rectangle(
+            (x, y, x + side // 10, y + side // 10),
+            fill=tuple(random.randint(0, 255) for _ in range(3)),
+        )
+
+    buffer = io.BytesIO()
+    img.save(buffer, format="TIFF")
+
+    return buffer.getvalue()
+
+
+SAMPLES = {
+    "text/csv": _csv,
+    "application/json": _json,
+    "text/plain": _log,
+    "image/svg+xml": _svg,
+    "image/tiff": _tiff,
+}
+
+
+def _encodings(levels):
+    from ktg_storage import compression
+
+    encodings = [(compression.GZIP, level) for level in levels["gzip"]]
+    if compression.zstandard is not None:
+        encodings += [(compression.ZSTD, level) for level in levels["zstd"]]
+
+    return encodings
+
+
+def measure(data, encoding, level, repeat):
+    from ktg_storage import compression
+
+    def chunks(payload):
+        return compression.iter_chunks(io.BytesIO(payload))
+
+    compress_cpu = []
+    decompress_cpu = []
+
+    for _ in range(repeat):
+        start = time.process_time()
+        compressed = b"".join(
+            compression.compress_chunks(chunks(data), encoding, level))
+        compress_cpu.append(time.process_time() - start)
+
+        start = time.process_time()
+        restored = b"".join(
+            compression.decompress_chunks(chunks(compressed), encoding))
+        decompress_cpu.append(time.process_time() - start)
+
+        assert restored == data
+
+    mib = len(data) / (1024 * 1024)
+    compress_time = min(compress_cpu)
+    decompress_time = min(decompress_cpu)
+
+    return {
+        "encoding": encoding,
+        "level": level,
+        "size": len(data),
+        "stored_size": len(compressed),
+        "ratio": len(data) / len(compressed) if compressed else 0.0,
+        "saving": 1 - len(compressed) / len(data) if data else 0.0,
+        "compress_cpu_ms": compress_time * 1000,
+        "decompress_cpu_ms": decompress_time * 1000,
+        "compress_mib_per_cpu_s": mib / compress_time if compress_time else 0.0,
+        "decompress_mib_per_cpu_s":
+            mib / decompress_time if decompress_time else 0.0,
+    }
+
+
+def print_report(report):
+    print(f"{'type':<18} {'encoding':<8} {'ratio':>7} {'saving':>7} "
+          f"{'comp MiB/s':>11} {'decomp MiB/s':>13}")
+
+    for result in report["results"]:
+        print(
+            f"{result['type']:<18} "
+            f"{result['encoding'] + '-' + str(result['level']):<8} "
+            f"{result['ratio']:>7.2f} "
+            f"{result['saving'] * 100:>6.1f}% "
+            f"{result['compress_mib_per_cpu_s']:>11.1f} "
+            f"{result['decompress_mib_per_cpu_s']:>13.1f}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--size-mb", type=float, default=4,
+        help="Size of each synthetic sample.",
+    )
+    parser.add_argument(
+        "--file", action="append", default=[], metavar="TYPE=PATH",
+        help="Measure a real file instead of a synthetic sample.",
+    )
+    parser.add_argument("--gzip-levels", type=int, nargs="+", default=[1, 6, 9])
+    parser.add_argument("--zstd-levels", type=int, nargs="+", default=[1, 3, 9])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report to this path.")
+
+    args = parser.parse_args(argv)
+
+    import django
+    django.setup()
+
+    random.seed(args.seed)
+    size = int(args.size_mb * 1024 * 1024)
+
+    samples = {}
+    if args.file:
+        for value in args.file:
+            mime_type, _, path = value.partition("=")
+            with open(path, "rb") as f:
+                samples[mime_type] = f.read()
+    else:
+        for mime_type, generate in SAMPLES.items():
+            samples[mime_type] = generate(size)
+
+    levels = {"gzip": args.gzip_levels, "zstd": args.zstd_levels}
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "results": [],
+    }
+
+    for mime_type, data in samples.items():
+        print(f"Measuring {mime_type}...", file=sys.stderr)
+        for encoding, level in _encodings(levels):
+            result = measure(data, encoding, level, args.repeat)
+            report["results"].append({"type": mime_type, **result})
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            f.write(json.dumps(report, indent=2))
+
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()
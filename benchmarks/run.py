@@ -0,0 +1,395 @@
+"""
+End-to-end benchmarks for the ktg_storage upload and listing endpoints.
+
+Runs fully offline: S3 is replaced by moto and the database is seeded with
+`StorageFactory` rows. Sizes are seeded incrementally, so `--rows 1000
+100000 1000000` only inserts each additional row once.
+
+    python -m benchmarks.run --rows 1000 100000 --output reports/HEAD.json
+    python -m benchmarks.run compare reports/base.json reports/HEAD.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+
+try:
+    from moto import mock_aws as mock_s3
+except ImportError:
+    from moto import mock_s3
+
+SEED_BATCH_SIZE = 5000
+
+SPARSE_FIELDS = "id,original_file_name,file_type,file_size,created_at"
+
+
+class S3CallCounter:
+    """
+    Count S3 API calls issued through a botocore client.
+    """
+
+    def __init__(self, client):
+        self.calls = Counter()
+        self.active = False
+        client.meta.events.register("before-call.s3", self._on_call)
+
+    def _on_call(self, model, **kwargs):
+        if self.active:
+            self.calls[model.name] += 1
+
+    @contextmanager
+    def count(self):
+        self.calls = Counter()
+        self.active = True
+        try:
+            yield self.calls
+        finally:
+            self.active = False
+
+
+def _percentile(values, percentile):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(percentile * (len(values) - 1))))
+    return values[index]
+
+
+def measure(func, iterations, s3_counter, setup=None):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    latencies = []
+    cpu_time = 0.0
+    queries = 0
+    s3_calls = Counter()
+
+    for _ in range(iterations):
+        args = setup() if setup else ()
+
+        with CaptureQueriesContext(connection) as captured, \
+                s3_counter.count() as calls:
+            start = time.perf_counter()
+            cpu_start = time.process_time()
+            func(*args)
+            cpu_time += time.process_time() - cpu_start
+            latencies.append(time.perf_counter() - start)
+
+        queries += len(captured.captured_queries)
+        s3_calls.update(calls)
+
+    total = sum(latencies)
+
+    return {
+        "iterations": iterations,
+        "latency_ms": {
+            "mean": statistics.mean(latencies) * 1000,
+            "p50": _percentile(latencies, 0.5) * 1000,
+            "p95": _percentile(latencies, 0.95) * 1000,
+            "max": max(latencies) * 1000,
+        },
+        "cpu_ms": cpu_time / iterations * 1000,
+        "throughput_per_s": iterations / total if total else 0.0,
+        "queries_per_call": queries / iterations,
+        "s3_calls_per_call": sum(s3_calls.values()) / iterations,
+        "s3_calls_by_operation": dict(s3_calls),
+    }
+
+
+def seed(total_rows, user_rows, bench_user):
+    from ktg_storage.factories import StorageFactory
+    from ktg_storage.factories import UserFactory
+    from ktg_storage.models import Storage
+
+    existing = Storage.objects.count()
+    owned = Storage.objects.filter(uploaded_by=bench_user).count()
+    other_users = [UserFactory.create() for _ in range(10)]
+
+    batch = []
+    for index in range(existing, total_rows):
+        if owned < user_rows:
+            owner = bench_user
+            owned += 1
+        else:
+            owner = other_users[index % len(other_users)]
+
+        name = f"{uuid.uuid4().hex}.jpg"
+        batch.append(
+            StorageFactory.build(
+                uploaded_by=owner,
+                file=f"files/{name}",
+                file_name=f"files/{name}",
+                original_file_name=name,
+                file_type="image/jpeg",
+                file_size=1024,
+            )
+        )
+
+        if len(batch) >= SEED_BATCH_SIZE:
+            Storage.objects.bulk_create(batch)
+            batch = []
+
+    Storage.objects.bulk_create(batch)
+
+
+def _jpeg_bytes():
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (640, 480), (200, 80, 40)).save(buffer, format="JPEG")
+
+    return buffer.getvalue()
+
+
+def run_scenarios(args, bench_user, s3_counter):
+    from django.urls import reverse
+    from rest_framework.renderers import JSONRenderer
+    from rest_framework.request import Request
+    from rest_framework.test import APIClient
+    from rest_framework.test import APIRequestFactory
+
+    from ktg_storage.client import s3_service
+    from ktg_storage.models import Storage
+    from ktg_storage.renderers import ORJSONRenderer
+    from ktg_storage.renderers import orjson
+    from ktg_storage.serializers import FileSerializer
+    from ktg_storage.services import FileDirectUploadService
+
+    client = APIClient()
+    client.force_authenticate(user=bench_user)
+    jpeg = _jpeg_bytes()
+    results = {}
+
+    def upload_start():
+        response = client.post(reverse("ktg_storage:direct_upload_start"), {
+            "file_name": "photo.jpg",
+            "file_type": "image/jpeg",
+        })
+        assert response.status_code == 201, response.content
+
+    results["upload_start"] = measure(
+        upload_start, args.iterations, s3_counter)
+
+    def finish_setup():
+        data = FileDirectUploadService(bench_user).start({
+            "file_name": "photo.jpg",
+            "file_type": "image/jpeg",
+            "user": bench_user,
+        })
+        file = data["file"]
+        s3_service.client.put_object(
+            Bucket=s3_service.bucket_name, Key=file.file.name, Body=jpeg)
+
+        return (file.id,)
+
+    def upload_finish(file_id):
+        response = client.post(
+            reverse("ktg_storage:direct_upload_finish"),
+            {"file_id": str(file_id)},
+        )
+        assert response.status_code == 201, response.content
+
+    results["upload_finish"] = measure(
+        upload_finish, args.iterations, s3_counter, setup=finish_setup)
+
+    def list_files():
+        response = client.get(reverse("ktg_storage:list"))
+        assert response.status_code == 200, response.content
+
+    results["list"] = measure(list_files, args.iterations, s3_counter)
+
+    page = list(
+        Storage.objects.select_related("uploaded_by")[:args.page_size])
+
+    def serialize_page():
+        FileSerializer(page, many=True).data
+
+    results["serializer_page"] = measure(
+        serialize_page, args.iterations, s3_counter)
+
+    # What a client asking for ?fields= costs: no URL signing, no nested user.
+    sparse_request = Request(
+        APIRequestFactory().get("/", {"fields": SPARSE_FIELDS}))
+
+    def serialize_sparse_page():
+        FileSerializer(
+            page, many=True, context={"request": sparse_request}).data
+
+    results["serializer_sparse"] = measure(
+        serialize_sparse_page, args.iterations, s3_counter)
+
+    # Signing the page's download URLs alone, botocore vs the cached signer.
+    keys = [file.file.name for file in page]
+
+    def presign_botocore():
+        for key in keys:
+            s3_service.client.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": s3_service.bucket_name, "Key": key},
+                ExpiresIn=s3_service.expiry,
+            )
+
+    results["presign_botocore"] = measure(
+        presign_botocore, args.iterations, s3_counter)
+    results["presign_signer"] = measure(
+        lambda: s3_service.create_presigned_urls(keys),
+        args.iterations, s3_counter)
+
+    data = FileSerializer(page, many=True).data
+
+    results["render_json"] = measure(
+        lambda: JSONRenderer().render(data), args.iterations, s3_counter)
+
+    if orjson is not None:
+        results["render_orjson"] = measure(
+            lambda: ORJSONRenderer().render(data), args.iterations, s3_counter)
+
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    mock = mock_s3()
+    mock.start()
+
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+    from django.db import connection
+
+    from ktg_storage.client import s3_service
+    from ktg_storage.factories import UserFactory
+    from django.contrib.auth import get_user_model
+
+    call_command("migrate", verbosity=0)
+
+    s3_service.client.create_bucket(
+        Bucket=s3_service.bucket_name,
+        CreateBucketConfiguration={
+            "LocationConstraint": s3_service.client.meta.region_name},
+    )
+    s3_counter = S3CallCounter(s3_service.client)
+
+    bench_user = get_user_model().objects.filter(
+        username="benchmark").first() or UserFactory.create(username="benchmark")
+
+    report = {
+        "commit": _git_commit(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "database": connection.vendor,
+        "iterations": args.iterations,
+        "results": {},
+    }
+
+    for rows in sorted(args.rows):
+        print(f"Seeding {rows} rows...", file=sys.stderr)
+        seed(rows, args.user_rows, bench_user)
+
+        print(f"Running scenarios at {rows} rows...", file=sys.stderr)
+        report["results"][str(rows)] = run_scenarios(
+            args, bench_user, s3_counter)
+
+    mock.stop()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            f.write(output)
+
+    print_report(report)
+
+
+def print_report(report, baseline=None):
+    header = f"{'rows':>9} {'scenario':<17} {'p50 ms':>9} {'p95 ms':>9} " \
+        f"{'cpu ms':>9} {'ops/s':>9} {'queries':>8} {'s3 calls':>9}"
+    print(f"commit {report['commit']} ({report['database']})")
+    print(header)
+
+    for rows, scenarios in report["results"].items():
+        for name, result in scenarios.items():
+            line = (
+                f"{rows:>9} {name:<17} "
+                f"{result['latency_ms']['p50']:>9.2f} "
+                f"{result['latency_ms']['p95']:>9.2f} "
+                f"{result.get('cpu_ms', 0.0):>9.2f} "
+                f"{result['throughput_per_s']:>9.1f} "
+                f"{result['queries_per_call']:>8.1f} "
+                f"{result['s3_calls_per_call']:>9.1f}"
+            )
+
+            base = (baseline or {}).get("results", {}).get(rows, {}).get(name)
+            if base:
+                before = base["latency_ms"]["p50"]
+                after = result["latency_ms"]["p50"]
+                change = (after - before) / before * 100 if before else 0.0
+                line += f"  p50 {change:+.1f}%"
+                if result["queries_per_call"] != base["queries_per_call"]:
+                    line += f", queries {base['queries_per_call']:.1f}" \
+                        f" -> {result['queries_per_call']:.1f}"
+                if result["s3_calls_per_call"] != base["s3_calls_per_call"]:
+                    line += f", s3 {base['s3_calls_per_call']:.1f}" \
+                        f" -> {result['s3_calls_per_call']:.1f}"
+
+            print(line)
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    print(f"baseline commit {baseline['commit']}")
+    print_report(candidate, baseline)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    subparsers = parser.add_subparsers(dest="command")
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare two JSON reports.")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[1000],
+        help="Total Storage rows to benchmark at, e.g. 1000 100000 1000000.",
+    )
+    parser.add_argument(
+        "--user-rows", type=int, default=100,
+        help="Rows owned by the benchmark user (size of the list response).",
+    )
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--output", help="Write the JSON report to this path.")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        compare(args)
+    else:
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Django settings for running the benchmark suite offline.
+
+The database defaults to a SQLite file so the suite runs anywhere; point
+the BENCH_DB_* environment variables at Postgres to benchmark the
+production database engine. S3 is replaced by moto inside `run.py`.
+"""
+import os
+import tempfile
+
+SECRET_KEY = "benchmarks"
+DEBUG = False
+USE_TZ = True
+
+INSTALLED_APPS = [
+    "django.contrib.auth",
+    "django.contrib.contenttypes",
+    "rest_framework",
+    "ktg_storage",
+]
+
+DATABASES = {
+    "default": {
+        "ENGINE": os.environ.get(
+            "BENCH_DB_ENGINE", "django.db.backends.sqlite3"),
+        "NAME": os.environ.get(
+            "BENCH_DB_NAME",
+            os.path.join(tempfile.gettempdir(), "ktg_storage_bench.sqlite3"),
+        ),
+        "USER": os.environ.get("BENCH_DB_USER", ""),
+        "PASSWORD": os.environ.get("BENCH_DB_PASSWORD", ""),
+        "HOST": os.environ.get("BENCH_DB_HOST", ""),
+        "PORT": os.environ.get("BENCH_DB_PORT", ""),
+    }
+}
+
+ROOT_URLCONF = "benchmarks.urls"
+DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+MEDIA_ROOT = os.path.join(tempfile.gettempdir(), "ktg_storage_bench_media")
+
+AWS_ACCESS_KEY_ID = "benchmark"
+AWS_SECRET_ACCESS_KEY = "benchmark"
+AWS_S3_REGION_NAME = "eu-west-3"
+AWS_STORAGE_BUCKET_NAME = "ktg-storage-bench"
+AWS_DEFAULT_ACL = "private"
+AWS_PRESIGNED_EXPIRY = 3600
+FILE_MAX_SIZE = 10 * 1024 * 1024
+FILE_UPLOAD_STORAGE = "s3"
+IS_USING_LOCAL_STORAGE = False
+ALLOW_AUTHENTICATION = True
+APP_DOMAIN = "http://localhost"
+STATIC_LOCATION = "static"
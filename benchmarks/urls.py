@@ -0,0 +1,6 @@
+from django.urls import include
+from django.urls import path
+
+urlpatterns = [
+    path("storage/", include("ktg_storage.urls")),
+]
@@ -0,0 +1,119 @@
+"""
+Batched last-access tracking.
+
+Reads (presigned URLs, downloads) only record the object key in a
+per-process buffer. The buffer is written to `Storage.last_accessed_at` with
+one bulk UPDATE per `STORAGE_ACCESS_FLUSH_INTERVAL` seconds (or once it
+holds `STORAGE_ACCESS_MAX_PENDING` keys), so hot paths never write per read.
+Timestamps are therefore accurate to the flush interval, which is plenty for
+storage-class tiering.
+"""
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime
+from datetime import timedelta
+from typing import Optional
+from typing import Set
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.utils import timezone
+
+UPDATE_BATCH_SIZE = 1000
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+class AccessTracker:
+    def __init__(self, flush_interval: float = 60, max_pending: int = 10000):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def record(self, file_name: Optional[str]) -> None:
+        if not file_name:
+            return
+
+        with self._lock:
+            self._pending.add(file_name)
+            due = (
+                len(self._pending) >= self.max_pending
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+
+        if due:
+            self.flush()
+
+    def flush(self) -> int:
+        from ktg_storage.models import Storage
+
+        with self._lock:
+            pending, self._pending = list(self._pending), set()
+            self._last_flush = time.monotonic()
+
+        if not pending:
+            return 0
+
+        now = timezone.now()
+        updated = 0
+
+        try:
+            for index in range(0, len(pending), UPDATE_BATCH_SIZE):
+                batch = pending[index:index + UPDATE_BATCH_SIZE]
+                # `update` bypasses auto_now, so updated_at (and the list
+                # ETags derived from it) is not touched by reads.
+                updated += Storage.objects.filter(
+                    file_name__in=batch).update(last_accessed_at=now)
+        except DatabaseError as e:
+            # Access times are advisory, losing one flush is acceptable.
+            logging.error(f"Failed to flush access times: {e}")
+
+        return updated
+
+
+_tracker: Optional[AccessTracker] = None
+
+
+def get_access_tracker() -> AccessTracker:
+    global _tracker
+
+    if _tracker is None:
+        _tracker = AccessTracker(
+            flush_interval=_setting("STORAGE_ACCESS_FLUSH_INTERVAL", 60),
+            max_pending=_setting("STORAGE_ACCESS_MAX_PENDING", 10000),
+        )
+        atexit.register(_tracker.flush)
+
+    return _tracker
+
+
+def tracking_enabled() -> bool:
+    return _setting("STORAGE_ACCESS_TRACKING", True)
+
+
+def is_recent(last_accessed_at: Optional[datetime]) -> bool:
+    resolution = _setting("STORAGE_ACCESS_RESOLUTION", 3600)
+
+    return last_accessed_at is not None and (
+        timezone.now() - last_accessed_at < timedelta(seconds=resolution)
+    )
+
+
+def record_access(
+    file_name: Optional[str], last_accessed_at: Optional[datetime] = None
+) -> None:
+    """
+    Record a read of `file_name`. Callers that have the row pass its current
+    `last_accessed_at`, so objects read within `STORAGE_ACCESS_RESOLUTION`
+    are not even buffered.
+    """
+    if not tracking_enabled() or is_recent(last_accessed_at):
+        return
+
+    get_access_tracker().record(file_name)
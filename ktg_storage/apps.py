@@ -8,4 +8,7 @@ class KTGStorageConfig(AppConfig):
     def ready(self) -> None:
         from ktg_storage.client import s3_get_credentials
         s3_get_credentials()
+
+        from ktg_storage.instrumentation import register_from_settings
+        register_from_settings()
         return super().ready()
@@ -0,0 +1,365 @@
+"""
+Storage service interface and the local filesystem implementation.
+
+`S3Service` (ktg_storage.client) and `LocalStorageService` implement
+`BaseStorageService`; `ktg_storage.client.storage_service` is the one
+selected by `IS_USING_LOCAL_STORAGE`. The local service works on the files
+directly: metadata comes from `os.stat`, reads are memory-mapped and copies
+use `shutil.copyfile` (copy_file_range/sendfile on Linux), so nothing is
+read into Python memory unless a caller asks for the bytes.
+"""
+import abc
+import logging
+import mimetypes
+import mmap
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime
+from datetime import timezone
+from typing import Any
+from typing import BinaryIO
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.utils._os import safe_join
+
+from ktg_storage.instrumentation import instrumented
+from ktg_storage.instrumentation import record_bytes
+
+
+class BaseStorageService(abc.ABC):
+    """
+    Operations the upload and processing pipeline needs from a storage
+    backend. Keys are relative object names such as "files/<name>".
+    """
+
+    @abc.abstractmethod
+    def file_exists(self, key: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def get_file_size(self, key: str) -> int:
+        ...
+
+    @abc.abstractmethod
+    def get_file_metadata(self, object_name: str) -> Optional[Dict[str, Any]]:
+        ...
+
+    @abc.abstractmethod
+    def get_file_content(self, object_name: str) -> Optional[bytes]:
+        ...
+
+    @abc.abstractmethod
+    def get_file_range(
+        self, object_name: str, start: int, end: int
+    ) -> Optional[bytes]:
+        ...
+
+    @abc.abstractmethod
+    def get_file_stream(self, object_name: str) -> Optional[Any]:
+        ...
+
+    @abc.abstractmethod
+    def get_cached_file_path(self, object_name: str) -> Optional[str]:
+        ...
+
+    @contextmanager
+    @abc.abstractmethod
+    def open_file_buffer(self, object_name: str) -> Iterator[Optional[Any]]:
+        ...
+
+    @contextmanager
+    @abc.abstractmethod
+    def open_file_path(self, object_name: str) -> Iterator[Optional[str]]:
+        ...
+
+    @abc.abstractmethod
+    def upload_file(self, file_path: str, object_name: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def upload_fileobj(
+        self,
+        fileobj: BinaryIO,
+        object_name: str,
+        content_type: str,
+        acl: Optional[str] = None,
+        content_encoding: Optional[str] = None,
+    ) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def copy_file(
+        self,
+        source_object_name: str,
+        destination_object_name: str,
+        extra_args: Optional[Dict[str, Any]] = None,
+    ) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def delete_file(self, file_path: str) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def delete_files(self, keys: List[str]) -> List[str]:
+        ...
+
+    @abc.abstractmethod
+    def list_files(self, prefix: str) -> List[str]:
+        ...
+
+    @abc.abstractmethod
+    def create_presigned_url(
+        self, object_name: str, expires: bool = True
+    ) -> Optional[str]:
+        ...
+
+    def create_presigned_urls(
+        self, object_names: List[str], expires: bool = True
+    ) -> List[Optional[str]]:
+        return [
+            self.create_presigned_url(object_name, expires)
+            for object_name in object_names
+        ]
+
+    @abc.abstractmethod
+    def get_file_url(self, object_name: str) -> Optional[str]:
+        ...
+
+    @abc.abstractmethod
+    def get_file_path(self, object_name: str) -> Optional[str]:
+        ...
+
+
+class LocalStorageService(BaseStorageService):
+    def __init__(self, root: Optional[str] = None, base_url: Optional[str] = None):
+        self.root = root or getattr(
+            settings, "STORAGE_LOCAL_ROOT", settings.MEDIA_ROOT)
+        self.base_url = base_url or "{}{}".format(
+            getattr(settings, "APP_DOMAIN", ""), settings.MEDIA_URL)
+
+    def path(self, key: str) -> str:
+        # safe_join rejects keys that would escape the storage root.
+        return safe_join(self.root, key)
+
+    def _stat(self, key: str) -> Optional[os.stat_result]:
+        try:
+            return os.stat(self.path(key))
+        except (OSError, SuspiciousFileOperation):
+            return None
+
+    @instrumented("file_exists")
+    def file_exists(self, key: str) -> bool:
+        return self._stat(key) is not None
+
+    @instrumented("get_file_size")
+    def get_file_size(self, key: str) -> int:
+        stat = self._stat(key)
+
+        return stat.st_size if stat else 0
+
+    @instrumented("get_file_metadata")
+    def get_file_metadata(self, object_name: str) -> Optional[Dict[str, Any]]:
+        stat = self._stat(object_name)
+        if stat is None:
+            logging.error(f"Failed to get metadata for {object_name}")
+            return None
+
+        content_type, _ = mimetypes.guess_type(object_name)
+
+        return {
+            "Size": stat.st_size,
+            "LastModified": datetime.fromtimestamp(
+                stat.st_mtime, tz=timezone.utc),
+            "ContentType": content_type or "application/octet-stream",
+            # Same validator nginx derives from mtime and size.
+            "ETag": f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+            "StorageClass": "STANDARD",
+            "ContentEncoding": None,
+            "Restore": None,
+        }
+
+    @instrumented("get_file_content")
+    def get_file_content(self, object_name: str) -> Optional[bytes]:
+        try:
+            with open(self.path(object_name), "rb") as f:
+                content = f.read()
+            record_bytes(len(content))
+            return content
+        except (OSError, SuspiciousFileOperation) as e:
+            logging.error(f"Failed to fetch file {object_name}: {e}")
+            return None
+
+    @instrumented("get_file_range")
+    def get_file_range(
+        self, object_name: str, start: int, end: int
+    ) -> Optional[bytes]:
+        try:
+            with open(self.path(object_name), "rb") as f:
+                f.seek(start)
+                content = f.read(end - start + 1)
+            record_bytes(len(content))
+            return content
+        except (OSError, SuspiciousFileOperation) as e:
+            logging.error(f"Failed to fetch range of file {object_name}: {e}")
+            return None
+
+    @instrumented("get_file_stream")
+    def get_file_stream(self, object_name: str) -> Optional[BinaryIO]:
+        try:
+            return open(self.path(object_name), "rb")
+        except (OSError, SuspiciousFileOperation) as e:
+            logging.error(f"Failed to stream file {object_name}: {e}")
+            return None
+
+    def get_cached_file_path(self, object_name: str) -> Optional[str]:
+        # The file already is local, no cache copy needed.
+        return self.path(object_name) if self.file_exists(object_name) else None
+
+    @contextmanager
+    def open_file_path(self, object_name: str) -> Iterator[Optional[str]]:
+        yield self.get_cached_file_path(object_name)
+
+    @contextmanager
+    def open_file_buffer(self, object_name: str) -> Iterator[Optional[Any]]:
+        path = self.get_cached_file_path(object_name)
+        if path is None:
+            yield None
+            return
+
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b""
+                return
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                yield buffer
+
+    def _write(self, object_name: str, write) -> bool:
+        path = self.path(object_name)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Write next to the target and rename, readers never see a partial file.
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        record_bytes(os.path.getsize(path))
+
+        return True
+
+    @instrumented("upload_file")
+    def upload_file(self, file_path: str, object_name: str) -> bool:
+        try:
+            def write(f):
+                with open(file_path, "rb") as source:
+                    shutil.copyfileobj(source, f)
+
+            return self._write(object_name, write)
+        except (OSError, SuspiciousFileOperation) as e:
+            logging.error(f"Failed to upload {file_path} to {object_name}: {e}")
+            return False
+
+    @instrumented("upload_fileobj")
+    def upload_fileobj(
+        self,
+        fileobj: BinaryIO,
+        object_name: str,
+        content_type: str,
+        acl: Optional[str] = None,
+        content_encoding: Optional[str] = None,
+    ) -> bool:
+        # Content type and encoding are served from the Storage row.
+        try:
+            return self._write(
+                object_name, lambda f: shutil.copyfileobj(fileobj, f))
+        except (OSError, SuspiciousFileOperation) as e:
+            logging.error(
+                f"Failed to upload file-like object to {object_name}: {e}")
+            return False
+
+    @instrumented("copy_file")
+    def copy_file(
+        self,
+        source_object_name: str,
+        destination_object_name: str,
+        extra_args: Optional[Dict[str, Any]] = None,
+    ) -> bool:
+        try:
+            destination = self.path(destination_object_name)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            shutil.copyfile(self.path(source_object_name), destination)
+
+            return True
+        except (OSError, SuspiciousFileOperation) as e:
+            logging.error(
+                "Failed to copy file {} to {}: {}".format(
+                    source_object_name, destination_object_name, e
+                )
+            )
+
+            return False
+
+    @instrumented("delete_file")
+    def delete_file(self, file_path: str) -> bool:
+        try:
+            os.remove(self.path(file_path))
+            return True
+        except FileNotFoundError:
+            # Same as S3, deleting a missing key succeeds.
+            return True
+        except (OSError, SuspiciousFileOperation) as e:
+            logging.error(f"Failed to delete file {file_path}: {e}")
+            return False
+
+    @instrumented("delete_files")
+    def delete_files(self, keys: List[str]) -> List[str]:
+        return [key for key in keys if not self.delete_file(key)]
+
+    @instrumented("list_files")
+    def list_files(self, prefix: str) -> List[str]:
+        # Keys, like S3, are matched on the string prefix, not directories.
+        directory, _, _ = prefix.rpartition("/")
+        try:
+            top = self.path(directory)
+        except SuspiciousFileOperation:
+            return []
+
+        keys = []
+        for dirpath, _, filenames in os.walk(top):
+            for filename in filenames:
+                key = os.path.relpath(
+                    os.path.join(dirpath, filename), self.root
+                ).replace(os.sep, "/")
+                if key.startswith(prefix):
+                    keys.append(key)
+
+        return sorted(keys)
+
+    def create_presigned_url(
+        self, object_name: str, expires: bool = True
+    ) -> Optional[str]:
+        # Local files are served by the web server (or the download view),
+        # there is nothing to sign.
+        return self.get_file_url(object_name)
+
+    def get_file_url(self, object_name: str) -> Optional[str]:
+        return f"{self.base_url}{object_name}"
+
+    def get_file_path(self, object_name: str) -> Optional[str]:
+        if self.file_exists(object_name):
+            return self.get_file_url(object_name)
+        return None
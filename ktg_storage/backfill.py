@@ -0,0 +1,224 @@
+"""
+Backfill of object size, ETag and content type for rows that predate them.
+
+Records come either from an S3 Inventory report downloaded to local disk
+(`read_inventory`, CSV or Parquet) or from HEAD requests (`head_records`).
+Both are consumed in batches by `apply_records`, one SELECT and one UPDATE
+per batch, so neither the inventory nor the rows are ever held in memory
+as a whole. Inventory reports have no content type, only the HEAD mode
+fills `file_type`.
+"""
+import csv
+import gzip
+import json
+import os
+import re
+from concurrent.futures import Executor
+from itertools import islice
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from urllib.parse import unquote
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import Q
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from ktg_storage.client import storage_service
+from ktg_storage.models import Storage
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - optional dependency
+    pq = None
+
+UPDATE_FIELDS = ["file_size", "stored_size", "etag", "file_type"]
+
+
+class ObjectRecord(NamedTuple):
+    key: str
+    size: Optional[int]
+    etag: Optional[str]
+    content_type: Optional[str] = None
+
+
+def missing_metadata() -> QuerySet[Storage]:
+    return Storage.objects.filter(
+        Q(file_size__isnull=True) | Q(etag__isnull=True),
+        upload_finished_at__isnull=False,
+    ).exclude(file="").order_by()
+
+
+def _column_name(name: str) -> str:
+    # CSV manifests list "ETag", "IsLatest"; Parquet columns are "e_tag",
+    # "is_latest".
+    return re.sub(r"(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])", "_",
+                  name.strip()).lower()
+
+
+def _quoted(etag: Optional[str]) -> Optional[str]:
+    # HEAD returns quoted ETags, inventories do not.
+    if not etag:
+        return None
+
+    return etag if etag.startswith('"') else f'"{etag}"'
+
+
+def _record(row: Dict) -> Optional[ObjectRecord]:
+    if str(row.get("is_delete_marker", "")).lower() == "true":
+        return None
+    if str(row.get("is_latest", "true")).lower() == "false":
+        return None
+
+    size = row.get("size")
+
+    return ObjectRecord(
+        key=row["key"],
+        size=int(size) if size not in (None, "") else None,
+        etag=_quoted(row.get("e_tag")),
+    )
+
+
+def _csv_records(path: str, columns: List[str]) -> Iterator[ObjectRecord]:
+    opener = gzip.open if path.endswith(".gz") else open
+
+    with opener(path, "rt", newline="") as f:
+        for values in csv.reader(f):
+            row = dict(zip(columns, values))
+            # Keys are URL-encoded in CSV reports.
+            row["key"] = unquote(row["key"])
+            record = _record(row)
+            if record is not None:
+                yield record
+
+
+def _parquet_records(path: str, batch_size: int) -> Iterator[ObjectRecord]:
+    if pq is None:
+        raise ImproperlyConfigured(
+            "pyarrow is required to read Parquet inventory reports.")
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size):
+        for row in batch.to_pylist():
+            record = _record(row)
+            if record is not None:
+                yield record
+
+
+def _data_path(manifest_dir: str, key: str, data_dir: Optional[str]) -> str:
+    # Data files live in <config>/data/, next to the dated manifest folder.
+    candidates = [
+        os.path.join(manifest_dir, "..", "data", os.path.basename(key)),
+        os.path.join(manifest_dir, os.path.basename(key)),
+    ]
+    if data_dir:
+        candidates = [
+            os.path.join(data_dir, key),
+            os.path.join(data_dir, os.path.basename(key)),
+        ] + candidates
+
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+
+    raise FileNotFoundError(f"Inventory data file {key} not found.")
+
+
+def read_inventory(
+    manifest_path: str, data_dir: Optional[str] = None, batch_size: int = 1000
+) -> Iterator[ObjectRecord]:
+    """
+    Stream the objects listed by an S3 Inventory `manifest.json`, one data
+    file at a time.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    file_format = manifest["fileFormat"].upper()
+    if file_format not in ("CSV", "PARQUET"):
+        raise ValueError(f"Unsupported inventory format: {file_format}")
+
+    columns = [
+        _column_name(name) for name in manifest["fileSchema"].split(",")]
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+
+    for data_file in manifest["files"]:
+        path = _data_path(manifest_dir, data_file["key"], data_dir)
+        if file_format == "CSV":
+            yield from _csv_records(path, columns)
+        else:
+            yield from _parquet_records(path, batch_size)
+
+
+def head_records(
+    files: Iterable[Storage], executor: Executor
+) -> Iterator[ObjectRecord]:
+    """
+    Records from HEAD requests for `files`, run concurrently on `executor`.
+    """
+    keys = [file.file.name for file in files]
+
+    for key, metadata in zip(keys, executor.map(
+        storage_service.get_file_metadata, keys
+    )):
+        if metadata is not None:
+            yield ObjectRecord(
+                key=key,
+                size=metadata["Size"],
+                etag=metadata["ETag"],
+                content_type=metadata["ContentType"],
+            )
+
+
+def _fill(file: Storage, record: ObjectRecord) -> None:
+    if record.size is not None:
+        # The object of a compressed file is smaller than the file.
+        if not file.content_encoding and file.file_size is None:
+            file.file_size = record.size
+        if file.stored_size is None:
+            file.stored_size = record.size
+    if record.etag and file.etag is None:
+        file.etag = record.etag
+    if record.content_type and not file.file_type:
+        file.file_type = record.content_type
+
+
+def apply_batch(records: List[ObjectRecord]) -> int:
+    """
+    Fill the rows of `records` that are missing metadata, in one UPDATE.
+    """
+    by_key = {record.key: record for record in records}
+    files = list(
+        missing_metadata()
+        .filter(file__in=list(by_key))
+        .only("id", "file", "content_encoding", *UPDATE_FIELDS)
+    )
+
+    # bulk_update skips auto_now, bump updated_at so conditional GETs of
+    # the files see the change.
+    now = timezone.now()
+    for file in files:
+        _fill(file, by_key[file.file.name])
+        file.updated_at = now
+
+    Storage.objects.bulk_update(files, UPDATE_FIELDS + ["updated_at"])
+
+    return len(files)
+
+
+def apply_records(
+    records: Iterable[ObjectRecord], batch_size: int = 1000,
+    prefix: str = "",
+) -> int:
+    records = (record for record in records if record.key.startswith(prefix))
+    updated = 0
+
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return updated
+
+        updated += apply_batch(batch)
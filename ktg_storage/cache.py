@@ -0,0 +1,206 @@
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any
+from typing import BinaryIO
+from typing import Dict
+from typing import Iterator
+from typing import Optional
+from uuid import uuid4
+
+from django.conf import settings
+
+
+class S3ObjectCache:
+    """
+    Size-bounded on-disk LRU cache for S3 objects.
+
+    Entries are keyed by object key *and* ETag, so an object that is
+    overwritten in the bucket is never served stale. Recency is tracked
+    through the entry mtime, which lets several worker processes share
+    the same cache directory.
+    """
+
+    def __init__(self, directory: str, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._size: Optional[int] = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def target_size(self) -> int:
+        # Evict down to 90% of the limit so we do not rescan the directory
+        # on every subsequent write. Larger entries are not cached, they
+        # would be evicted right after being written.
+        return int(self.max_size * 0.9)
+
+    def _entry_path(self, key: str, etag: str) -> str:
+        digest = hashlib.sha256(f"{key}\0{etag}".encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get_path(self, key: str, etag: str) -> Optional[str]:
+        path = self._entry_path(key, etag)
+
+        try:
+            # Touching the entry marks it as recently used.
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+
+        return path
+
+    def put_stream(self, key: str, etag: str, stream: BinaryIO) -> str:
+        path = self._entry_path(key, etag)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file in the same directory and rename it into
+        # place, so readers never observe a partially written entry.
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                shutil.copyfileobj(stream, temp_file)
+                size = temp_file.tell()
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+
+        self._evict()
+
+        return path
+
+    @contextmanager
+    def pin(self, path: str) -> Iterator[Optional[str]]:
+        """
+        Yield a second name of the entry at `path`, which eviction (by any
+        process) does not remove, or None when the entry is already gone.
+        """
+        # Temporary names are skipped by eviction, see `_entries`.
+        pinned = os.path.join(os.path.dirname(path), f".tmp{uuid4().hex}")
+        try:
+            os.link(path, pinned)
+        except FileNotFoundError:
+            yield None
+            return
+
+        try:
+            yield pinned
+        finally:
+            try:
+                os.unlink(pinned)
+            except FileNotFoundError:
+                pass
+
+    @contextmanager
+    def open_buffer(self, key: str, etag: str) -> Iterator[Optional[Any]]:
+        """
+        Yield a read-only memory map of a cached entry, or None on a miss.
+        """
+        try:
+            f = open(self._entry_path(key, etag), "rb")
+        except FileNotFoundError:
+            yield None
+            return
+
+        with f:
+            if os.fstat(f.fileno()).st_size == 0:
+                # Empty files cannot be memory-mapped.
+                yield b""
+                return
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                yield buffer
+
+    def _entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.startswith(".tmp"):
+                    # Entry still being written by another writer.
+                    continue
+
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat
+
+    def _evict(self):
+        with self._lock:
+            if self._size is not None and self._size <= self.max_size:
+                return
+
+            entries = sorted(self._entries(), key=lambda e: e[1].st_mtime)
+            size = sum(stat.st_size for _, stat in entries)
+            target = self.target_size
+
+            for path, stat in entries:
+                if size <= target:
+                    break
+
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+
+                size -= stat.st_size
+                self.evictions += 1
+
+            self._size = size
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.directory, exist_ok=True)
+            self._size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def get_object_cache() -> Optional[S3ObjectCache]:
+    """
+    Build the object cache from settings. Caching is opt-in: it is only
+    enabled when `STORAGE_CACHE_DIR` is set.
+    """
+    directory = getattr(settings, "STORAGE_CACHE_DIR", None)
+    if not directory:
+        return None
+
+    max_size = getattr(settings, "STORAGE_CACHE_MAX_SIZE", 1024 * 1024 * 1024)
+
+    try:
+        return S3ObjectCache(directory, max_size)
+    except OSError as e:
+        logging.error(f"Failed to initialise S3 object cache: {e}")
+        return None
@@ -0,0 +1,178 @@
+"""
+CloudFront signed-cookie delivery.
+
+With `STORAGE_CDN_DOMAIN` set, new uploads are stored under a per-user
+prefix (`files/users/<user id>/`, see `utils.file_generate_upload_path`).
+Serializers return stable, unsigned object URLs on the CDN domain for those
+files instead of presigned S3 URLs, and the views set CloudFront signed
+cookies (`CloudFront-Policy`, `CloudFront-Signature`,
+`CloudFront-Key-Pair-Id`) granting access to the user's prefix only. Files
+uploaded before, outside any user prefix, keep presigned URLs. The cookies
+are signed once and renewed when half their lifetime has passed, so a
+session costs one RSA signature per renewal instead of one signature per
+listed object, and browsers and the CDN can cache the URLs.
+
+The browser only sends the cookies to the CDN when `STORAGE_CDN_DOMAIN` is
+covered by `STORAGE_CDN_COOKIE_DOMAIN`, e.g. "cdn.example.com" with
+".example.com". Signing uses the PEM private key in `STORAGE_CDN_PRIVATE_KEY`
+and requires `cryptography`.
+"""
+import base64
+import functools
+import json
+import time
+from typing import Dict
+from typing import Optional
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from ktg_storage.utils import user_files_prefix
+
+try:
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import padding
+except ImportError:  # pragma: no cover - optional dependency
+    hashes = None
+    serialization = None
+    padding = None
+
+POLICY_COOKIE = "CloudFront-Policy"
+SIGNATURE_COOKIE = "CloudFront-Signature"
+KEY_PAIR_ID_COOKIE = "CloudFront-Key-Pair-Id"
+
+DEFAULT_COOKIE_SECONDS = 12 * 3600
+
+
+def cdn_enabled() -> bool:
+    return bool(getattr(settings, "STORAGE_CDN_DOMAIN", None))
+
+
+def get_resource(user) -> str:
+    return f"https://{settings.STORAGE_CDN_DOMAIN}/{user_files_prefix(user.pk)}/*"
+
+
+def delivers(file) -> bool:
+    """
+    Whether `file` is served from the CDN, i.e. it is stored under its
+    owner's prefix and the owner's cookies grant it.
+    """
+    return (
+        cdn_enabled()
+        and bool(file.file)
+        and file.uploaded_by_id is not None
+        and file.file.name.startswith(
+            f"{user_files_prefix(file.uploaded_by_id)}/")
+    )
+
+
+def get_cookie_seconds() -> int:
+    return getattr(settings, "STORAGE_CDN_COOKIE_SECONDS", DEFAULT_COOKIE_SECONDS)
+
+
+def object_url(object_name: str) -> str:
+    return f"https://{settings.STORAGE_CDN_DOMAIN}/{quote(object_name, safe='/~')}"
+
+
+@functools.lru_cache(maxsize=None)
+def _load_private_key(pem: bytes):
+    if serialization is None:
+        raise ImproperlyConfigured(
+            "cryptography is required for CloudFront signed cookies.")
+
+    return serialization.load_pem_private_key(pem, password=None)
+
+
+def _private_key():
+    pem = getattr(settings, "STORAGE_CDN_PRIVATE_KEY", None)
+    if not pem or not getattr(settings, "STORAGE_CDN_KEY_PAIR_ID", None):
+        raise ImproperlyConfigured(
+            "STORAGE_CDN_PRIVATE_KEY and STORAGE_CDN_KEY_PAIR_ID are required "
+            "with STORAGE_CDN_DOMAIN.")
+
+    return _load_private_key(pem.encode() if isinstance(pem, str) else pem)
+
+
+def _encode(data: bytes) -> str:
+    # CloudFront's URL-safe base64 variant.
+    return (
+        base64.b64encode(data).decode("ascii")
+        .replace("+", "-").replace("=", "_").replace("/", "~")
+    )
+
+
+def _decode(value: str) -> bytes:
+    return base64.b64decode(
+        value.replace("-", "+").replace("_", "=").replace("~", "/"))
+
+
+def build_policy(resource: str, expires_at: int) -> bytes:
+    policy = {
+        "Statement": [{
+            "Resource": resource,
+            "Condition": {"DateLessThan": {"AWS:EpochTime": expires_at}},
+        }]
+    }
+
+    return json.dumps(policy, separators=(",", ":")).encode("utf-8")
+
+
+def signed_cookies(user, expires_at: Optional[int] = None) -> Dict[str, str]:
+    """
+    Cookie values granting access to the files of `user` until `expires_at`
+    (epoch seconds).
+    """
+    if expires_at is None:
+        expires_at = int(time.time()) + get_cookie_seconds()
+
+    policy = build_policy(get_resource(user), expires_at)
+    signature = _private_key().sign(policy, padding.PKCS1v15(), hashes.SHA1())
+
+    return {
+        POLICY_COOKIE: _encode(policy),
+        SIGNATURE_COOKIE: _encode(signature),
+        KEY_PAIR_ID_COOKIE: settings.STORAGE_CDN_KEY_PAIR_ID,
+    }
+
+
+def cookie_expiry(cookies: Dict[str, str], user) -> Optional[int]:
+    """
+    Expiry of the policy cookie sent by the client, if it was issued for
+    the files of `user`.
+    """
+    value = cookies.get(POLICY_COOKIE)
+    if not value:
+        return None
+
+    try:
+        statement = json.loads(_decode(value))["Statement"][0]
+        if statement["Resource"] != get_resource(user):
+            return None
+
+        return int(statement["Condition"]["DateLessThan"]["AWS:EpochTime"])
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def needs_renewal(cookies: Dict[str, str], user) -> bool:
+    expires_at = cookie_expiry(cookies, user)
+
+    return expires_at is None or expires_at - time.time() < get_cookie_seconds() / 2
+
+
+def set_signed_cookies(response, user) -> None:
+    max_age = get_cookie_seconds()
+    values = signed_cookies(user, int(time.time()) + max_age)
+
+    for name, value in values.items():
+        response.set_cookie(
+            name,
+            value,
+            max_age=max_age,
+            domain=getattr(settings, "STORAGE_CDN_COOKIE_DOMAIN", None),
+            secure=True,
+            httponly=True,
+            samesite="Lax",
+        )
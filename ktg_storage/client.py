@@ -1,7 +1,12 @@
 from typing import Dict
 from typing import Any
+from typing import Iterator
+from typing import List
 from typing import Optional
+from typing import Tuple
 import logging
+import os
+from contextlib import contextmanager
 from dataclasses import dataclass
 import boto3
 from botocore.client import Config
@@ -9,6 +14,18 @@ from botocore.exceptions import ClientError
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from io import BytesIO
+from ktg_storage.backends import BaseStorageService
+from ktg_storage.backends import LocalStorageService
+from ktg_storage.cache import get_object_cache
+from ktg_storage.instrumentation import instrumented
+from ktg_storage.instrumentation import record_bytes
+from ktg_storage.instrumentation import record_error
+from ktg_storage.instrumentation import record_retries
+from ktg_storage.signer import PresignedUrlSigner
+
+
+# DeleteObjects accepts at most 1000 keys per request.
+DELETE_BATCH_SIZE = 1000
 
 
 def assert_settings(required_settings, error_message_prefix=""):
@@ -79,7 +96,7 @@ def s3_get_credentials() -> S3Credentials:
 
 
 def get_s3_client():
-    return boto3.client(
+    client = boto3.client(
         service_name="s3",
         aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
         aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
@@ -87,6 +104,9 @@ def get_s3_client():
         config=Config(s3={"addressing_style": "path"},
                       signature_version="s3v4"),
     )
+    client.meta.events.register("after-call.s3", record_retries)
+
+    return client
 
 
 def get_s3_resource():
@@ -98,16 +118,33 @@ def get_s3_resource():
     )
 
 
-class S3Service:
+def _fileobj_size(fileobj) -> int:
+    position = fileobj.tell()
+    size = fileobj.seek(0, os.SEEK_END) - position
+    fileobj.seek(position)
+
+    return size
+
+
+class S3Service(BaseStorageService):
     def __init__(self):
         self.client = get_s3_client()
         self.bucket_name = settings.AWS_STORAGE_BUCKET_NAME
         self.acl = settings.AWS_DEFAULT_ACL
         self.expiry = settings.AWS_PRESIGNED_EXPIRY
         self.max_size = settings.FILE_MAX_SIZE
+        self.cache = get_object_cache()
+        self.signer = PresignedUrlSigner.from_client(
+            self.client,
+            access_key_id=settings.AWS_ACCESS_KEY_ID,
+            secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+            bucket_name=self.bucket_name,
+        )
 
+    # Signing, URL building and cache lookups make no request and are not
+    # instrumented, only methods calling S3 count as S3 calls.
     def generate_presigned_post(
-        self, *, file_path: str, file_type: str
+        self, *, file_path: str, file_type: str, max_size: Optional[int] = None
     ) -> Dict[str, Any]:
         try:
             presigned_data = self.client.generate_presigned_post(
@@ -117,29 +154,28 @@ class S3Service:
                 Conditions=[
                     {"acl": self.acl},
                     {"Content-Type": file_type},
-                    ["content-length-range", 1, self.max_size],
+                    ["content-length-range", 1, max_size or self.max_size],
                 ],
                 ExpiresIn=self.expiry,
             )
             return presigned_data
         except ClientError as e:
+            record_error(e)
             logging.error(f"Failed to generate presigned POST URL: {e}")
             raise
 
     def create_presigned_url(self, object_name: str, expires: bool = True) -> Optional[str]:
+        # Same URL as client.generate_presigned_url("get_object", ...), signed
+        # in process with a cached signing key.
+        return self.signer.sign(object_name, self.expiry if expires else 0)
 
-        expires_in = self.expiry if expires else 0
-
-        try:
-            return self.client.generate_presigned_url(
-                "get_object",
-                Params={"Bucket": self.bucket_name, "Key": object_name},
-                ExpiresIn=expires_in,
-            )
-        except ClientError as e:
-            logging.error(f"Failed to generate presigned URL: {e}")
-            return None
+    def create_presigned_urls(
+        self, object_names: List[str], expires: bool = True
+    ) -> List[str]:
+        return self.signer.sign_many(
+            object_names, self.expiry if expires else 0)
 
+    @instrumented("get_file")
     def get_file(
         self, object_name: str, download_path: Optional[str] = None
     ) -> Optional[bytes]:
@@ -147,13 +183,17 @@ class S3Service:
             if download_path:
                 self.client.download_file(
                     self.bucket_name, object_name, download_path)
+                record_bytes(os.path.getsize(download_path))
                 logging.info(f"File downloaded to {download_path}")
                 return None
             else:
                 obj = self.client.get_object(
                     Bucket=self.bucket_name, Key=object_name)
-                return obj["Body"].read()
+                content = obj["Body"].read()
+                record_bytes(len(content))
+                return content
         except ClientError as e:
+            record_error(e)
             logging.error(
                 "Failed to retrieve file %s from S3: %s",
                 object_name,
@@ -162,17 +202,24 @@ class S3Service:
 
             return None
 
-    def copy_file(self, source_object_name: str, destination_object_name: str) -> bool:
+    @instrumented("copy_file")
+    def copy_file(
+        self,
+        source_object_name: str,
+        destination_object_name: str,
+        extra_args: Optional[Dict[str, Any]] = None,
+    ) -> bool:
 
         copy_source = {"Bucket": self.bucket_name, "Key": source_object_name}
         try:
             self.client.copy(copy_source, self.bucket_name,
-                             destination_object_name)
+                             destination_object_name, ExtraArgs=extra_args)
             logging.info("Copied %s to %s", source_object_name,
                          destination_object_name)
 
             return True
         except ClientError as e:
+            record_error(e)
             logging.error(
                 "Failed to copy file {} to {}: {}".format(
                     source_object_name, destination_object_name, e
@@ -181,14 +228,174 @@ class S3Service:
 
             return False
 
+    @instrumented("set_storage_class")
+    def set_storage_class(self, object_name: str, storage_class: str) -> bool:
+        """
+        Transition an object by copying it onto itself. Metadata (including
+        Content-Encoding) is kept; the ACL has to be restated because copies
+        default to private.
+        """
+        copy_source = {"Bucket": self.bucket_name, "Key": object_name}
+        try:
+            self.client.copy(
+                copy_source,
+                self.bucket_name,
+                object_name,
+                ExtraArgs={
+                    "StorageClass": storage_class,
+                    "MetadataDirective": "COPY",
+                    "ACL": self.acl,
+                },
+            )
+
+            return True
+        except ClientError as e:
+            record_error(e)
+            logging.error(
+                "Failed to move %s to %s: %s", object_name, storage_class, e)
+
+            return False
+
+    @instrumented("restore_object")
+    def restore_object(self, object_name: str, days: int, tier: str = "Standard") -> bool:
+        try:
+            self.client.restore_object(
+                Bucket=self.bucket_name,
+                Key=object_name,
+                RestoreRequest={
+                    "Days": days,
+                    "GlacierJobParameters": {"Tier": tier},
+                },
+            )
+
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "RestoreAlreadyInProgress":
+                return True
+
+            record_error(e)
+            logging.error(f"Failed to restore {object_name}: {e}")
+
+            return False
+
+    @instrumented("set_object_tags")
+    def set_object_tags(self, object_name: str, tags: Dict[str, str]) -> bool:
+        """
+        Replace the tag set of an object; an empty dict removes all tags.
+        """
+        try:
+            if tags:
+                self.client.put_object_tagging(
+                    Bucket=self.bucket_name,
+                    Key=object_name,
+                    Tagging={"TagSet": [
+                        {"Key": key, "Value": value}
+                        for key, value in tags.items()
+                    ]},
+                )
+            else:
+                self.client.delete_object_tagging(
+                    Bucket=self.bucket_name, Key=object_name)
+
+            return True
+        except ClientError as e:
+            record_error(e)
+            logging.error(f"Failed to tag {object_name}: {e}")
+
+            return False
+
+    @instrumented("get_object_tags")
+    def get_object_tags(self, object_name: str) -> Optional[Dict[str, str]]:
+        try:
+            response = self.client.get_object_tagging(
+                Bucket=self.bucket_name, Key=object_name)
+
+            return {tag["Key"]: tag["Value"] for tag in response["TagSet"]}
+        except ClientError as e:
+            record_error(e)
+            logging.error(f"Failed to get tags of {object_name}: {e}")
+
+            return None
+
+    @instrumented("get_lifecycle_rules")
+    def get_lifecycle_rules(self) -> List[Dict[str, Any]]:
+        try:
+            response = self.client.get_bucket_lifecycle_configuration(
+                Bucket=self.bucket_name)
+
+            return response["Rules"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "NoSuchLifecycleConfiguration":
+                return []
+
+            record_error(e)
+            raise
+
+    @instrumented("put_lifecycle_rules")
+    def put_lifecycle_rules(self, rules: List[Dict[str, Any]]) -> None:
+        try:
+            if rules:
+                self.client.put_bucket_lifecycle_configuration(
+                    Bucket=self.bucket_name,
+                    LifecycleConfiguration={"Rules": rules},
+                )
+            else:
+                self.client.delete_bucket_lifecycle(Bucket=self.bucket_name)
+        except ClientError as e:
+            record_error(e)
+            raise
+
+    @instrumented("delete_file")
     def delete_file(self, file_path: str) -> bool:
         try:
             self.client.delete_object(Bucket=self.bucket_name, Key=file_path)
             return True
         except ClientError as e:
+            record_error(e)
             logging.error(f"Failed to delete file from S3: {e}")
             return False
 
+    @instrumented("delete_files")
+    def delete_files(self, keys: List[str]) -> List[str]:
+        """
+        Delete keys with batched DeleteObjects calls. Returns the keys that
+        could not be deleted.
+        """
+        failed = []
+
+        for index in range(0, len(keys), DELETE_BATCH_SIZE):
+            batch = keys[index:index + DELETE_BATCH_SIZE]
+            try:
+                response = self.client.delete_objects(
+                    Bucket=self.bucket_name,
+                    Delete={
+                        "Objects": [{"Key": key} for key in batch],
+                        "Quiet": True,
+                    },
+                )
+                failed.extend(error["Key"] for error in response.get("Errors", []))
+            except ClientError as e:
+                record_error(e)
+                logging.error(f"Failed to delete files from S3: {e}")
+                failed.extend(batch)
+
+        return failed
+
+    @instrumented("list_files")
+    def list_files(self, prefix: str) -> List[str]:
+        try:
+            pages = self.client.get_paginator("list_objects_v2").paginate(
+                Bucket=self.bucket_name, Prefix=prefix)
+
+            return [
+                item["Key"] for page in pages for item in page.get("Contents", [])
+            ]
+        except ClientError as e:
+            record_error(e)
+            logging.error(f"Failed to list files under {prefix}: {e}")
+            return []
+
+    @instrumented("file_exists")
     def file_exists(self, key: str) -> bool:
         try:
             self.client.head_object(Bucket=self.bucket_name, Key=key)
@@ -197,8 +404,10 @@ class S3Service:
             if e.response["Error"]["Code"] == "404":
                 return False
 
+            record_error(e)
             raise
 
+    @instrumented("get_file_size")
     def get_file_size(self, key: str) -> int:
         if not self.file_exists(key):
             return 0
@@ -223,13 +432,106 @@ class S3Service:
             logging.error(f"Failed to generate URL for {object_name}: {e}")
             return None
 
-    def get_file_content(self, object_name: str) -> Optional[bytes]:
+    def _cache_object(self, object_name: str) -> Optional[Tuple[str, str]]:
+        if self.cache is None:
+            return None
+
+        metadata = self.get_file_metadata(object_name)
+        if metadata is None or metadata["Size"] > self.cache.target_size:
+            return None
+
+        etag = metadata["ETag"]
+        path = self.cache.get_path(object_name, etag)
+        if path is None:
+            path = self._download_to_cache(object_name, etag, metadata["Size"])
 
+        return (path, etag) if path is not None else None
+
+    @instrumented("cache_object")
+    def _download_to_cache(
+        self, object_name: str, etag: str, size: int
+    ) -> Optional[str]:
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket_name, Key=object_name, IfMatch=etag)
+            path = self.cache.put_stream(object_name, etag, response["Body"])
+            record_bytes(size)
+
+            return path
+        except ClientError as e:
+            record_error(e)
+            logging.error(
+                "Failed to cache file %s: %s",
+                object_name,
+                e.response["Error"]["Message"],
+            )
+
+            return None
+
+    def get_cached_file_path(self, object_name: str) -> Optional[str]:
+        """
+        Return a local path to the object, downloading it through the on-disk
+        cache on a miss. Returns None when caching is disabled or the object
+        can not be cached.
+        """
+        cached = self._cache_object(object_name)
+
+        return cached[0] if cached else None
+
+    @contextmanager
+    def open_file_buffer(self, object_name: str) -> Iterator[Optional[Any]]:
+        """
+        Yield the object content as a buffer: a read-only memory map of the
+        cached copy when caching is enabled, otherwise the downloaded bytes.
+        """
+        cached = self._cache_object(object_name)
+
+        if cached is not None:
+            path, etag = cached
+            with self.cache.open_buffer(object_name, etag) as buffer:
+                if buffer is not None:
+                    yield buffer
+                    return
+
+        yield self.get_file_content(object_name)
+
+    @contextmanager
+    def open_file_path(self, object_name: str) -> Iterator[Optional[str]]:
+        """
+        Yield a local path to the cached object that stays readable until
+        the block exits, even when another process evicts the entry.
+        Yields None when caching is disabled or the object can not be cached.
+        """
+        cached = self._cache_object(object_name)
+        if cached is None:
+            yield None
+            return
+
+        with self.cache.pin(cached[0]) as path:
+            yield path
+
+    def get_file_content(self, object_name: str) -> Optional[bytes]:
+        path = self.get_cached_file_path(object_name)
+        if path is not None:
+            try:
+                with open(path, "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                # Evicted by another process since the lookup.
+                pass
+
+        return self._get_object_content(object_name)
+
+    @instrumented("get_file_content")
+    def _get_object_content(self, object_name: str) -> Optional[bytes]:
         try:
             response = self.client.get_object(
                 Bucket=self.bucket_name, Key=object_name)
-            return response["Body"].read()
+            content = response["Body"].read()
+            record_bytes(len(content))
+            return content
         except ClientError as e:
+            record_error(e)
             logging.error(
                 "Failed to fetch file %s: %s",
                 object_name,
@@ -238,33 +540,97 @@ class S3Service:
 
             return None
 
+    @instrumented("get_file_range")
+    def get_file_range(
+        self, object_name: str, start: int, end: int
+    ) -> Optional[bytes]:
+        """
+        Fetch bytes `start`..`end` (inclusive) of an object, e.g. to parse a
+        file header without downloading the whole object.
+        """
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket_name,
+                Key=object_name,
+                Range=f"bytes={start}-{end}",
+            )
+            content = response["Body"].read()
+            record_bytes(len(content))
+            return content
+        except ClientError as e:
+            record_error(e)
+            logging.error(
+                "Failed to fetch range of file %s: %s",
+                object_name,
+                e.response["Error"]["Message"],
+            )
+
+            return None
+
+    @instrumented("get_file_stream")
+    def get_file_stream(self, object_name: str) -> Optional[Any]:
+        """
+        Return the streaming body of an object, for reading it in chunks.
+        Stored bytes are returned as-is, `Content-Encoding` is not undone.
+        """
+        try:
+            response = self.client.get_object(
+                Bucket=self.bucket_name, Key=object_name)
+            record_bytes(response["ContentLength"])
+            return response["Body"]
+        except ClientError as e:
+            record_error(e)
+            logging.error(
+                "Failed to stream file %s: %s",
+                object_name,
+                e.response["Error"]["Message"],
+            )
+
+            return None
+
+    @instrumented("upload_file")
     def upload_file(self, file_path: str, object_name: str) -> bool:
 
         try:
             self.client.upload_file(file_path, self.bucket_name, object_name)
+            record_bytes(os.path.getsize(file_path))
             logging.info(f"Uploaded {file_path} to {object_name}")
             return True
         except ClientError as e:
+            record_error(e)
             message = f"Failed to upload {file_path} to {object_name}: {e}"
             logging.error(message)
 
             return False
 
+    @instrumented("upload_fileobj")
     def upload_fileobj(
-        self, fileobj: BytesIO, object_name: str, content_type: str, acl: Optional[str] = None
+        self,
+        fileobj: BytesIO,
+        object_name: str,
+        content_type: str,
+        acl: Optional[str] = None,
+        content_encoding: Optional[str] = None,
     ) -> bool:
         try:
             acl = acl or self.acl
+            size = _fileobj_size(fileobj)
+            extra_args = {"ContentType": content_type, "ACL": acl}
+            if content_encoding:
+                extra_args["ContentEncoding"] = content_encoding
+
             self.client.upload_fileobj(
                 fileobj,
                 self.bucket_name,
                 object_name,
-                ExtraArgs={"ContentType": content_type, "ACL": acl},
+                ExtraArgs=extra_args,
             )
 
+            record_bytes(size)
             logging.info(f"Uploaded file-like object to {object_name}")
             return True
         except ClientError as e:
+            record_error(e)
             logging.error(
                 "Failed to upload file-like object to %s: %s",
                 object_name,
@@ -273,6 +639,7 @@ class S3Service:
 
             return False
 
+    @instrumented("get_file_metadata")
     def get_file_metadata(self, object_name: str):
         try:
             response = self.client.head_object(
@@ -282,11 +649,25 @@ class S3Service:
                 "LastModified": response["LastModified"],
                 "ContentType": response["ContentType"],
                 "ETag": response["ETag"],
+                "StorageClass": response.get("StorageClass", "STANDARD"),
+                "Restore": response.get("Restore"),
+                "ContentEncoding": response.get("ContentEncoding"),
             }
             return metadata
         except ClientError as e:
+            record_error(e)
             logging.error(f"Failed to get metadata for {object_name}: {e}")
             return None
 
 
 s3_service = S3Service()
+
+
+def get_storage_service() -> BaseStorageService:
+    if getattr(settings, "IS_USING_LOCAL_STORAGE", False):
+        return LocalStorageService()
+
+    return s3_service
+
+
+storage_service = get_storage_service()
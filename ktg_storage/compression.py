@@ -0,0 +1,224 @@
+"""
+Transparent compression of compressible stored objects.
+
+Finished direct uploads whose MIME type is listed in `STORAGE_COMPRESS_TYPES`
+are recompressed with gzip or zstd (`STORAGE_COMPRESSION`) and written back
+under the same key with the matching `Content-Encoding`. `Storage.file_size`
+keeps the logical size and `Storage.stored_size` the size in the bucket.
+Objects that would not shrink by at least `MIN_SAVING` are left untouched.
+Nothing is compressed with local storage, whose media URLs serve the stored
+bytes without a `Content-Encoding`.
+
+Compression and decompression are streamed in `CHUNK_SIZE` pieces, so memory
+use does not depend on the object size. Stages that parse the content
+(thumbnails, metadata, image variants) read it through `decode`.
+"""
+import logging
+import tempfile
+import zlib
+from typing import Iterable
+from typing import Iterator
+from typing import Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from ktg_storage.client import storage_service
+from ktg_storage.instrumentation import stage
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+GZIP = "gzip"
+ZSTD = "zstd"
+ENCODINGS = (GZIP, ZSTD)
+
+DEFAULT_LEVELS = {GZIP: 6, ZSTD: 3}
+
+CHUNK_SIZE = 1024 * 1024
+
+# Keep the original object unless compression saves at least 10%.
+MIN_SAVING = 0.1
+
+# wbits for zlib that produce/accept a gzip header and trailer.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def get_encoding() -> str:
+    encoding = getattr(settings, "STORAGE_COMPRESSION", GZIP)
+
+    if encoding not in ENCODINGS:
+        raise ImproperlyConfigured(
+            f"STORAGE_COMPRESSION must be one of {', '.join(ENCODINGS)}."
+        )
+
+    if encoding == ZSTD and zstandard is None:
+        raise ImproperlyConfigured(
+            "zstandard is required for STORAGE_COMPRESSION = 'zstd'."
+        )
+
+    return encoding
+
+
+def get_level(encoding: str) -> int:
+    level = getattr(settings, "STORAGE_COMPRESSION_LEVEL", None)
+
+    return level or DEFAULT_LEVELS[encoding]
+
+
+def should_compress(file_type: Optional[str]) -> bool:
+    """
+    `STORAGE_COMPRESS_TYPES` entries are exact MIME types ("text/csv") or
+    type wildcards ("text/*").
+    """
+    if settings.IS_USING_LOCAL_STORAGE:
+        return False
+
+    mime_type = (file_type or "").split(";")[0].strip().lower()
+    if not mime_type:
+        return False
+
+    for pattern in getattr(settings, "STORAGE_COMPRESS_TYPES", []):
+        pattern = pattern.lower()
+
+        if pattern == mime_type:
+            return True
+        if pattern.endswith("/*") and mime_type.startswith(pattern[:-1]):
+            return True
+
+    return False
+
+
+def accepts_encoding(accept_encoding: str, encoding: str) -> bool:
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+
+        if token.strip().lower() not in (encoding, "*"):
+            continue
+
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+
+        return True
+
+    return False
+
+
+def iter_chunks(stream, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def _compressor(encoding: str, level: int):
+    if encoding == GZIP:
+        return zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+
+    return zstandard.ZstdCompressor(level=level).compressobj()
+
+
+def _decompressor(encoding: str):
+    if encoding == GZIP:
+        return zlib.decompressobj(GZIP_WBITS)
+
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def compress_chunks(
+    chunks: Iterable[bytes], encoding: str, level: Optional[int] = None
+) -> Iterator[bytes]:
+    compressor = _compressor(encoding, level or DEFAULT_LEVELS[encoding])
+
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    data = compressor.flush()
+    if data:
+        yield data
+
+
+def decompress_chunks(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    decompressor = _decompressor(encoding)
+
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def decode(source, encoding: Optional[str]):
+    """
+    Content of a buffer read from storage (bytes or a memory map), decoded
+    when the object is stored with `encoding`.
+    """
+    if source is None or not encoding:
+        return source
+
+    return b"".join(decompress_chunks([source[:]], encoding))
+
+
+def compress_object(file) -> bool:
+    """
+    Recompress the object of a finished `Storage` row in place. Sets
+    `content_encoding` and `stored_size` on the instance (the caller saves
+    it) and returns whether the stored object was replaced. Objects already
+    stored with an encoding are left alone.
+    """
+    if file.content_encoding:
+        return False
+
+    encoding = get_encoding()
+    s3_key = file.file.name
+
+    try:
+        with stage("compress"):
+            body = storage_service.get_file_stream(s3_key)
+            if body is None:
+                return False
+
+            with tempfile.TemporaryFile() as compressed:
+                chunks = compress_chunks(
+                    iter_chunks(body), encoding, get_level(encoding))
+                for chunk in chunks:
+                    compressed.write(chunk)
+
+                stored_size = compressed.tell()
+                if stored_size > (file.file_size or 0) * (1 - MIN_SAVING):
+                    return False
+
+                compressed.seek(0)
+                success = storage_service.upload_fileobj(
+                    compressed,
+                    s3_key,
+                    content_type=file.file_type,
+                    content_encoding=encoding,
+                )
+
+        if not success:
+            return False
+
+        file.content_encoding = encoding
+        file.stored_size = stored_size
+
+        return True
+
+    except Exception as e:
+        message = f"Error compressing {s3_key}: {str(e)}"
+        logging.error(message, exc_info=True)
+
+        return False
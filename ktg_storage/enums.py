@@ -9,3 +9,19 @@ class FileUploadStrategy(Enum):
 class FileUploadStorage:
     LOCAL = "local"
     S3 = "s3"
+
+
+class StorageClass:
+    """
+    S3 storage classes, warmest first.
+    """
+    STANDARD = "STANDARD"
+    STANDARD_IA = "STANDARD_IA"
+    GLACIER_IR = "GLACIER_IR"
+    GLACIER = "GLACIER"
+    DEEP_ARCHIVE = "DEEP_ARCHIVE"
+
+    TIERS = [STANDARD, STANDARD_IA, GLACIER_IR, GLACIER, DEEP_ARCHIVE]
+
+    # Objects in these classes must be restored before they can be read.
+    ARCHIVED = [GLACIER, DEEP_ARCHIVE]
@@ -0,0 +1,159 @@
+"""
+Expiry offloaded to S3 lifecycle rules.
+
+With `STORAGE_LIFECYCLE_EXPIRY` enabled, objects are tagged at `finish` (and
+whenever `expire_at` changes) with the smallest expiry bucket, in days since
+the object was created, that is not earlier than `expire_at`. One lifecycle
+rule per bucket (installed by `install_expiry_rules`) then deletes the
+objects, so the app never sends per-object deletes. `expire_files` only
+marks the expired rows deleted.
+
+Lifecycle expiry counts from the object's creation, which is never earlier
+than `Storage.created_at`, so rounding up to a bucket means objects can be
+deleted a little after `expire_at`, never before. Copies (key sharding,
+storage-class changes) restart the count and keep the tags. Image variants
+carry the tag of their source.
+"""
+import math
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models import Sum
+from django.utils import timezone
+
+from ktg_storage import quota
+from ktg_storage.client import s3_service
+from ktg_storage.models import Storage
+from ktg_storage.utils import variants_generate_prefix
+
+EXPIRY_TAG = "ktg-expiry"
+
+# Rules installed by this module are recognised (and replaced) by this prefix.
+RULE_ID_PREFIX = "ktg-storage-expiry-"
+
+DEFAULT_BUCKETS = [1, 7, 30, 90, 180, 365, 730]
+
+
+def lifecycle_enabled() -> bool:
+    return (
+        getattr(settings, "STORAGE_LIFECYCLE_EXPIRY", False)
+        and not settings.IS_USING_LOCAL_STORAGE
+    )
+
+
+def get_buckets() -> List[int]:
+    return sorted(
+        getattr(settings, "STORAGE_LIFECYCLE_EXPIRY_DAYS", DEFAULT_BUCKETS))
+
+
+def expiry_tag(file: Storage) -> Optional[str]:
+    """
+    Tag value for the file, or None when it does not expire or expires
+    later than the largest bucket (the row then keeps the object alive).
+    """
+    if file.expire_at is None:
+        return None
+
+    created_at = file.created_at or timezone.now()
+    days = max(
+        math.ceil((file.expire_at - created_at).total_seconds() / 86400), 1)
+
+    for bucket in get_buckets():
+        if bucket >= days:
+            return f"{bucket}d"
+
+    return None
+
+
+def lifecycle_rules() -> List[Dict[str, Any]]:
+    return [
+        {
+            "ID": f"{RULE_ID_PREFIX}{days}d",
+            "Filter": {"Tag": {"Key": EXPIRY_TAG, "Value": f"{days}d"}},
+            "Status": "Enabled",
+            "Expiration": {"Days": days},
+        }
+        for days in get_buckets()
+    ]
+
+
+def install_rules() -> List[Dict[str, Any]]:
+    """
+    Put the expiry rules on the bucket, keeping every rule not managed
+    here. Returns the resulting rules.
+    """
+    rules = [
+        rule for rule in s3_service.get_lifecycle_rules()
+        if not rule.get("ID", "").startswith(RULE_ID_PREFIX)
+    ]
+    rules += lifecycle_rules()
+
+    s3_service.put_lifecycle_rules(rules)
+
+    return rules
+
+
+def tag_object(s3_key: str, tag: Optional[str]) -> bool:
+    return s3_service.set_object_tags(s3_key, {EXPIRY_TAG: tag} if tag else {})
+
+
+def apply_expiry_tag(file: Storage) -> bool:
+    """
+    Tag the object for the current `expire_at` and store the tag on the row.
+    No request is made when the tag is unchanged.
+    """
+    if not lifecycle_enabled() or not file.file or not file.upload_finished_at:
+        return False
+
+    tag = expiry_tag(file)
+    if tag == file.expiry_tag:
+        return True
+
+    if not tag_object(file.file.name, tag):
+        return False
+
+    for key in s3_service.list_files(variants_generate_prefix(file.file.name)):
+        tag_object(key, tag)
+
+    file.expiry_tag = tag
+    Storage.objects.filter(pk=file.pk).update(expiry_tag=tag)
+
+    return True
+
+
+def expired_files() -> QuerySet[Storage]:
+    """
+    Lifecycle-managed files past `expire_at`, served by
+    `storage_lifecycle_expire_idx`.
+    """
+    return Storage.objects.filter(
+        expiry_tag__isnull=False, expire_at__lte=timezone.now()
+    ).order_by()
+
+
+@transaction.atomic
+def mark_expired(file_ids: List) -> int:
+    """
+    Soft-delete expired files in one UPDATE, releasing their quota with one
+    UPDATE per owner.
+    """
+    files = Storage.objects.filter(id__in=file_ids).order_by()
+
+    if quota.quota_enabled():
+        sizes = (
+            files.filter(upload_finished_at__isnull=False)
+            .values("uploaded_by")
+            .annotate(total=Sum("file_size"))
+        )
+        users = get_user_model().objects.in_bulk(
+            [row["uploaded_by"] for row in sizes if row["uploaded_by"]])
+        for row in sizes:
+            quota.release(users.get(row["uploaded_by"]), row["total"] or 0)
+
+    return files.update(is_deleted=True, updated_at=timezone.now())
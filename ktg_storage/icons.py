@@ -0,0 +1,120 @@
+"""
+Shared placeholder thumbnails for file types without a real preview.
+
+Every unsupported upload of a category (doc, zip, audio, generic) references
+the same icon object under `icons/`, rendered and uploaded once per size. The
+icons live outside `thumbnails/`, so re-sharding and thumbnail regeneration
+never move or delete them.
+"""
+import logging
+import threading
+from io import BytesIO
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+from PIL import Image
+from PIL import ImageDraw
+
+from ktg_storage.client import storage_service
+from ktg_storage.utils import icon_generate_path
+
+GENERIC = "generic"
+
+# Category -> (label, background colour).
+ICONS = {
+    "doc": ("DOC", (66, 133, 244)),
+    "zip": ("ZIP", (244, 180, 0)),
+    "audio": ("AUDIO", (171, 71, 188)),
+    GENERIC: ("FILE", (120, 144, 156)),
+}
+
+ARCHIVE_TYPES = {
+    "application/zip",
+    "application/gzip",
+    "application/x-gzip",
+    "application/x-tar",
+    "application/x-bzip2",
+    "application/x-xz",
+    "application/x-7z-compressed",
+    "application/x-rar",
+    "application/x-rar-compressed",
+    "application/vnd.rar",
+    "application/zstd",
+}
+
+DOCUMENT_TYPES = {
+    "application/msword",
+    "application/rtf",
+    "application/vnd.ms-excel",
+    "application/vnd.ms-powerpoint",
+    "application/json",
+    "application/xml",
+}
+
+DOCUMENT_PREFIXES = (
+    "text/",
+    "application/vnd.openxmlformats-officedocument.",
+    "application/vnd.oasis.opendocument.",
+)
+
+# Keys known to exist, so each process checks the bucket once per icon.
+_known_icons: Set[str] = set()
+_lock = threading.Lock()
+
+
+def icon_category(mime_type: str) -> str:
+    if mime_type.startswith("audio/"):
+        return "audio"
+    if mime_type in ARCHIVE_TYPES:
+        return "zip"
+    if mime_type in DOCUMENT_TYPES or mime_type.startswith(DOCUMENT_PREFIXES):
+        return "doc"
+
+    return GENERIC
+
+
+def render_icon(category: str, size: Tuple[int, int]) -> BytesIO:
+    label, color = ICONS[category]
+
+    img = Image.new("RGB", size, color=color)
+    draw = ImageDraw.Draw(img)
+    left, top, right, bottom = draw.textbbox((0, 0), label)
+    draw.text(
+        ((size[0] - (right - left)) / 2, (size[1] - (bottom - top)) / 2),
+        label,
+        fill=(255, 255, 255),
+    )
+
+    buffer = BytesIO()
+    img.save(buffer, format="PNG", optimize=True)
+    buffer.seek(0)
+
+    return buffer
+
+
+def get_icon(mime_type: str, size: Tuple[int, int]) -> Optional[str]:
+    """
+    Key of the shared icon for `mime_type`, uploading it if the bucket does
+    not have it yet.
+    """
+    category = icon_category(mime_type)
+    key = icon_generate_path(category, size)
+    if key in _known_icons:
+        return key
+
+    with _lock:
+        if key in _known_icons:
+            return key
+
+        if not storage_service.file_exists(key):
+            success = storage_service.upload_fileobj(
+                render_icon(category, size), key, content_type="image/png"
+            )
+            if not success:
+                logging.error(f"Failed to upload {category} icon to S3.")
+                return None
+
+        _known_icons.add(key)
+
+    return key
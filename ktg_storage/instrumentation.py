@@ -0,0 +1,350 @@
+"""
+Pluggable instrumentation for `S3Service` calls and thumbnail stages.
+
+Instruments are registered with `register()` (or through the
+`STORAGE_INSTRUMENTS` setting) and receive one record per S3 operation or
+thumbnail stage. When no instrument is registered the hooks return
+immediately, so instrumentation costs a single list check per call.
+
+`count_s3_calls()` counts the operations made in a block, per operation,
+for budgets (`S3CallBudgetMiddleware`) and tests (`assertNumS3Calls`). Only
+calls made in the block's context are counted, not those of other threads.
+"""
+import contextvars
+import functools
+import logging
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+try:
+    import prometheus_client
+except ImportError:  # pragma: no cover - optional dependency
+    prometheus_client = None
+
+try:
+    from opentelemetry import metrics as otel_metrics
+    from opentelemetry import trace as otel_trace
+except ImportError:  # pragma: no cover - optional dependency
+    otel_metrics = None
+    otel_trace = None
+
+
+@dataclass
+class OperationRecord:
+    operation: str
+    start_time: float
+    duration: float = 0.0
+    bytes_transferred: int = 0
+    retries: int = 0
+    error: Optional[str] = None
+
+
+@dataclass
+class StageRecord:
+    stage: str
+    start_time: float
+    duration: float = 0.0
+    error: Optional[str] = None
+
+
+class Instrument:
+    """
+    Base class for instruments. Subclasses override the hooks they need.
+    """
+
+    def record_operation(self, record: OperationRecord) -> None:
+        pass
+
+    def record_stage(self, record: StageRecord) -> None:
+        pass
+
+
+_instruments: List[Instrument] = []
+_current_operation: contextvars.ContextVar[Optional[OperationRecord]] = (
+    contextvars.ContextVar("ktg_storage_s3_operation", default=None)
+)
+
+
+class S3CallCounter:
+    """
+    Calls per `S3Service` operation made while the counter is active.
+    Operations calling other operations (e.g. `get_file_size` checking
+    `file_exists`) count each of them.
+    """
+
+    def __init__(self):
+        self.calls: Counter = Counter()
+        self._token: Optional[contextvars.Token] = None
+
+    @property
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+    def __enter__(self) -> "S3CallCounter":
+        self._token = _call_counters.set(_call_counters.get() + (self,))
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        _call_counters.reset(self._token)
+
+
+class S3CallBudgetExceeded(Exception):
+    pass
+
+
+_call_counters: contextvars.ContextVar[Tuple[S3CallCounter, ...]] = (
+    contextvars.ContextVar("ktg_storage_s3_call_counters", default=())
+)
+
+
+def count_s3_calls() -> S3CallCounter:
+    return S3CallCounter()
+
+
+def register(instrument: Instrument) -> Instrument:
+    if instrument not in _instruments:
+        _instruments.append(instrument)
+
+    return instrument
+
+
+def unregister(instrument: Instrument) -> None:
+    if instrument in _instruments:
+        _instruments.remove(instrument)
+
+
+def register_from_settings() -> None:
+    for path in getattr(settings, "STORAGE_INSTRUMENTS", []):
+        register(import_string(path)())
+
+
+def _emit(method: str, record) -> None:
+    for instrument in list(_instruments):
+        try:
+            getattr(instrument, method)(record)
+        except Exception as e:
+            # Instrumentation must never break storage calls.
+            logging.error(f"Instrument {instrument!r} failed: {e}")
+
+
+def instrumented(operation: str):
+    """
+    Decorate an `S3Service` method so every call produces an
+    `OperationRecord`.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            for counter in _call_counters.get():
+                counter.calls[operation] += 1
+
+            if not _instruments:
+                return func(*args, **kwargs)
+
+            record = OperationRecord(operation=operation, start_time=time.time())
+            token = _current_operation.set(record)
+            start = time.perf_counter()
+
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                record.error = record.error or type(e).__name__
+                raise
+            finally:
+                record.duration = time.perf_counter() - start
+                _current_operation.reset(token)
+                _emit("record_operation", record)
+
+        return wrapper
+
+    return decorator
+
+
+def record_bytes(count: int) -> None:
+    record = _current_operation.get()
+    if record is not None:
+        record.bytes_transferred += count
+
+
+def record_error(error: Exception) -> None:
+    record = _current_operation.get()
+    if record is None:
+        return
+
+    response = getattr(error, "response", None) or {}
+    record.error = response.get("Error", {}).get("Code") or type(error).__name__
+
+
+def record_retries(parsed=None, **kwargs) -> None:
+    """
+    botocore `after-call` handler that adds the retry attempts of the
+    underlying API call to the current operation.
+    """
+    record = _current_operation.get()
+    if record is None or not parsed:
+        return
+
+    record.retries += parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    if not _instruments:
+        yield
+        return
+
+    record = StageRecord(stage=name, start_time=time.time())
+    start = time.perf_counter()
+
+    try:
+        yield
+    except Exception as e:
+        record.error = type(e).__name__
+        raise
+    finally:
+        record.duration = time.perf_counter() - start
+        _emit("record_stage", record)
+
+
+class PrometheusInstrument(Instrument):
+    """
+    Export records as Prometheus metrics. Requires `prometheus_client`.
+    """
+
+    def __init__(self, registry=None, namespace: str = "ktg_storage"):
+        if prometheus_client is None:
+            raise ImproperlyConfigured(
+                "prometheus_client is required for PrometheusInstrument."
+            )
+
+        options = {"namespace": namespace}
+        if registry is not None:
+            options["registry"] = registry
+
+        self.operation_duration = prometheus_client.Histogram(
+            "s3_operation_duration_seconds",
+            "Latency of S3Service operations.",
+            ["operation"],
+            **options,
+        )
+        self.operation_bytes = prometheus_client.Counter(
+            "s3_operation_bytes",
+            "Bytes transferred by S3Service operations.",
+            ["operation"],
+            **options,
+        )
+        self.operation_errors = prometheus_client.Counter(
+            "s3_operation_errors",
+            "Failed S3Service operations.",
+            ["operation", "error"],
+            **options,
+        )
+        self.operation_retries = prometheus_client.Counter(
+            "s3_operation_retries",
+            "Retries performed by S3Service operations.",
+            ["operation"],
+            **options,
+        )
+        self.stage_duration = prometheus_client.Histogram(
+            "thumbnail_stage_duration_seconds",
+            "Latency of thumbnail pipeline stages.",
+            ["stage"],
+            **options,
+        )
+
+    def record_operation(self, record: OperationRecord) -> None:
+        self.operation_duration.labels(record.operation).observe(record.duration)
+
+        if record.bytes_transferred:
+            self.operation_bytes.labels(record.operation).inc(
+                record.bytes_transferred)
+        if record.retries:
+            self.operation_retries.labels(record.operation).inc(record.retries)
+        if record.error:
+            self.operation_errors.labels(record.operation, record.error).inc()
+
+    def record_stage(self, record: StageRecord) -> None:
+        self.stage_duration.labels(record.stage).observe(record.duration)
+
+
+class OpenTelemetryInstrument(Instrument):
+    """
+    Export records as OpenTelemetry metrics and spans. Requires
+    `opentelemetry-api`; exporters are configured by the host project.
+    """
+
+    def __init__(self, meter=None, tracer=None):
+        if otel_metrics is None:
+            raise ImproperlyConfigured(
+                "opentelemetry-api is required for OpenTelemetryInstrument."
+            )
+
+        meter = meter or otel_metrics.get_meter("ktg_storage")
+        self.tracer = tracer or otel_trace.get_tracer("ktg_storage")
+
+        self.operation_duration = meter.create_histogram(
+            "ktg_storage.s3.duration", unit="s",
+            description="Latency of S3Service operations.",
+        )
+        self.operation_bytes = meter.create_counter(
+            "ktg_storage.s3.bytes", unit="By",
+            description="Bytes transferred by S3Service operations.",
+        )
+        self.operation_errors = meter.create_counter(
+            "ktg_storage.s3.errors",
+            description="Failed S3Service operations.",
+        )
+        self.operation_retries = meter.create_counter(
+            "ktg_storage.s3.retries",
+            description="Retries performed by S3Service operations.",
+        )
+        self.stage_duration = meter.create_histogram(
+            "ktg_storage.thumbnail.stage.duration", unit="s",
+            description="Latency of thumbnail pipeline stages.",
+        )
+
+    def _span(self, name: str, record, attributes) -> None:
+        start_ns = int(record.start_time * 1e9)
+        span = self.tracer.start_span(
+            name, start_time=start_ns, attributes=attributes)
+
+        if record.error:
+            span.set_status(otel_trace.Status(
+                otel_trace.StatusCode.ERROR, record.error))
+
+        span.end(end_time=start_ns + int(record.duration * 1e9))
+
+    def record_operation(self, record: OperationRecord) -> None:
+        attributes = {"operation": record.operation}
+
+        self.operation_duration.record(record.duration, attributes)
+        if record.bytes_transferred:
+            self.operation_bytes.add(record.bytes_transferred, attributes)
+        if record.retries:
+            self.operation_retries.add(record.retries, attributes)
+        if record.error:
+            self.operation_errors.add(
+                1, {**attributes, "error": record.error})
+
+        self._span(f"s3.{record.operation}", record, {
+            **attributes,
+            "bytes": record.bytes_transferred,
+            "retries": record.retries,
+        })
+
+    def record_stage(self, record: StageRecord) -> None:
+        attributes = {"stage": record.stage}
+
+        self.stage_duration.record(record.duration, attributes)
+        self._span(f"thumbnail.{record.stage}", record, attributes)
@@ -0,0 +1,82 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from ktg_storage import backfill
+from ktg_storage.utils import FILES_PREFIX
+
+
+class Command(BaseCommand):
+    help = (
+        "Fill file_size, stored_size, etag and (HEAD mode only) a missing "
+        "file_type for finished files, from an S3 Inventory report on local "
+        "disk or from HEAD requests."
+    )
+
+    def add_arguments(self, parser):
+        mode = parser.add_mutually_exclusive_group(required=True)
+        mode.add_argument(
+            "--inventory", metavar="MANIFEST",
+            help="Path to the manifest.json of a CSV or Parquet inventory.",
+        )
+        mode.add_argument(
+            "--head", action="store_true",
+            help="HEAD every file missing metadata.",
+        )
+        parser.add_argument(
+            "--data-dir",
+            help="Directory holding the inventory data files, if they are "
+                 "not in the data/ folder next to the manifest's folder.",
+        )
+        parser.add_argument(
+            "--prefix", default=f"{FILES_PREFIX}/",
+            help="Only read inventory keys under this prefix.",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="Number of rows per SELECT and UPDATE.",
+        )
+        parser.add_argument(
+            "--workers", type=int, default=16,
+            help="Number of concurrent HEAD requests.",
+        )
+
+    def handle(self, *args, **options):
+        if options["inventory"]:
+            try:
+                updated = backfill.apply_records(
+                    backfill.read_inventory(
+                        options["inventory"], options["data_dir"],
+                        options["batch_size"],
+                    ),
+                    options["batch_size"],
+                    options["prefix"],
+                )
+            except (OSError, KeyError, ValueError) as e:
+                raise CommandError(f"Could not read the inventory: {e}")
+        else:
+            updated = self._head(options["batch_size"], options["workers"])
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Filled metadata of {updated} files."))
+
+    def _head(self, batch_size: int, workers: int) -> int:
+        files = backfill.missing_metadata()
+        updated = 0
+        last_pk = None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                # Files whose object is missing stay in the queryset, page by
+                # primary key so they are not fetched again.
+                page = files.order_by("pk").only("id", "file")
+                if last_pk is not None:
+                    page = page.filter(pk__gt=last_pk)
+                batch = list(page[:batch_size])
+                if not batch:
+                    return updated
+                last_pk = batch[-1].pk
+
+                updated += backfill.apply_batch(
+                    list(backfill.head_records(batch, executor)))
@@ -0,0 +1,47 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import close_old_connections
+
+from ktg_storage import notifications
+
+
+class Command(BaseCommand):
+    help = (
+        "Finish direct uploads from the S3 ObjectCreated notifications "
+        "delivered to an SQS queue (STORAGE_UPLOAD_EVENTS_QUEUE_URL)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--queue-url",
+            default=getattr(settings, "STORAGE_UPLOAD_EVENTS_QUEUE_URL", None),
+        )
+        parser.add_argument(
+            "--wait", type=int, default=20,
+            help="Long-polling wait per receive, in seconds.",
+        )
+        parser.add_argument(
+            "--once", action="store_true",
+            help="Stop when the queue is empty instead of polling forever.",
+        )
+
+    def handle(self, *args, **options):
+        if not options["queue_url"]:
+            raise CommandError(
+                "Pass --queue-url or set STORAGE_UPLOAD_EVENTS_QUEUE_URL.")
+
+        queue = notifications.SQSQueue(options["queue_url"])
+        finished = 0
+
+        while True:
+            messages = queue.receive(wait_seconds=options["wait"])
+            if not messages and options["once"]:
+                break
+
+            if messages:
+                close_old_connections()
+                finished += notifications.handle_messages(queue, messages)
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Finished {finished} uploads."))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from ktg_storage import expiry
+
+
+class Command(BaseCommand):
+    help = (
+        "Mark files whose expire_at has passed as deleted. Their objects are "
+        "deleted by the bucket lifecycle rules (install_expiry_rules), this "
+        "command makes no storage requests."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Only report how many files would be marked deleted.",
+        )
+
+    def handle(self, *args, **options):
+        files = expiry.expired_files()
+
+        if options["dry_run"]:
+            self.stdout.write(f"{files.count()} files would be marked deleted.")
+            return
+
+        marked = 0
+        while True:
+            # Marked rows leave the queryset, so always take the first batch.
+            batch = list(
+                files.values_list("id", flat=True)[:options["batch_size"]])
+            if not batch:
+                break
+
+            count = expiry.mark_expired(batch)
+            if not count:
+                break
+            marked += count
+
+        self.stdout.write(
+            self.style.SUCCESS(f"Marked {marked} expired files deleted."))
@@ -0,0 +1,89 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from ktg_storage import expiry
+from ktg_storage.models import Storage
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = (
+        "Put the lifecycle rules that expire objects tagged by "
+        "STORAGE_LIFECYCLE_EXPIRY on the bucket (other rules are kept), and "
+        "optionally tag files that already have an expire_at."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--tag-existing", action="store_true",
+            help="Tag finished files with an expire_at that are not tagged yet.",
+        )
+        parser.add_argument(
+            "--workers", type=int, default=16,
+            help="Number of concurrent tagging requests.",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Print the rules instead of installing them.",
+        )
+
+    def handle(self, *args, **options):
+        if not expiry.lifecycle_enabled():
+            raise CommandError(
+                "STORAGE_LIFECYCLE_EXPIRY is not enabled for S3 storage.")
+
+        if options["dry_run"]:
+            self.stdout.write(json.dumps(expiry.lifecycle_rules(), indent=2))
+            return
+
+        rules = expiry.install_rules()
+        self.stdout.write(f"Bucket has {len(rules)} lifecycle rules.")
+
+        if options["tag_existing"]:
+            tagged = self._tag_existing(options["workers"])
+            self.stdout.write(f"Tagged {tagged} files.")
+
+        self.stdout.write(self.style.SUCCESS("Expiry rules installed."))
+
+    def _tag_existing(self, workers: int) -> int:
+        files = Storage.objects.filter(
+            expire_at__isnull=False,
+            expiry_tag__isnull=True,
+            upload_finished_at__isnull=False,
+        ).exclude(file="").order_by()
+
+        tagged = 0
+        last_pk = None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                page = files.order_by("pk").only(
+                    "id", "file", "created_at", "expire_at")
+                if last_pk is not None:
+                    page = page.filter(pk__gt=last_pk)
+                batch = list(page[:BATCH_SIZE])
+                if not batch:
+                    return tagged
+                last_pk = batch[-1].pk
+
+                # Files expiring after the largest bucket stay untagged.
+                for file in batch:
+                    file.expiry_tag = expiry.expiry_tag(file)
+                batch = [file for file in batch if file.expiry_tag]
+
+                # Only the tagging requests run in the pool, rows are updated
+                # here in one statement per batch.
+                results = executor.map(
+                    lambda file: expiry.tag_object(
+                        file.file.name, file.expiry_tag),
+                    batch,
+                )
+                updated = [
+                    file for file, success in zip(batch, results) if success]
+
+                Storage.objects.bulk_update(updated, ["expiry_tag"])
+                tagged += len(updated)
@@ -0,0 +1,95 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from ktg_storage.models import Storage
+from ktg_storage.models import StorageUsage
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute StorageUsage counters from Storage in batches of users and "
+        "drop reservations of uploads that were started but never finished."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--stale-after-hours", type=int, default=24,
+            help="Release reservations of unfinished uploads older than this.",
+        )
+
+    def handle(self, *args, **options):
+        stale_before = timezone.now() - timedelta(
+            hours=options["stale_after_hours"])
+
+        released = Storage.objects.filter(
+            upload_finished_at__isnull=True,
+            reserved_size__isnull=False,
+            created_at__lt=stale_before,
+        ).update(reserved_size=None)
+
+        corrected = 0
+        last_pk = 0
+
+        while True:
+            with transaction.atomic():
+                # Locking the usage rows first means concurrent finish/delete
+                # operations either land before the aggregate below or are
+                # applied on top of the corrected values.
+                batch = list(
+                    StorageUsage.objects.select_for_update()
+                    .filter(pk__gt=last_pk)
+                    .order_by("pk")[:options["batch_size"]]
+                )
+                if not batch:
+                    break
+
+                last_pk = batch[-1].pk
+                corrected += self._reconcile(batch)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Released {released} stale reservations, "
+            f"corrected {corrected} usage rows."
+        ))
+
+    def _reconcile(self, batch) -> int:
+        user_ids = [usage.user_id for usage in batch]
+
+        files = Storage.objects.filter(uploaded_by_id__in=user_ids).order_by()
+
+        used = dict(
+            files.filter(upload_finished_at__isnull=False)
+            .exclude(file="")
+            .values("uploaded_by_id")
+            .annotate(total=Sum("file_size"))
+            .values_list("uploaded_by_id", "total")
+        )
+        reserved = dict(
+            files.filter(
+                upload_finished_at__isnull=True, reserved_size__isnull=False
+            )
+            .values("uploaded_by_id")
+            .annotate(total=Sum("reserved_size"))
+            .values_list("uploaded_by_id", "total")
+        )
+
+        changed = []
+        for usage in batch:
+            used_bytes = used.get(usage.user_id) or 0
+            reserved_bytes = reserved.get(usage.user_id) or 0
+
+            if (usage.used_bytes, usage.reserved_bytes) != (
+                used_bytes, reserved_bytes
+            ):
+                usage.used_bytes = used_bytes
+                usage.reserved_bytes = reserved_bytes
+                changed.append(usage)
+
+        StorageUsage.objects.bulk_update(
+            changed, ["used_bytes", "reserved_bytes"])
+
+        return len(changed)
@@ -0,0 +1,205 @@
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from ktg_storage import compression
+from ktg_storage.client import get_s3_client
+from ktg_storage.client import s3_service
+from ktg_storage.client import storage_service
+from ktg_storage.models import Storage
+from ktg_storage.services import create_thumbnail
+
+REGENERATED = "regenerated"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+# (file id, status, thumbnail url, placeholder, source etag, error)
+Result = Tuple[
+    str, str, Optional[str], Optional[str], Optional[str], Optional[str]
+]
+
+
+def _init_worker():
+    # boto3 clients are not safe to share across a fork.
+    s3_service.client = get_s3_client()
+
+
+def _regenerate(row, size: Tuple[int, int], force: bool) -> Result:
+    file_id = row[0]
+
+    # A failing row (unreachable endpoint, unreadable image, ...) must not
+    # abort the run and lose the results not written yet.
+    try:
+        return _regenerate_row(row, size, force)
+    except Exception as e:
+        return file_id, FAILED, None, None, None, f"{type(e).__name__}: {e}"
+
+
+def _regenerate_row(row, size: Tuple[int, int], force: bool) -> Result:
+    file_id, s3_key, thumbnail, recorded_etag, content_encoding = row
+
+    metadata = storage_service.get_file_metadata(s3_key)
+    if metadata is None:
+        return file_id, FAILED, None, None, None, "Source object not found"
+
+    etag = metadata["ETag"]
+    if not force and thumbnail and recorded_etag == etag:
+        return file_id, SKIPPED, thumbnail, None, etag, None
+
+    if content_encoding:
+        # Sniff and decode the content, not the compressed bytes.
+        with storage_service.open_file_buffer(s3_key) as source:
+            if source is None:
+                return file_id, FAILED, None, None, None, "Source object not found"
+            data = create_thumbnail(
+                s3_key, size, compression.decode(source, content_encoding))
+    else:
+        data = create_thumbnail(s3_key, size)
+    if data is None:
+        return file_id, FAILED, None, None, etag, "Thumbnail generation failed"
+
+    thumbnail_url = storage_service.get_file_url(data["thumbnail"])
+
+    return file_id, REGENERATED, thumbnail_url, data["placeholder"], etag, None
+
+
+class Command(BaseCommand):
+    help = (
+        "Regenerate thumbnails for finished uploads across a process pool. "
+        "Files whose thumbnail was built from the current source ETag are "
+        "skipped unless --force is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count() or 1,
+            help="Number of worker processes.",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Number of results written to the database per UPDATE batch.",
+        )
+        parser.add_argument(
+            "--size", type=int, default=128,
+            help="Thumbnail bounding box in pixels.",
+        )
+        parser.add_argument(
+            "--missing-only", action="store_true",
+            help="Only process files without a thumbnail.",
+        )
+        parser.add_argument(
+            "--failed-only", action="store_true",
+            help="Only retry files whose previous generation failed.",
+        )
+        parser.add_argument(
+            "--force", action="store_true",
+            help="Regenerate even when the thumbnail is up to date.",
+        )
+
+    def get_queryset(self, options):
+        queryset = Storage.objects.filter(
+            upload_finished_at__isnull=False,
+        ).exclude(file="").exclude(file__isnull=True)
+
+        if options["missing_only"]:
+            queryset = queryset.filter(thumbnail__isnull=True)
+
+        if options["failed_only"]:
+            queryset = queryset.filter(thumbnail_error__isnull=False)
+
+        return queryset.order_by().values_list(
+            "id", "file", "thumbnail", "thumbnail_source_etag",
+            "content_encoding",
+        )
+
+    def handle(self, *args, **options):
+        size = (options["size"], options["size"])
+        batch_size = options["batch_size"]
+        workers = max(options["workers"], 1)
+        max_in_flight = workers * 4
+
+        counts = {REGENERATED: 0, SKIPPED: 0, FAILED: 0}
+        results: List[Result] = []
+
+        # Worker processes are forked, make sure they do not inherit open
+        # database connections: a fork pool starts all its workers on the
+        # first submit, so wait for one before the rows are queried.
+        connections.close_all()
+
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+        ) as executor:
+            executor.submit(int).result()
+
+            pending = set()
+            rows = self.get_queryset(options).iterator(chunk_size=batch_size)
+
+            for row in rows:
+                pending.add(
+                    executor.submit(_regenerate, row, size, options["force"])
+                )
+
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    results.extend(future.result() for future in done)
+
+                if len(results) >= batch_size:
+                    self._write_results(results, counts)
+                    results = []
+
+            done, _ = wait(pending)
+            results.extend(future.result() for future in done)
+            self._write_results(results, counts)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Regenerated {regenerated}, skipped {skipped}, "
+                "failed {failed}.".format(**counts)
+            )
+        )
+
+    def _write_results(self, results: List[Result], counts):
+        now = timezone.now()
+        updated = []
+        failed = []
+
+        for file_id, status, thumbnail, placeholder, etag, error in results:
+            counts[status] += 1
+
+            if status == REGENERATED:
+                updated.append(
+                    Storage(
+                        id=file_id,
+                        thumbnail=thumbnail,
+                        placeholder=placeholder,
+                        thumbnail_source_etag=etag,
+                        thumbnail_error=None,
+                        updated_at=now,
+                    )
+                )
+            elif status == FAILED:
+                failed.append(Storage(id=file_id, thumbnail_error=error))
+                self.stderr.write(f"{file_id}: {error}")
+
+        Storage.objects.bulk_update(
+            updated,
+            [
+                "thumbnail",
+                "placeholder",
+                "thumbnail_source_etag",
+                "thumbnail_error",
+                "updated_at",
+            ],
+        )
+        Storage.objects.bulk_update(failed, ["thumbnail_error"])
@@ -0,0 +1,236 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List
+from typing import Optional
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from ktg_storage import tiering
+from ktg_storage.client import s3_service
+from ktg_storage.enums import StorageClass
+from ktg_storage.models import Storage
+from ktg_storage.utils import FILES_PREFIX
+from ktg_storage.utils import THUMBNAILS_PREFIX
+from ktg_storage.utils import reshard_key
+from ktg_storage.utils import shard_depth
+from ktg_storage.utils import variants_generate_prefix
+
+
+@dataclass
+class Move:
+    file_id: str
+    key: str
+    new_key: str
+    file_name: str
+    storage_class: str
+    file_type: str = ""
+    etag: Optional[str] = None
+    thumbnail_source_etag: Optional[str] = None
+    stored_size: Optional[int] = None
+    expiry_tag: Optional[str] = None
+    thumbnail: Optional[str] = None
+    thumbnail_key: Optional[str] = None
+    new_thumbnail_key: Optional[str] = None
+
+
+def _thumbnail_key(thumbnail: Optional[str]) -> Optional[str]:
+    prefix = s3_service.get_file_url("")
+    if thumbnail and prefix and thumbnail.startswith(prefix):
+        key = thumbnail[len(prefix):]
+        if key.startswith(f"{THUMBNAILS_PREFIX}/"):
+            return key
+
+    return None
+
+
+def _copy(move: Move) -> bool:
+    extra_args = {"ACL": s3_service.acl, "StorageClass": move.storage_class}
+
+    if move.new_key != move.key:
+        if not s3_service.copy_file(move.key, move.new_key, extra_args):
+            return False
+
+        etag = tiering.refresh_copy(
+            move.new_key, move.stored_size, move.expiry_tag)
+        if etag and etag != move.etag:
+            if move.thumbnail_source_etag == move.etag:
+                move.thumbnail_source_etag = etag
+            move.etag = etag
+
+    if move.new_thumbnail_key != move.thumbnail_key:
+        # The row keeps the old thumbnail, it does not block the move.
+        if not s3_service.copy_file(
+            move.thumbnail_key, move.new_thumbnail_key, {"ACL": s3_service.acl}
+        ):
+            move.new_thumbnail_key = move.thumbnail_key
+
+    return True
+
+
+class Command(BaseCommand):
+    help = (
+        "Move objects and thumbnails to the key layout of "
+        "STORAGE_KEY_SHARD_DEPTH (e.g. files/ab/cd/<name>) with parallel "
+        "server-side copies. Rows are updated before the old keys are "
+        "deleted, so every row always points at an existing object. Image "
+        "variants of moved files are deleted and rendered again on demand."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--depth", type=int, default=None,
+            help="Shard depth to move to, defaults to STORAGE_KEY_SHARD_DEPTH.",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Number of files per batch of copies and UPDATE.",
+        )
+        parser.add_argument(
+            "--workers", type=int, default=16,
+            help="Number of concurrent copy requests.",
+        )
+        parser.add_argument(
+            "--keep-source", action="store_true",
+            help="Do not delete the old keys after moving.",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Only report how many files would be moved.",
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        depth = options["depth"] if options["depth"] is not None else shard_depth()
+        batch_size = options["batch_size"]
+
+        rows = (
+            Storage.objects.filter(file__startswith=f"{FILES_PREFIX}/")
+            .order_by()
+            .values_list(
+                "id", "file", "file_name", "thumbnail", "storage_class",
+                "file_type", "etag", "thumbnail_source_etag", "stored_size",
+                "expiry_tag",
+            )
+            .iterator(chunk_size=batch_size)
+        )
+
+        counts = {"moved": 0, "failed": 0, "skipped": 0}
+        batch: List[Move] = []
+
+        with ThreadPoolExecutor(max_workers=options["workers"]) as executor:
+            for row in rows:
+                move = self._plan(row, depth)
+                if move is None:
+                    continue
+
+                if move.storage_class in StorageClass.ARCHIVED:
+                    # Archived objects can not be copied without a restore.
+                    counts["skipped"] += 1
+                    continue
+
+                batch.append(move)
+                if len(batch) >= batch_size:
+                    self._move_batch(executor, batch, counts)
+                    batch = []
+
+            self._move_batch(executor, batch, counts)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Moved {moved}, failed {failed}, skipped {skipped} "
+                "archived files.".format(**counts)
+            )
+        )
+
+    def _plan(self, row, depth: int) -> Optional[Move]:
+        (
+            file_id, key, file_name, thumbnail, storage_class, file_type,
+            etag, thumbnail_source_etag, stored_size, expiry_tag,
+        ) = row
+
+        thumbnail_key = _thumbnail_key(thumbnail)
+        move = Move(
+            file_id=file_id,
+            key=key,
+            new_key=reshard_key(key, depth),
+            file_name=file_name,
+            storage_class=storage_class,
+            file_type=file_type or "",
+            etag=etag,
+            thumbnail_source_etag=thumbnail_source_etag,
+            stored_size=stored_size,
+            expiry_tag=expiry_tag,
+            thumbnail=thumbnail,
+            thumbnail_key=thumbnail_key,
+            new_thumbnail_key=(
+                reshard_key(thumbnail_key, depth) if thumbnail_key else None
+            ),
+        )
+
+        if move.new_key == key and move.new_thumbnail_key == thumbnail_key:
+            return None
+
+        return move
+
+    def _move_batch(self, executor, batch: List[Move], counts) -> None:
+        if not batch:
+            return
+
+        if self.options["dry_run"]:
+            counts["moved"] += len(batch)
+            return
+
+        moved = [
+            move for move, success in zip(batch, executor.map(_copy, batch))
+            if success
+        ]
+        counts["moved"] += len(moved)
+        counts["failed"] += len(batch) - len(moved)
+
+        now = timezone.now()
+        updated = []
+        for move in moved:
+            file = Storage(
+                id=move.file_id,
+                updated_at=now,
+                file=move.new_key,
+                # Direct uploads store the full key as file_name.
+                file_name=(
+                    move.new_key if move.file_name == move.key
+                    else move.file_name
+                ),
+                thumbnail=move.thumbnail,
+                etag=move.etag,
+                thumbnail_source_etag=move.thumbnail_source_etag,
+            )
+            if move.new_thumbnail_key != move.thumbnail_key:
+                file.thumbnail = s3_service.get_file_url(move.new_thumbnail_key)
+            updated.append(file)
+
+        with transaction.atomic():
+            Storage.objects.bulk_update(
+                updated, [
+                    "file", "file_name", "thumbnail", "etag",
+                    "thumbnail_source_etag", "updated_at",
+                ])
+
+        if self.options["keep_source"]:
+            return
+
+        old_keys = [move.key for move in moved if move.new_key != move.key]
+        old_keys += [
+            move.thumbnail_key for move in moved
+            if move.new_thumbnail_key != move.thumbnail_key
+        ]
+        # Variants are keyed by the file's key, the ones of the old key
+        # would never be read or deleted again.
+        variant_prefixes = [
+            variants_generate_prefix(move.key) for move in moved
+            if move.new_key != move.key and move.file_type.startswith("image/")
+        ]
+        for keys in executor.map(s3_service.list_files, variant_prefixes):
+            old_keys += keys
+        for key in s3_service.delete_files(old_keys):
+            self.stderr.write(f"Could not delete {key}")
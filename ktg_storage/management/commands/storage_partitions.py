@@ -0,0 +1,76 @@
+from datetime import datetime
+from datetime import timezone
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+
+from ktg_storage import partitioning
+
+
+class Command(BaseCommand):
+    help = (
+        "Maintain the monthly created_at partitions of the Storage table "
+        "(Postgres, STORAGE_PARTITIONING): create the partitions of the next "
+        "months and detach old ones. Run daily."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--convert", action="store_true",
+            help="Partition the table first (online, copies rows in batches).",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=5000,
+            help="Rows copied per transaction by --convert.",
+        )
+        parser.add_argument(
+            "--ahead", type=int, default=3,
+            help="Number of future monthly partitions to keep created.",
+        )
+        parser.add_argument(
+            "--detach-after-months", type=int, default=None,
+            help=(
+                "Detach partitions older than this many months. Their files "
+                "disappear from the app, only use it for data that is no "
+                "longer needed (e.g. already expired)."
+            ),
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Only report the partitions that would be detached.",
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Storage partitioning requires Postgres.")
+
+        if options["convert"]:
+            if partitioning.convert_table(
+                connection, batch_size=options["batch_size"],
+                months_ahead=options["ahead"],
+            ):
+                self.stdout.write("Partitioned the Storage table.")
+
+        if not partitioning.is_partitioned(connection):
+            raise CommandError(
+                "The Storage table is not partitioned, run with --convert.")
+
+        if not options["dry_run"]:
+            for name in partitioning.ensure_partitions(
+                connection, options["ahead"]
+            ):
+                self.stdout.write(f"Created {name}.")
+
+        if options["detach_after_months"] is not None:
+            cutoff = partitioning.add_months(
+                partitioning.month_start(datetime.now(timezone.utc).date()),
+                -options["detach_after_months"],
+            )
+            for name in partitioning.detach_partitions(
+                connection, cutoff, dry_run=options["dry_run"]
+            ):
+                verb = "Would detach" if options["dry_run"] else "Detached"
+                self.stdout.write(f"{verb} {name}.")
+
+        self.stdout.write(self.style.SUCCESS("Partitions are up to date."))
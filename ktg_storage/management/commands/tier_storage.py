@@ -0,0 +1,94 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from typing import List
+
+from django.core.management.base import BaseCommand
+
+from ktg_storage import tiering
+from ktg_storage.access import get_access_tracker
+from ktg_storage.enums import StorageClass
+
+
+class Command(BaseCommand):
+    help = (
+        "Move files that have not been read recently to cheaper storage "
+        "classes (STORAGE_TIERING_RULES), and move tiered files that were "
+        "read again back to STANDARD."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Number of files per batch of S3 copies and UPDATE.",
+        )
+        parser.add_argument(
+            "--workers", type=int, default=8,
+            help="Number of concurrent S3 copy requests.",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Only report how many files would be moved.",
+        )
+        parser.add_argument(
+            "--skip-restore", action="store_true",
+            help="Do not move re-read files back to STANDARD.",
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+
+        get_access_tracker().flush()
+
+        if not options["skip_restore"]:
+            restored = self._apply(
+                tiering.files_to_restore(),
+                tiering.restore,
+                StorageClass.STANDARD,
+            )
+            self.stdout.write(f"Restored {restored} files to STANDARD.")
+
+        for days, storage_class in tiering.get_rules():
+            moved = self._apply(
+                tiering.cold_files(days, storage_class),
+                lambda file: tiering.transition(file, storage_class),
+                storage_class,
+            )
+            self.stdout.write(
+                f"Moved {moved} files not read for {days} days "
+                f"to {storage_class}."
+            )
+
+        self.stdout.write(self.style.SUCCESS("Tiering finished."))
+
+    def _apply(self, queryset, move: Callable, storage_class: str) -> int:
+        if self.options["dry_run"]:
+            return queryset.count()
+
+        batch_size = self.options["batch_size"]
+        # The copies need the ETags, size and expiry tag (tiering.refresh_copy).
+        files = queryset.only(
+            "id", "file", "storage_class", "stored_size", "etag",
+            "thumbnail_source_etag", "expiry_tag",
+        ).iterator(chunk_size=batch_size)
+
+        moved = 0
+        batch: List = []
+
+        with ThreadPoolExecutor(max_workers=self.options["workers"]) as executor:
+            for file in files:
+                batch.append(file)
+
+                if len(batch) >= batch_size:
+                    moved += self._apply_batch(
+                        executor, batch, move, storage_class)
+                    batch = []
+
+            moved += self._apply_batch(executor, batch, move, storage_class)
+
+        return moved
+
+    def _apply_batch(self, executor, batch, move, storage_class) -> int:
+        results = executor.map(move, batch)
+        done = [file.id for file, success in zip(batch, results) if success]
+
+        return tiering.mark_storage_class(done, storage_class)
@@ -0,0 +1,165 @@
+"""
+Media metadata extraction (dimensions, duration, page count).
+
+Extraction reads as little of the object as possible: images are parsed
+from a ranged GET of the file header, videos are probed by ffmpeg straight
+from a presigned URL (it only fetches the container header) and PDFs are
+opened lazily, from the object cache when it is enabled. When the caller
+already holds the content (`source`, e.g. the buffer the thumbnail was made
+from), nothing is downloaded for images and PDFs.
+"""
+import logging
+import mmap
+from io import BytesIO
+from typing import Any
+from typing import Dict
+from typing import Optional
+
+import fitz
+import magic
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+from PIL import Image
+
+from ktg_storage.client import storage_service
+from ktg_storage.instrumentation import stage
+
+# Enough for the header of virtually every image format, including JPEGs
+# with large EXIF blocks before the frame header.
+HEADER_SIZE = 64 * 1024
+
+EXIF_ORIENTATION = 0x0112
+
+MediaMetadata = Dict[str, Any]
+
+
+def open_pdf(source) -> fitz.Document:
+    # PyMuPDF does not read from memory maps, copy them to bytes.
+    if isinstance(source, mmap.mmap):
+        source = source[:]
+
+    return fitz.open(stream=source, filetype="pdf")
+
+
+def _read_header(s3_key: str) -> Optional[bytes]:
+    local_path = storage_service.get_cached_file_path(s3_key)
+    if local_path is not None:
+        with open(local_path, "rb") as f:
+            return f.read(HEADER_SIZE)
+
+    return storage_service.get_file_range(s3_key, 0, HEADER_SIZE - 1)
+
+
+def _image_metadata(
+    s3_key: str, header: bytes, source: Optional[Any] = None
+) -> MediaMetadata:
+    try:
+        # PIL only parses the header on open, pixels are never decoded.
+        img = Image.open(BytesIO(header))
+    except (OSError, SyntaxError):
+        content = (
+            source[:] if source is not None
+            else storage_service.get_file_content(s3_key)
+        )
+        img = Image.open(BytesIO(content))
+
+    metadata = {
+        "width": img.width,
+        "height": img.height,
+        "format": img.format,
+        "mode": img.mode,
+    }
+
+    try:
+        orientation = img.getexif().get(EXIF_ORIENTATION)
+    except Exception:
+        orientation = None
+
+    if orientation:
+        metadata["orientation"] = orientation
+
+    return metadata
+
+
+def _video_metadata(s3_key: str) -> MediaMetadata:
+    source = storage_service.get_cached_file_path(s3_key)
+    if source is None:
+        # ffmpeg reads the container header over HTTP range requests.
+        source = storage_service.create_presigned_url(s3_key)
+
+    infos = ffmpeg_parse_infos(source)
+
+    metadata: MediaMetadata = {"duration": infos.get("duration")}
+
+    if infos.get("video_found"):
+        width, height = infos["video_size"]
+        metadata.update(
+            width=width,
+            height=height,
+            fps=infos.get("video_fps"),
+        )
+
+    metadata["has_audio"] = bool(infos.get("audio_found"))
+
+    return metadata
+
+
+def _pdf_metadata(s3_key: str, source: Optional[Any] = None) -> MediaMetadata:
+    local_path = None
+    if source is None:
+        local_path = storage_service.get_cached_file_path(s3_key)
+
+    if local_path is not None:
+        pdf_file = fitz.open(local_path, filetype="pdf")
+    else:
+        pdf_file = open_pdf(
+            source if source is not None
+            else storage_service.get_file_content(s3_key)
+        )
+
+    with pdf_file:
+        metadata: MediaMetadata = {"page_count": pdf_file.page_count}
+
+        if pdf_file.page_count:
+            # Only the first page object is loaded.
+            rect = pdf_file.load_page(0).rect
+            metadata.update(width=rect.width, height=rect.height)
+
+    return metadata
+
+
+def extract_media_metadata(
+    s3_key: str, source: Optional[Any] = None
+) -> Optional[MediaMetadata]:
+    """
+    `source` is the object content when the caller has it open already
+    (`open_file_buffer`).
+    """
+    try:
+        with stage("metadata"):
+            if source is not None:
+                header = source[:HEADER_SIZE]
+            else:
+                header = _read_header(s3_key)
+            if not header:
+                return None
+
+            mime_type = magic.Magic(mime=True).from_buffer(header)
+
+            if mime_type.startswith("image/"):
+                metadata = _image_metadata(s3_key, header, source)
+            elif mime_type.startswith("video/"):
+                metadata = _video_metadata(s3_key)
+            elif mime_type == "application/pdf":
+                metadata = _pdf_metadata(s3_key, source)
+            else:
+                return None
+
+        metadata["mime_type"] = mime_type
+
+        return metadata
+
+    except Exception as e:
+        message = f"Error extracting metadata from {s3_key}: {str(e)}"
+        logging.error(message, exc_info=True)
+
+        return None
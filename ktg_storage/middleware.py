@@ -0,0 +1,41 @@
+import logging
+
+from django.conf import settings
+
+from ktg_storage.instrumentation import S3CallBudgetExceeded
+from ktg_storage.instrumentation import count_s3_calls
+
+
+class S3CallBudgetMiddleware:
+    """
+    Count the `S3Service` operations made by each request and report
+    requests over `STORAGE_S3_CALL_BUDGET`, e.g. per-row presigned URLs or
+    `Storage.get_size` in a list. Requests over budget are logged, or fail
+    with `S3CallBudgetExceeded` when DEBUG and `STORAGE_S3_CALL_BUDGET_RAISE`
+    are set.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        budget = getattr(settings, "STORAGE_S3_CALL_BUDGET", None)
+        if budget is None:
+            return self.get_response(request)
+
+        with count_s3_calls() as counter:
+            response = self.get_response(request)
+
+        if counter.total > budget:
+            message = (
+                f"{request.method} {request.path} made {counter.total} S3 "
+                f"calls (budget {budget}): {dict(counter.calls)}"
+            )
+            if settings.DEBUG and getattr(
+                settings, "STORAGE_S3_CALL_BUDGET_RAISE", False
+            ):
+                raise S3CallBudgetExceeded(message)
+
+            logging.warning(message)
+
+        return response
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ktg_storage', '0002_storage_file_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storage',
+            name='thumbnail_error',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='storage',
+            name='thumbnail_source_etag',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:17
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('ktg_storage', '0003_storage_thumbnail_error_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storage',
+            name='reserved_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='StorageUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('used_bytes', models.BigIntegerField(default=0)),
+                ('reserved_bytes', models.BigIntegerField(default=0)),
+                ('quota_bytes', models.BigIntegerField(blank=True, help_text='Overrides STORAGE_USER_QUOTA for this user.', null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='storage_usage', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
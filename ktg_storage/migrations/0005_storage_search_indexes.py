@@ -0,0 +1,70 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:18
+
+from django.db import DatabaseError, migrations, models, transaction
+
+TRIGRAM_INDEX = """
+CREATE INDEX IF NOT EXISTS storage_name_trgm_idx ON ktg_storage_storage
+USING gin ((UPPER(original_file_name::text)) gin_trgm_ops)
+"""
+
+FTS_INDEX = """
+CREATE INDEX IF NOT EXISTS storage_name_fts_idx ON ktg_storage_storage
+USING gin (to_tsvector('simple'::regconfig, COALESCE(original_file_name, '')))
+"""
+
+
+def create_name_search_index(apps, schema_editor):
+    """
+    Back filename search with a trigram index on Postgres. When pg_trgm can
+    not be installed (e.g. no superuser), fall back to a full-text index,
+    used with STORAGE_SEARCH_BACKEND = "fts". Other databases fall back to
+    the (uploaded_by, ...) B-tree indexes.
+    """
+    connection = schema_editor.connection
+    if connection.vendor != "postgresql":
+        return
+
+    with connection.cursor() as cursor:
+        try:
+            with transaction.atomic(using=connection.alias):
+                cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                cursor.execute(TRIGRAM_INDEX)
+            return
+        except DatabaseError:
+            pass
+
+        cursor.execute(FTS_INDEX)
+
+
+def drop_name_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("DROP INDEX IF EXISTS storage_name_trgm_idx")
+        cursor.execute("DROP INDEX IF EXISTS storage_name_fts_idx")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ktg_storage', '0004_storage_reserved_size_storageusage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='storage',
+            index=models.Index(fields=['uploaded_by', '-created_at'], name='storage_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='storage',
+            index=models.Index(fields=['uploaded_by', 'file_type', '-created_at'], name='storage_user_type_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='storage',
+            index=models.Index(fields=['uploaded_by', 'expire_at'], name='storage_user_expire_idx'),
+        ),
+        migrations.RunPython(
+            create_name_search_index, drop_name_search_index
+        ),
+    ]
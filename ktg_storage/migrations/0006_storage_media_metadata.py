@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ktg_storage', '0005_storage_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storage',
+            name='media_metadata',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
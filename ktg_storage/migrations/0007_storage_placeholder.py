@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ktg_storage', '0006_storage_media_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storage',
+            name='placeholder',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
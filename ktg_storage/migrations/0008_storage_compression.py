@@ -0,0 +1,23 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ktg_storage', '0007_storage_placeholder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storage',
+            name='content_encoding',
+            field=models.CharField(blank=True, max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='storage',
+            name='stored_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ktg_storage', '0008_storage_compression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storage',
+            name='last_accessed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='storage',
+            name='storage_class',
+            field=models.CharField(default='STANDARD', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='storage',
+            name='storage_class_changed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='storage',
+            index=models.Index(fields=['storage_class', 'last_accessed_at'], name='storage_class_accessed_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ktg_storage', '0009_storage_access_tiering'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='storage',
+            index=models.Index(fields=['-created_at', '-id'], name='storage_created_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.5 on 2026-10-19 02:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ktg_storage', '0010_storage_created_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storage',
+            name='expiry_tag',
+            field=models.CharField(blank=True, max_length=16, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='storage',
+            index=models.Index(condition=models.Q(('expiry_tag__isnull', False), ('is_deleted', False)), fields=['expire_at'], name='storage_lifecycle_expire_idx'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations
+
+from ktg_storage import partitioning
+
+
+def partition_storage_table(apps, schema_editor):
+    """
+    Convert ktg_storage_storage to a table partitioned by created_at when
+    STORAGE_PARTITIONING is enabled (Postgres only). Rows are copied in
+    batches while the table stays in use; enabling the setting later is
+    done with `storage_partitions --convert`.
+    """
+    connection = schema_editor.connection
+    if connection.vendor != "postgresql" or not partitioning.partitioning_enabled():
+        return
+
+    partitioning.convert_table(connection)
+
+
+class Migration(migrations.Migration):
+    # The rows are copied in one transaction per batch.
+    atomic = False
+
+    dependencies = [
+        ('ktg_storage', '0011_storage_lifecycle_expiry'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            partition_storage_table, migrations.RunPython.noop
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-19 03:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ktg_storage', '0013_storage_etag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storage',
+            name='upload_etag',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
@@ -1,12 +1,44 @@
+from ktg_storage.enums import StorageClass
 from ktg_storage.utils import file_generate_upload_path
+from ktg_storage.utils import reshard_key
 from django.db import models
+from django.db import transaction
 from django.utils import timezone
+import re
 import uuid
-from ktg_storage.client import s3_service
+from ktg_storage.client import storage_service
+from datetime import datetime
+from datetime import timedelta
+from typing import Any
+from typing import Dict
 from typing import Optional
+from typing import Tuple
 from django.conf import settings
 
 
+def _full_text_search(files, query: str):
+    """
+    Word-prefix search backed by the `storage_name_fts_idx` GIN index, for
+    Postgres databases where pg_trgm is not available.
+    """
+    from django.contrib.postgres.search import SearchQuery
+    from django.contrib.postgres.search import SearchVector
+
+    terms = [term for term in re.split(r"\W+", query.lower()) if term]
+    if not terms:
+        return files
+
+    search_query = SearchQuery(
+        " & ".join(f"{term}:*" for term in terms),
+        config="simple",
+        search_type="raw",
+    )
+
+    return files.annotate(
+        name_vector=SearchVector("original_file_name", config="simple")
+    ).filter(name_vector=search_query)
+
+
 class FileManger(models.Manager):
     def get_queryset(self):
         return (
@@ -22,28 +54,103 @@ class FileManger(models.Manager):
             uploaded_by=user, upload_finished_at__isnull=False
         )
 
-    def get_files_that_expire_today(self):
+    def resolve_key(self, key: str) -> str:
+        """
+        Map an object key a client may still hold (from before the keys were
+        sharded, or re-sharded) to the current key of the same file.
+        """
+        candidates = {key, reshard_key(key), reshard_key(key, 0)}
+        if candidates == {key}:
+            return key
+
+        current = (
+            self.get_queryset()
+            .filter(file_name__in=candidates)
+            .values_list("file_name", flat=True)
+            .first()
+        )
+
+        return current or key
+
+    def search_user_files(
+        self,
+        user,
+        query: str = "",
+        match: str = "contains",
+        file_type: str = "",
+        created_after=None,
+        created_before=None,
+        expire_after=None,
+        expire_before=None,
+    ) -> models.QuerySet["Storage"]:
+        files = self.get_user_files(user)
+
+        if query:
+            if match == "prefix":
+                files = files.filter(original_file_name__istartswith=query)
+            elif getattr(settings, "STORAGE_SEARCH_BACKEND", "trigram") == "fts":
+                files = _full_text_search(files, query)
+            else:
+                files = files.filter(original_file_name__icontains=query)
+
+        if file_type:
+            # "image/" matches every image type.
+            if file_type.endswith("/"):
+                files = files.filter(file_type__startswith=file_type)
+            else:
+                files = files.filter(file_type=file_type)
+
+        if created_after:
+            files = files.filter(created_at__gte=created_after)
+        if created_before:
+            files = files.filter(created_at__lt=created_before)
+        if expire_after:
+            files = files.filter(expire_at__gte=expire_after)
+        if expire_before:
+            files = files.filter(expire_at__lt=expire_before)
+
+        return files
+
+    def _today(self) -> Tuple[datetime, datetime]:
         start_of_day = timezone.now().replace(
             hour=0, minute=0, second=0, microsecond=0
         )
-        end_date_of_day = timezone.now().replace(
-            hour=23, minute=59, second=59, microsecond=999999
-        )
+
+        return start_of_day, start_of_day + timedelta(days=1)
+
+    def _created_window(self, start: datetime, end: datetime) -> Dict[str, Any]:
+        """
+        created_at bounds of files that can have a date (expire_at, reminder)
+        in [start, end): created before `end`, and at most
+        STORAGE_MAX_RETENTION_DAYS earlier when set. They let Postgres skip
+        the created_at partitions that can not match.
+        """
+        window: Dict[str, Any] = {"created_at__lt": end}
+
+        days = getattr(settings, "STORAGE_MAX_RETENTION_DAYS", None)
+        if days is not None:
+            window["created_at__gte"] = start - timedelta(days=days)
+
+        return window
+
+    def get_files_that_expire_today(self):
+        start_of_day, end_of_day = self._today()
+
         return self.get_queryset().filter(
-            expire_at__range=[start_of_day, end_date_of_day]
+            expire_at__gte=start_of_day,
+            expire_at__lt=end_of_day,
+            **self._created_window(start_of_day, end_of_day),
         )
 
     def get_files_that_need_to_remind_today(
         self,
     ) -> models.QuerySet["Storage"]:
-        start_of_day = timezone.now().replace(
-            hour=0, minute=0, second=0, microsecond=0
-        )
-        end_date_of_day = timezone.now().replace(
-            hour=23, minute=59, second=59, microsecond=999999
-        )
+        start_of_day, end_of_day = self._today()
+
         return self.get_queryset().filter(
-            reminder__range=[start_of_day, end_date_of_day]
+            reminder__gte=start_of_day,
+            reminder__lt=end_of_day,
+            **self._created_window(start_of_day, end_of_day),
         )
 
 
@@ -57,6 +164,11 @@ class Storage(models.Model):
         upload_to=file_generate_upload_path, blank=True, null=True,
     )
     thumbnail = models.URLField(blank=True, null=True)
+    thumbnail_source_etag = models.CharField(
+        max_length=255, blank=True, null=True)
+    thumbnail_error = models.TextField(blank=True, null=True)
+    # Tiny base64 JPEG data URI, rendered blurred while the thumbnail loads.
+    placeholder = models.TextField(blank=True, null=True)
 
     original_file_name = models.TextField()
 
@@ -68,6 +180,51 @@ class Storage(models.Model):
     expire_at = models.DateTimeField(blank=True, null=True)
     reminder = models.DateTimeField(blank=True, null=True)
     file_size = models.IntegerField(null=True, blank=True)
+    # Size in the bucket, smaller than file_size when content_encoding is set.
+    stored_size = models.BigIntegerField(null=True, blank=True)
+    # ETag of the stored object, as returned by HEAD.
+    etag = models.CharField(max_length=64, null=True, blank=True)
+    # ETag of the object as uploaded, before compression rewrote it.
+    upload_etag = models.CharField(max_length=64, null=True, blank=True)
+    content_encoding = models.CharField(max_length=16, null=True, blank=True)
+    reserved_size = models.BigIntegerField(null=True, blank=True)
+    media_metadata = models.JSONField(null=True, blank=True)
+    # Written in batches by ktg_storage.access, accurate to the flush interval.
+    last_accessed_at = models.DateTimeField(null=True, blank=True)
+    storage_class = models.CharField(
+        max_length=32, default=StorageClass.STANDARD)
+    storage_class_changed_at = models.DateTimeField(null=True, blank=True)
+    # Lifecycle expiry bucket the object is tagged with (ktg_storage.expiry).
+    expiry_tag = models.CharField(max_length=16, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["uploaded_by", "-created_at"],
+                name="storage_user_created_idx",
+            ),
+            models.Index(
+                fields=["uploaded_by", "file_type", "-created_at"],
+                name="storage_user_type_created_idx",
+            ),
+            models.Index(
+                fields=["uploaded_by", "expire_at"],
+                name="storage_user_expire_idx",
+            ),
+            models.Index(
+                fields=["-created_at", "-id"],
+                name="storage_created_idx",
+            ),
+            models.Index(
+                fields=["storage_class", "last_accessed_at"],
+                name="storage_class_accessed_idx",
+            ),
+            models.Index(
+                fields=["expire_at"],
+                name="storage_lifecycle_expire_idx",
+                condition=models.Q(expiry_tag__isnull=False, is_deleted=False),
+            ),
+        ]
 
     @property
     def is_valid(self):
@@ -78,30 +235,56 @@ class Storage(models.Model):
 
     @property
     def get_size(self) -> Optional[int]:
-        return s3_service.get_file_size(self.file_name)
+        return storage_service.get_file_size(self.file_name)
 
     @property
     def generate_presigned_url(self, expires: bool = True) -> Optional[str]:
-        return s3_service.create_presigned_url(self.file_name, expires)
+        return storage_service.create_presigned_url(self.file_name, expires)
 
     def delete_file(self) -> bool:
-        result = s3_service.delete_file(self.file_name)
+        from ktg_storage import quota
+
+        result = storage_service.delete_file(self.file_name)
 
         if result:
-            self.file = None
-            self.thumbnail = None
-            self.save()
+            with transaction.atomic():
+                if self.file and self.upload_finished_at and not self.is_deleted:
+                    quota.release(self.uploaded_by, self.file_size or 0)
+
+                self.file = None
+                self.thumbnail = None
+                self.placeholder = None
+                self.save()
 
         return result
 
     @property
     def file_exists(self) -> bool:
-        return s3_service.file_exists(self.file_name)
+        return storage_service.file_exists(self.file_name)
 
     @property
     def file_url(self):
-        return s3_service.get_file_url(self.file_name)
+        return storage_service.get_file_url(self.file_name)
 
     @property
     def file_path(self) -> str:
-        return s3_service.get_file_path(self.file_name)
+        return storage_service.get_file_path(self.file_name)
+
+
+class StorageUsage(models.Model):
+    """
+    Per-user storage accounting, maintained incrementally so quota checks
+    never have to aggregate over `Storage`.
+    """
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="storage_usage",
+    )
+    used_bytes = models.BigIntegerField(default=0)
+    reserved_bytes = models.BigIntegerField(default=0)
+    quota_bytes = models.BigIntegerField(
+        null=True, blank=True,
+        help_text="Overrides STORAGE_USER_QUOTA for this user.",
+    )
+    updated_at = models.DateTimeField(auto_now=True)
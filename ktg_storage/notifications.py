@@ -0,0 +1,194 @@
+"""
+Upload completion driven by S3 `ObjectCreated` notifications.
+
+Clients that upload directly to S3 and never call the finish endpoint leave
+their rows unfinished. With the bucket sending `s3:ObjectCreated:*` events
+for the `files/` prefix to an SQS queue (directly or through SNS), the
+`consume_upload_events` command finishes those uploads from the events,
+using the size and ETag they carry instead of a HEAD request. `finish` is
+idempotent, so the client's own finish call and the event can both arrive.
+
+Only uploads finish files. `ObjectCreated:Copy` events are ignored: tiering
+and key sharding copy objects in place, and a multipart copy gets a new
+ETag, which would otherwise finish the file again and reset its storage
+class, encoding, size and thumbnail. Multipart copies complete with a
+`CompleteMultipartUpload` event instead; tiering and key sharding store the
+new ETag of those copies, so the event finds the file finished.
+
+`LocalQueue` has the interface of `SQSQueue` and keeps messages in memory,
+for tests and local development.
+"""
+import collections
+import itertools
+import json
+import logging
+from typing import Any
+from typing import Deque
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from urllib.parse import unquote_plus
+
+import boto3
+from django.conf import settings
+
+from ktg_storage.models import Storage
+from ktg_storage.services import FileDirectUploadService
+
+# SQS returns at most 10 messages per receive and deletes 10 per batch.
+MAX_MESSAGES = 10
+
+UPLOAD_EVENTS = frozenset({
+    "ObjectCreated:Put",
+    "ObjectCreated:Post",
+    "ObjectCreated:CompleteMultipartUpload",
+})
+
+
+class QueueMessage(NamedTuple):
+    receipt: str
+    body: str
+
+
+class ObjectCreated(NamedTuple):
+    key: str
+    size: int
+    etag: str
+
+
+class SQSQueue:
+    def __init__(self, queue_url: str, client=None):
+        self.queue_url = queue_url
+        self.client = client or boto3.client(
+            service_name="sqs",
+            aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
+            region_name=settings.AWS_S3_REGION_NAME,
+        )
+
+    def receive(
+        self, max_messages: int = MAX_MESSAGES, wait_seconds: int = 20
+    ) -> List[QueueMessage]:
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, MAX_MESSAGES),
+            WaitTimeSeconds=wait_seconds,
+        )
+
+        return [
+            QueueMessage(message["ReceiptHandle"], message["Body"])
+            for message in response.get("Messages", [])
+        ]
+
+    def delete(self, receipts: List[str]) -> None:
+        for start in range(0, len(receipts), MAX_MESSAGES):
+            batch = receipts[start:start + MAX_MESSAGES]
+            response = self.client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {"Id": str(index), "ReceiptHandle": receipt}
+                    for index, receipt in enumerate(batch)
+                ],
+            )
+            for failure in response.get("Failed", []):
+                logging.error(f"Failed to delete upload event: {failure}")
+
+
+class LocalQueue:
+    def __init__(self):
+        self.messages: Deque[QueueMessage] = collections.deque()
+        self.in_flight: Dict[str, QueueMessage] = {}
+        self._receipts = itertools.count()
+
+    def send(self, body: str) -> None:
+        self.messages.append(QueueMessage(str(next(self._receipts)), body))
+
+    def receive(
+        self, max_messages: int = MAX_MESSAGES, wait_seconds: int = 0
+    ) -> List[QueueMessage]:
+        received = []
+        while self.messages and len(received) < max_messages:
+            message = self.messages.popleft()
+            self.in_flight[message.receipt] = message
+            received.append(message)
+
+        return received
+
+    def delete(self, receipts: List[str]) -> None:
+        for receipt in receipts:
+            self.in_flight.pop(receipt, None)
+
+    def release(self) -> None:
+        """
+        Make undeleted messages visible again, like an expired SQS
+        visibility timeout.
+        """
+        self.messages.extend(self.in_flight.values())
+        self.in_flight.clear()
+
+
+def parse_events(body: str) -> List[ObjectCreated]:
+    """
+    Upload records of an S3 event notification, delivered directly or
+    wrapped in an SNS notification. Copies and test events yield nothing.
+    """
+    payload: Dict[str, Any] = json.loads(body)
+    if payload.get("Type") == "Notification":
+        payload = json.loads(payload["Message"])
+
+    events = []
+    for record in payload.get("Records", []):
+        if record.get("eventName") not in UPLOAD_EVENTS:
+            continue
+
+        s3_object = record["s3"]["object"]
+        events.append(ObjectCreated(
+            # Keys are URL-encoded in event notifications.
+            key=unquote_plus(s3_object["key"]),
+            size=s3_object.get("size", 0),
+            etag=s3_object.get("eTag", ""),
+        ))
+
+    return events
+
+
+def finish_uploads(events: Iterable[ObjectCreated]) -> int:
+    """
+    Finish the uploads of `events` with one query for the whole batch.
+    Returns the number of files that were finished.
+    """
+    # A key written twice in the batch only counts with its last version.
+    events_by_key = {event.key: event for event in events}
+    files = Storage.objects.filter(file__in=list(events_by_key)).select_related(
+        "uploaded_by")
+
+    finished = 0
+    for file in files:
+        event = events_by_key[file.file.name]
+        result = FileDirectUploadService(file.uploaded_by).finish(
+            file=file, metadata={"Size": event.size, "ETag": event.etag})
+        if result.upload_finished_at != file.upload_finished_at:
+            finished += 1
+
+    return finished
+
+
+def handle_messages(queue, messages: List[QueueMessage]) -> int:
+    """
+    Finish the uploads of a batch of messages and delete the messages. A
+    message that can not be processed stays on the queue to be retried.
+    """
+    processed = []
+    events = []
+    for message in messages:
+        try:
+            events.extend(parse_events(message.body))
+            processed.append(message.receipt)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error(f"Invalid upload event {message.receipt}: {e}")
+
+    finished = finish_uploads(events)
+    queue.delete(processed)
+
+    return finished
@@ -0,0 +1,406 @@
+"""
+Optional Postgres range partitioning of `ktg_storage_storage` on created_at.
+
+`convert_table` turns the regular table into a partitioned one online:
+
+1. a partitioned copy is created with monthly partitions (plus a DEFAULT
+   partition, so an insert never fails for lack of a partition), the
+   indexes and foreign keys of the original table,
+2. a trigger mirrors every write on the original table into the copy,
+3. existing rows are copied in batches, each in its own transaction,
+4. the tables are swapped in one short transaction.
+
+Partitioned tables can only enforce unique constraints that include the
+partition key, so the primary key becomes (id, created_at) and file_name is
+unique per created_at instead of globally (names are generated with a UUID).
+Tables in other apps can not keep foreign keys to Storage, the conversion
+refuses to start while any exist.
+
+Partitions are named `<table>_pYYYY_MM`. `storage_partitions` pre-creates
+future partitions and detaches old ones.
+"""
+import logging
+import re
+from datetime import date
+from datetime import datetime
+from datetime import timezone
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+
+TABLE = "ktg_storage_storage"
+
+# Suffix of the partitioned copy and its indexes while it is being filled.
+SHADOW_SUFFIX = "_part"
+
+MAX_NAME_LENGTH = 63
+
+
+def partitioning_enabled() -> bool:
+    return getattr(settings, "STORAGE_PARTITIONING", False)
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def add_months(day: date, months: int) -> date:
+    month = day.month - 1 + months
+    return day.replace(year=day.year + month // 12, month=month % 12 + 1, day=1)
+
+
+def partition_name(table: str, start: date) -> str:
+    return f"{table}_p{start.year:04d}_{start.month:02d}"
+
+
+def _bound(day: date) -> str:
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc).isoformat()
+
+
+def is_partitioned(connection, table: str = TABLE) -> bool:
+    if connection.vendor != "postgresql":
+        return False
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass",
+            [table],
+        )
+        return cursor.fetchone() is not None
+
+
+def list_partitions(connection, table: str = TABLE) -> List[Tuple[str, Optional[str]]]:
+    """
+    (name, bound expression) of the attached partitions, oldest first.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+            FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = %s::regclass
+            ORDER BY child.relname
+            """,
+            [table],
+        )
+        return cursor.fetchall()
+
+
+def create_partition(connection, table: str, start: date) -> bool:
+    """
+    Create the monthly partition starting at `start`. Returns False when it
+    already exists.
+    """
+    name = partition_name(table, start)
+    quote = connection.ops.quote_name
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s)", [name])
+        if cursor.fetchone()[0] is not None:
+            return False
+
+        cursor.execute(
+            f"CREATE TABLE {quote(name)} PARTITION OF {quote(table)} "
+            f"FOR VALUES FROM ('{_bound(start)}') "
+            f"TO ('{_bound(add_months(start, 1))}')"
+        )
+
+    return True
+
+
+def ensure_partitions(
+    connection, months_ahead: int, table: str = TABLE, today: Optional[date] = None
+) -> List[str]:
+    """
+    Create the partitions of the current month and `months_ahead` months.
+    """
+    start = month_start(today or datetime.now(timezone.utc).date())
+    created = []
+
+    for offset in range(months_ahead + 1):
+        month = add_months(start, offset)
+        with transaction.atomic(using=connection.alias):
+            if create_partition(connection, table, month):
+                created.append(partition_name(table, month))
+
+    return created
+
+
+def detach_partitions(
+    connection, before: date, table: str = TABLE, dry_run: bool = False
+) -> List[str]:
+    """
+    Detach monthly partitions that end on or before `before`. Their rows
+    leave the table (and the app) but are kept as standalone tables.
+    """
+    quote = connection.ops.quote_name
+    detached = []
+
+    for name, _ in list_partitions(connection, table):
+        if not name.startswith(f"{table}_p"):
+            continue
+
+        try:
+            year, month = map(int, name[len(table) + 2:].split("_"))
+        except ValueError:
+            continue
+
+        if add_months(date(year, month, 1), 1) > before:
+            continue
+
+        if not dry_run:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"ALTER TABLE {quote(table)} DETACH PARTITION {quote(name)}")
+        detached.append(name)
+
+    return detached
+
+
+def _shadow_name(name: str) -> str:
+    return name[:MAX_NAME_LENGTH - len(SHADOW_SUFFIX)] + SHADOW_SUFFIX
+
+
+def _index_names(cursor, table: str) -> List[str]:
+    """
+    Indexes of `table` other than the primary key and unique constraints,
+    which can not be carried over to a partitioned table as they are.
+    """
+    cursor.execute(
+        """
+        SELECT index.relname
+        FROM pg_index
+        JOIN pg_class index ON index.oid = pg_index.indexrelid
+        WHERE pg_index.indrelid = %s::regclass
+          AND NOT pg_index.indisprimary AND NOT pg_index.indisunique
+        """,
+        [table],
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _referencing_constraints(cursor, table: str) -> List[str]:
+    cursor.execute(
+        """
+        SELECT conrelid::regclass::text || '.' || conname
+        FROM pg_constraint
+        WHERE contype = 'f' AND confrelid = %s::regclass
+        """,
+        [table],
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def _create_shadow(connection, table: str, shadow: str, months_ahead: int) -> None:
+    quote = connection.ops.quote_name
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TABLE {quote(shadow)} (LIKE {quote(table)} "
+            f"INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+            f"PARTITION BY RANGE (created_at)"
+        )
+        cursor.execute(
+            f"ALTER TABLE {quote(shadow)} ADD CONSTRAINT "
+            f"{quote(shadow + '_pkey')} PRIMARY KEY (id, created_at)"
+        )
+        cursor.execute(
+            f"ALTER TABLE {quote(shadow)} ADD CONSTRAINT "
+            f"{quote(shadow + '_file_name_key')} UNIQUE (file_name, created_at)"
+        )
+
+        # Foreign keys (uploaded_by) are not copied by LIKE. Their names
+        # only have to be unique per table, they are kept as they are.
+        cursor.execute(
+            """
+            SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+            WHERE contype = 'f' AND conrelid = %s::regclass
+            """,
+            [table],
+        )
+        for name, definition in cursor.fetchall():
+            cursor.execute(
+                f"ALTER TABLE {quote(shadow)} ADD CONSTRAINT "
+                f"{quote(name)} {definition}"
+            )
+
+        # Every other index, created on the parent so partitions inherit it.
+        for name in _index_names(cursor, table):
+            cursor.execute("SELECT pg_get_indexdef(%s::regclass)", [name])
+            definition = cursor.fetchone()[0]
+            definition = definition.replace(
+                f"INDEX {name} ON", f"INDEX {_shadow_name(name)} ON", 1)
+            definition = re.sub(
+                rf" ON (ONLY )?((?:\S+\.)?){table} ",
+                rf" ON \2{shadow} ",
+                definition,
+                count=1,
+            )
+            cursor.execute(definition)
+
+        cursor.execute(f"SELECT min(created_at) FROM {quote(table)}")
+        oldest = cursor.fetchone()[0]
+
+    today = datetime.now(timezone.utc).date()
+    start = month_start(oldest.date() if oldest else today)
+    months = (today.year - start.year) * 12 + today.month - start.month
+
+    for offset in range(months + months_ahead + 1):
+        create_partition(connection, shadow, add_months(start, offset))
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE TABLE {quote(shadow + '_default')} "
+            f"PARTITION OF {quote(shadow)} DEFAULT"
+        )
+
+
+def _install_sync_trigger(connection, table: str, shadow: str) -> None:
+    quote = connection.ops.quote_name
+    function = quote(f"{shadow}_sync")
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            CREATE FUNCTION {function}() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                    DELETE FROM {quote(shadow)}
+                    WHERE id = OLD.id AND created_at = OLD.created_at;
+                END IF;
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    INSERT INTO {quote(shadow)} SELECT (NEW).*
+                    ON CONFLICT DO NOTHING;
+                END IF;
+                RETURN NULL;
+            END
+            $$ LANGUAGE plpgsql
+            """
+        )
+        cursor.execute(
+            f"CREATE TRIGGER {quote(shadow + '_sync')} "
+            f"AFTER INSERT OR UPDATE OR DELETE ON {quote(table)} "
+            f"FOR EACH ROW EXECUTE FUNCTION {function}()"
+        )
+
+
+def _copy_rows(connection, table: str, shadow: str, batch_size: int) -> int:
+    """
+    Copy rows in primary key order, one transaction per batch. The batch is
+    locked FOR SHARE, so a concurrent write waits for the copy and its
+    trigger then replaces the copied row; rows the trigger already wrote are
+    newer and are kept.
+    """
+    quote = connection.ops.quote_name
+    copied = 0
+    last_id = None
+
+    while True:
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"""
+                    WITH batch AS (
+                        SELECT * FROM {quote(table)}
+                        WHERE %s::uuid IS NULL OR id > %s::uuid
+                        ORDER BY id LIMIT %s
+                        FOR SHARE
+                    ), copied AS (
+                        INSERT INTO {quote(shadow)} SELECT * FROM batch
+                        ON CONFLICT DO NOTHING
+                    )
+                    SELECT id, (SELECT count(*) FROM batch) FROM batch
+                    ORDER BY id DESC LIMIT 1
+                    """,
+                    [last_id, last_id, batch_size],
+                )
+                row = cursor.fetchone()
+
+        if row is None:
+            return copied
+
+        last_id, count = row
+        copied += count
+        logging.info("Copied %s rows into %s", copied, shadow)
+
+
+def _swap(connection, table: str, shadow: str) -> None:
+    quote = connection.ops.quote_name
+
+    with transaction.atomic(using=connection.alias):
+        with connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {quote(table)} IN ACCESS EXCLUSIVE MODE")
+            index_names = _index_names(cursor, table)
+
+            cursor.execute(
+                f"DROP TRIGGER {quote(shadow + '_sync')} ON {quote(table)}")
+            cursor.execute(f"DROP FUNCTION {quote(shadow + '_sync')}()")
+            cursor.execute(f"DROP TABLE {quote(table)}")
+            cursor.execute(
+                f"ALTER TABLE {quote(shadow)} RENAME TO {quote(table)}")
+
+            # The original index names are free again, later migrations
+            # refer to indexes by name.
+            for name in index_names:
+                cursor.execute(
+                    f"ALTER INDEX {quote(_shadow_name(name))} "
+                    f"RENAME TO {quote(name)}"
+                )
+            for constraint in ("pkey", "file_name_key"):
+                cursor.execute(
+                    f"ALTER TABLE {quote(table)} RENAME CONSTRAINT "
+                    f"{quote(f'{shadow}_{constraint}')} "
+                    f"TO {quote(f'{table}_{constraint}')}"
+                )
+
+            for name, _ in list_partitions(connection, table):
+                cursor.execute(
+                    f"ALTER TABLE {quote(name)} RENAME TO "
+                    f"{quote(table + name[len(shadow):])}"
+                )
+
+
+def convert_table(
+    connection, table: str = TABLE, batch_size: int = 5000, months_ahead: int = 3
+) -> bool:
+    """
+    Convert `table` to a table partitioned by month of created_at, while it
+    stays readable and writable. Must run outside a transaction. Returns
+    False when there is nothing to do.
+    """
+    if connection.vendor != "postgresql":
+        raise ImproperlyConfigured("Storage partitioning requires Postgres.")
+
+    if connection.in_atomic_block:
+        raise ImproperlyConfigured(
+            "convert_table copies rows in batches and can not run inside a "
+            "transaction."
+        )
+
+    if is_partitioned(connection, table):
+        return False
+
+    shadow = table + SHADOW_SUFFIX
+
+    with transaction.atomic(using=connection.alias):
+        with connection.cursor() as cursor:
+            references = _referencing_constraints(cursor, table)
+        if references:
+            raise ImproperlyConfigured(
+                "Foreign keys to {} prevent partitioning: {}".format(
+                    table, ", ".join(references))
+            )
+
+        _create_shadow(connection, table, shadow, months_ahead)
+        _install_sync_trigger(connection, table, shadow)
+
+    copied = _copy_rows(connection, table, shadow, batch_size)
+    _swap(connection, table, shadow)
+    logging.info("Partitioned %s, %s rows copied", table, copied)
+
+    return True
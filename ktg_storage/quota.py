@@ -0,0 +1,126 @@
+"""
+Per-user storage quota.
+
+Usage is kept on `StorageUsage` rows and changed with single conditional
+UPDATEs (F-expressions), inside the transaction of the operation that
+changes it, so no request ever has to aggregate over `Storage`:
+
+- `reserve` when a direct upload starts (against the declared size),
+- `commit` when it finishes (reservation becomes actual usage),
+- `charge` for standard uploads whose size is known up front,
+- `release` on soft-delete and purge,
+- `cancel` when an unfinished upload is deleted (drops its reservation).
+
+Quota accounting is disabled unless `STORAGE_USER_QUOTA` is set. Drift is
+fixed by the `reconcile_storage_usage` management command.
+"""
+from typing import Optional
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import BigIntegerField
+from django.db.models import F
+from django.db.models import Sum
+from django.db.models import Value
+from django.db.models.functions import Coalesce
+from django.db.models.functions import Greatest
+
+from ktg_storage.models import Storage
+from ktg_storage.models import StorageUsage
+from ktg_storage.utils import bytes_to_mib
+
+
+def quota_enabled() -> bool:
+    return getattr(settings, "STORAGE_USER_QUOTA", None) is not None
+
+
+def _is_tracked(user) -> bool:
+    return (
+        quota_enabled()
+        and user is not None
+        and getattr(user, "is_authenticated", False)
+    )
+
+
+def calculate_used_bytes(user_id) -> int:
+    return (
+        Storage.objects.filter(
+            uploaded_by_id=user_id, upload_finished_at__isnull=False
+        )
+        .exclude(file="")
+        .aggregate(total=Sum("file_size"))["total"]
+        or 0
+    )
+
+
+def get_usage(user) -> StorageUsage:
+    # The aggregate only runs once per user, when the row is created.
+    usage, _ = StorageUsage.objects.get_or_create(
+        user=user,
+        defaults={"used_bytes": lambda: calculate_used_bytes(user.pk)},
+    )
+
+    return usage
+
+
+def _limit():
+    return Coalesce(
+        F("quota_bytes"),
+        Value(settings.STORAGE_USER_QUOTA, output_field=BigIntegerField()),
+    )
+
+
+def _add_within_quota(user, field: str, size: int) -> None:
+    usage = get_usage(user)
+
+    updated = (
+        StorageUsage.objects.filter(pk=usage.pk)
+        .filter(used_bytes__lte=_limit() - F("reserved_bytes") - size)
+        .update(**{field: F(field) + size})
+    )
+
+    if not updated:
+        usage.refresh_from_db()
+        limit = (
+            usage.quota_bytes
+            if usage.quota_bytes is not None
+            else settings.STORAGE_USER_QUOTA
+        )
+        message = "Storage quota exceeded. The limit is {} MiB".format(
+            bytes_to_mib(limit))
+        raise ValidationError(message)
+
+
+def reserve(user, size: int) -> None:
+    if _is_tracked(user) and size:
+        _add_within_quota(user, "reserved_bytes", size)
+
+
+def charge(user, size: int) -> None:
+    if _is_tracked(user) and size:
+        _add_within_quota(user, "used_bytes", size)
+
+
+def commit(user, reserved: Optional[int], size: int) -> None:
+    if not _is_tracked(user):
+        return
+
+    usage = get_usage(user)
+    StorageUsage.objects.filter(pk=usage.pk).update(
+        reserved_bytes=Greatest(F("reserved_bytes") - (reserved or 0), 0),
+        used_bytes=Greatest(F("used_bytes") + size, 0),
+    )
+
+
+def cancel(user, reserved: Optional[int]) -> None:
+    if _is_tracked(user) and reserved:
+        StorageUsage.objects.filter(user=user).update(
+            reserved_bytes=Greatest(F("reserved_bytes") - reserved, 0),
+        )
+
+
+def release(user, size: int) -> None:
+    if _is_tracked(user) and size:
+        StorageUsage.objects.filter(user=user).update(
+            used_bytes=Greatest(F("used_bytes") - size, 0),
+        )
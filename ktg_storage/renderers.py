@@ -0,0 +1,46 @@
+"""
+JSON renderer backed by `orjson` (optional dependency).
+
+Enable it for the whole API or per view:
+
+    REST_FRAMEWORK = {
+        "DEFAULT_RENDERER_CLASSES": [
+            "ktg_storage.renderers.ORJSONRenderer",
+            "rest_framework.renderers.BrowsableAPIRenderer",
+        ],
+    }
+
+The output is compact JSON, like `JSONRenderer` with COMPACT_JSON, but
+encoding a 1,000 row file listing takes a fraction of the time.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+
+class ORJSONRenderer(BaseRenderer):
+    media_type = "application/json"
+    format = "json"
+    charset = None
+
+    def __init__(self):
+        if orjson is None:
+            raise ImproperlyConfigured(
+                "orjson is required for ktg_storage.renderers.ORJSONRenderer."
+            )
+
+        # Lazy translations, Decimal and the other types orjson does not
+        # know are encoded the same way as by DRF.
+        self._default = JSONEncoder().default
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+
+        return orjson.dumps(
+            data, default=self._default, option=orjson.OPT_NON_STR_KEYS)
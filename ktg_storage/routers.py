@@ -0,0 +1,111 @@
+"""
+Read-replica routing for the read-only storage endpoints.
+
+Views using `ReplicaReadMixin` (ktg_storage.views) run the ktg_storage
+queries of GET requests on one of `STORAGE_READ_REPLICAS`, through
+`StorageReplicaRouter`:
+
+    DATABASE_ROUTERS = ["ktg_storage.routers.StorageReplicaRouter"]
+    STORAGE_READ_REPLICAS = ["replica"]
+
+Everything else (writes, other apps, code outside those views) keeps using
+the default database. A user whose write (upload finish, update, delete)
+went through one of the views reads from the primary for
+`STORAGE_STICKY_PRIMARY_SECONDS` afterwards, so replication lag never hides
+their own changes. The window is kept in the Django cache, which must be
+shared between processes for it to hold across workers.
+"""
+import contextvars
+import random
+from contextlib import contextmanager
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+APP_LABEL = "ktg_storage"
+
+_read_database: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar(
+    "ktg_storage_read_database", default=None)
+
+
+def get_replicas() -> List[str]:
+    return list(getattr(settings, "STORAGE_READ_REPLICAS", []))
+
+
+def _sticky_key(user) -> str:
+    return f"ktg_storage:primary:{user.pk}"
+
+
+def mark_recent_write(user) -> None:
+    """
+    Send the user's reads to the primary for the sticky window.
+    """
+    seconds = getattr(settings, "STORAGE_STICKY_PRIMARY_SECONDS", 10)
+    if get_replicas() and seconds and getattr(user, "is_authenticated", False):
+        cache.set(_sticky_key(user), True, seconds)
+
+
+def reads_from_primary(user) -> bool:
+    return (
+        getattr(user, "is_authenticated", False)
+        and cache.get(_sticky_key(user)) is not None
+    )
+
+
+def use_replica(user) -> contextvars.Token:
+    """
+    Route ktg_storage reads of the current context to a replica, unless the
+    user is in their sticky-primary window. Undo with `reset_replica`.
+    """
+    replicas = get_replicas()
+    database = None
+    if replicas and not reads_from_primary(user):
+        database = random.choice(replicas)
+
+    return _read_database.set(database)
+
+
+def reset_replica(token: contextvars.Token) -> None:
+    _read_database.reset(token)
+
+
+@contextmanager
+def read_replica(user) -> Iterator[Optional[str]]:
+    token = use_replica(user)
+    try:
+        yield _read_database.get()
+    finally:
+        reset_replica(token)
+
+
+class StorageReplicaRouter:
+    def db_for_read(self, model, **hints) -> Optional[str]:
+        if model._meta.app_label == APP_LABEL:
+            return _read_database.get()
+
+        return None
+
+    def db_for_write(self, model, **hints) -> Optional[str]:
+        # Objects loaded from a replica are saved to the primary.
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db in get_replicas():
+            return "default"
+
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints) -> Optional[bool]:
+        # Replicas hold the same data as the primary.
+        databases = {"default", *get_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints) -> Optional[bool]:
+        if db in get_replicas():
+            return False
+
+        return None
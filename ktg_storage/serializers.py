@@ -1,10 +1,21 @@
 from ktg_storage.services import FileDirectUploadService
 from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Manager
 from django.shortcuts import get_object_or_404
 from rest_framework import serializers
+from typing import Dict
+from typing import Optional
+from typing import Set
+from typing import Tuple
 from typing_extensions import TypedDict
+from ktg_storage.access import record_access
 from ktg_storage.client import s3_service
+from ktg_storage.enums import StorageClass
 
+from ktg_storage import cdn
+from ktg_storage import expiry
+from ktg_storage import variants
 from ktg_storage.models import Storage
 
 
@@ -28,21 +39,109 @@ class StorageValidatedData(TypedDict):
     upload_finished_at: str
     expire_at: str
     reminder: str
+    file_size: int
 
 
-class FileSerializer(serializers.ModelSerializer):
+class SparseFieldsetMixin:
+    """
+    `?fields=id,file_name` limits GET responses to the listed fields. Fields
+    in `expandable_fields` are then rendered as a primary key unless also
+    listed in `?expand=`. Dropped fields are removed before serialization,
+    so their methods (URL signing, nested serializers) never run. Without
+    `?fields=` the full representation is returned.
+    """
+
+    expandable_fields: Tuple[str, ...] = ()
+
+    def _query_names(self, param: str) -> Optional[Set[str]]:
+        request = self.context.get("request")
+        if request is None or request.method != "GET":
+            return None
+
+        value = request.query_params.get(param)
+        if value is None:
+            return None
+
+        return {name.strip() for name in value.split(",") if name.strip()}
+
+    def get_fields(self):
+        fields = super().get_fields()
+
+        requested = self._query_names("fields")
+        if requested is None:
+            return fields
+
+        expand = self._query_names("expand") or set()
+        for name in list(fields):
+            if name not in requested:
+                del fields[name]
+            elif name in self.expandable_fields and name not in expand:
+                fields[name] = serializers.PrimaryKeyRelatedField(
+                    read_only=True)
+
+        return fields
+
+
+class FileListSerializer(serializers.ListSerializer):
+    """
+    Signs the download URLs of a whole page at once (`sign_many`), one
+    timestamp and one storage call per page instead of one per row.
+    """
+
+    presigned_urls: Dict[str, str] = {}
+
+    def to_representation(self, data):
+        files = list(data.all() if isinstance(data, Manager) else data)
+
+        if not settings.IS_USING_LOCAL_STORAGE and "file" in self.child.fields:
+            names = [
+                file.file.name for file in files
+                if file.file
+                and file.storage_class not in StorageClass.ARCHIVED
+                and not cdn.delivers(file)
+            ]
+            if names:
+                self.presigned_urls = dict(
+                    zip(names, s3_service.create_presigned_urls(names)))
+
+        return super().to_representation(files)
+
+
+class FileSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     uploaded_by = UserSerializer()
     file = serializers.SerializerMethodField()
 
+    expandable_fields = ("uploaded_by",)
+
     class Meta:
         model = Storage
-        exclude = (
-            "is_deleted",
+        list_serializer_class = FileListSerializer
+        # Bookkeeping columns (reservations, stored size, ETags, storage
+        # class, expiry tag, ...) are not part of the API.
+        fields = (
+            "id",
+            "created_at",
+            "updated_at",
+            "file",
+            "thumbnail",
+            "placeholder",
+            "original_file_name",
+            "file_name",
+            "file_type",
+            "uploaded_by",
+            "upload_finished_at",
+            "expire_at",
+            "reminder",
+            "file_size",
+            "media_metadata",
         )
         read_only_fields = (
             "id",
             "upload_finished_at",
             "uploaded_by",
+            "media_metadata",
+            "placeholder",
+            "file_size",
         )
 
     def update(self, instance: Storage, validated_data: dict):
@@ -52,13 +151,28 @@ class FileSerializer(serializers.ModelSerializer):
         validated_data.pop("file_name", None)
         validated_data.pop("file_type", None)
 
-        return super().update(instance, validated_data)
+        instance = super().update(instance, validated_data)
+        if "expire_at" in validated_data:
+            expiry.apply_expiry_tag(instance)
+
+        return instance
 
     def get_file(self, obj: Storage):
         if settings.IS_USING_LOCAL_STORAGE:
             return obj.file.url if obj.file else None
 
-        return s3_service.create_presigned_url(obj.file.name)
+        if obj.storage_class in StorageClass.ARCHIVED:
+            # Not readable until restored, see FileDownloadView.
+            return None
+
+        record_access(obj.file_name, obj.last_accessed_at)
+
+        if cdn.delivers(obj):
+            return cdn.object_url(obj.file.name)
+
+        url = getattr(self.parent, "presigned_urls", {}).get(obj.file.name)
+
+        return url or s3_service.create_presigned_url(obj.file.name)
 
 
 class StartDirectFileUploadSerializer(serializers.Serializer):
@@ -69,6 +183,8 @@ class StartDirectFileUploadSerializer(serializers.Serializer):
     file_type = serializers.CharField(write_only=True)
     reminder = serializers.DateTimeField(write_only=True, required=False)
     expire_at = serializers.DateTimeField(write_only=True, required=False)
+    file_size = serializers.IntegerField(
+        write_only=True, required=False, min_value=1)
 
     def create(self, validated_data: StorageValidatedData):
 
@@ -76,7 +192,11 @@ class StartDirectFileUploadSerializer(serializers.Serializer):
         if user.is_authenticated:
             validated_data["user"] = user
         service = FileDirectUploadService(user)
-        data = service.start(validated_data)
+
+        try:
+            data = service.start(validated_data)
+        except DjangoValidationError as e:
+            raise serializers.ValidationError(e.messages)
 
         return data
 
@@ -111,3 +231,33 @@ class FinishFileUploadSerializer(serializers.Serializer):
 class CreatePresignedUrl(serializers.Serializer):
     file_name = serializers.CharField()
     expires = serializers.BooleanField(default=True)
+
+
+class FileSearchSerializer(serializers.Serializer):
+    q = serializers.CharField(required=False, allow_blank=True, max_length=255)
+    match = serializers.ChoiceField(
+        choices=["contains", "prefix"], default="contains")
+    file_type = serializers.CharField(required=False, max_length=255)
+    created_after = serializers.DateTimeField(required=False)
+    created_before = serializers.DateTimeField(required=False)
+    expire_after = serializers.DateTimeField(required=False)
+    expire_before = serializers.DateTimeField(required=False)
+
+
+class ImageVariantSerializer(serializers.Serializer):
+    w = serializers.IntegerField()
+    fmt = serializers.CharField(default="jpeg")
+
+    def validate_w(self, value):
+        if value not in variants.allowed_widths():
+            raise serializers.ValidationError(
+                "Width must be one of {}.".format(
+                    ", ".join(map(str, variants.allowed_widths()))))
+        return value
+
+    def validate_fmt(self, value):
+        if value not in variants.allowed_formats():
+            raise serializers.ValidationError(
+                "Format must be one of {}.".format(
+                    ", ".join(variants.allowed_formats())))
+        return value
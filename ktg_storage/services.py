@@ -1,31 +1,56 @@
 import mimetypes
 from typing import Any
 from typing import Dict
+from typing import Iterator
 from typing import Tuple
+from typing import Union
+from contextlib import ExitStack
+from contextlib import contextmanager
 from PIL import Image
 
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.db import transaction
 from django.utils import timezone
+from django.utils.cache import quote_etag
 from typing_extensions import TypedDict
+from ktg_storage import compression
+from ktg_storage import expiry
+from ktg_storage import icons
+from ktg_storage import quota
+from ktg_storage import variants
 from ktg_storage.client import s3_service
+from ktg_storage.client import storage_service
 from moviepy.editor import VideoFileClip
 import fitz
 from ktg_storage.enums import FileUploadStorage
+from ktg_storage.enums import StorageClass
+from ktg_storage.instrumentation import stage
+from ktg_storage.metadata import extract_media_metadata
+from ktg_storage.metadata import open_pdf
 from ktg_storage.models import Storage
 from ktg_storage.utils import bytes_to_mib
 from ktg_storage.utils import file_generate_local_upload_url
 from ktg_storage.utils import file_generate_name
 from ktg_storage.utils import file_generate_upload_path
+from ktg_storage.utils import thumbnail_generate_path
+import base64
 import magic
+import mmap
 import io
 import logging
-import random
 import tempfile
 from io import BytesIO
 from typing import Optional
 
+# libmagic does not need the whole object to detect its type.
+MIME_SNIFF_SIZE = 1024 * 1024
+
+# Placeholders are a few hundred bytes, small enough to inline in every row
+# of a list response.
+PLACEHOLDER_SIZE = (16, 16)
+PLACEHOLDER_QUALITY = 40
+
 
 def _validate_file_size(file_obj):
 
@@ -81,12 +106,15 @@ class FileStandardUploadService:
             file_name, file_type
         )
 
+        quota.charge(self.user, self.file_obj.size)
+
         obj = Storage(
             file=self.file_obj,
             object_type=object_type,
             original_file_name=file_name,
             file_name=file_generate_name(file_name),
             file_type=file_type,
+            file_size=self.file_obj.size,
             uploaded_by=self.user,
             upload_finished_at=timezone.now(),
         )
@@ -106,7 +134,10 @@ class FileStandardUploadService:
             file_name, file_type
         )
 
+        quota.charge(self.user, self.file_obj.size - (file.file_size or 0))
+
         file.file = self.file_obj
+        file.file_size = self.file_obj.size
         file.original_file_name = file_name
         file.file_name = file_generate_name(file_name)
         file.file_type = file_type
@@ -124,6 +155,11 @@ class StartFileUploadData(TypedDict):
     presigned_data: Dict[str, Any]
 
 
+class ThumbnailData(TypedDict):
+    thumbnail: str
+    placeholder: Optional[str]
+
+
 class FileDirectUploadService:
 
     class StorageValidatedData(TypedDict):
@@ -134,20 +170,32 @@ class FileDirectUploadService:
         reminder: str
         user: str
         object_type: str
+        file_size: int
 
     def __init__(self, user):
         self.user = user
 
     @transaction.atomic
     def start(self, data: StorageValidatedData) -> StartFileUploadData:
+        # Reserve the declared size, or the largest upload the presigned
+        # POST allows when the client did not declare one.
+        max_size = data.get("file_size") or settings.FILE_MAX_SIZE
+        if max_size > settings.FILE_MAX_SIZE:
+            raise ValidationError(
+                "File is too large. It should not exceed {} MiB".format(
+                    bytes_to_mib(settings.FILE_MAX_SIZE)))
+
+        user = data.get("user", None)
+        quota.reserve(user, max_size)
 
         file: Storage = Storage(
             original_file_name=data["file_name"],
             file_name=file_generate_name(data["file_name"]),
             file_type=data["file_type"],
-            uploaded_by=data.get("user", None),
+            uploaded_by=user,
             expire_at=data.get("expire_at"),
             reminder=data.get("reminder"),
+            reserved_size=max_size if quota.quota_enabled() else None,
             file=None,
         )
 
@@ -171,7 +219,9 @@ class FileDirectUploadService:
             or not settings.DEBUG
         ):
             presigned_data = s3_service.generate_presigned_post(
-                file_path=upload_path, file_type=file.file_type
+                file_path=upload_path,
+                file_type=file.file_type,
+                max_size=max_size,
             )
 
         else:
@@ -186,19 +236,101 @@ class FileDirectUploadService:
         }
 
     @transaction.atomic
-    def finish(self, *, file: Storage) -> Storage:
+    def finish(
+        self, *, file: Storage, metadata: Optional[Dict[str, Any]] = None
+    ) -> Storage:
+        """
+        Finish the upload of `file`. `metadata` (Size and ETag of the
+        object, e.g. from an upload event) saves the HEAD request.
+
+        Idempotent: the client's finish call and the upload event
+        (ktg_storage.notifications) may both arrive, whichever comes second
+        returns the row unchanged as long as the object is the same. The
+        event carries the ETag of the upload, which no longer matches the
+        stored object once it was compressed, so both ETags are recognised.
+        """
         # Potentially, check against user
+        file = Storage.objects.select_for_update().get(pk=file.pk)
+
+        if metadata is None:
+            metadata = storage_service.get_file_metadata(file.file.name) or {}
+        etag = metadata.get("ETag")
+        if etag:
+            etag = quote_etag(etag)
+
+        if (
+            file.upload_finished_at
+            and etag
+            and etag in (file.etag, file.upload_etag)
+        ):
+            return file
+
+        previous_size = (file.file_size or 0) if file.upload_finished_at else 0
+        if file.upload_finished_at:
+            # The object was uploaded again, its variants are stale.
+            variants.delete_variants(file)
         file.upload_finished_at = timezone.now()
+        # A new upload is a fresh STANDARD object.
+        file.last_accessed_at = file.upload_finished_at
+        file.storage_class = StorageClass.STANDARD
+        file.storage_class_changed_at = None
 
         file.full_clean()
         file.file_name = file.file.name
 
-        file.file_size = s3_service.get_file_size(file.file.name)
-        thumbnail = create_thumbnail(file.file.name)
-        file.thumbnail = s3_service.get_file_path(thumbnail)
+        file.file_size = metadata.get("Size", 0)
+        file.stored_size = file.file_size
+        # Set when the object is stored compressed already, e.g. when the
+        # upload of a compressed file is finished again.
+        file.content_encoding = metadata.get("ContentEncoding")
+        file.etag = etag
+        file.upload_etag = etag
+        with ExitStack() as stack:
+            # The thumbnail and metadata stages share one download.
+            with stage("download"):
+                source = stack.enter_context(
+                    storage_service.open_file_buffer(file.file.name))
+
+            if file.content_encoding and source is not None:
+                source = compression.decode(source, file.content_encoding)
+                file.file_size = len(source)
+
+            thumbnail = create_thumbnail(file.file.name, source=source)
+            if thumbnail:
+                file.thumbnail = storage_service.get_file_path(
+                    thumbnail["thumbnail"])
+                file.placeholder = thumbnail["placeholder"]
+                file.thumbnail_error = None
+            else:
+                file.thumbnail = None
+                file.placeholder = None
+                file.thumbnail_error = "Thumbnail generation failed"
+
+            file.media_metadata = extract_media_metadata(
+                file.file.name, source=source)
+
+        # Runs last: the thumbnail and metadata stages read the raw object.
+        if compression.should_compress(file.file_type):
+            if compression.compress_object(file):
+                # Keep the ETag of the stored object, so the event of the
+                # rewrite is recognised as already finished.
+                compressed = storage_service.get_file_metadata(file.file.name)
+                file.etag = compressed["ETag"] if compressed else None
+        # regenerate_thumbnails skips files whose stored object still has
+        # the ETag the thumbnail was built for.
+        file.thumbnail_source_etag = file.etag if file.thumbnail else None
+
+        quota.commit(
+            file.uploaded_by, file.reserved_size, file.file_size - previous_size
+        )
+        file.reserved_size = None
+        # The object was (re)written, it carries no expiry tag yet.
+        file.expiry_tag = None
 
         file.save()
 
+        expiry.apply_expiry_tag(file)
+
         return file
 
     @transaction.atomic
@@ -213,33 +345,126 @@ class FileDirectUploadService:
         return file
 
 
+@transaction.atomic
+def soft_delete_file(file: Storage) -> Storage:
+    if not file.is_deleted:
+        if file.upload_finished_at:
+            # file_size is read-only, it is what `finish` committed.
+            quota.release(file.uploaded_by, file.file_size or 0)
+        elif file.reserved_size:
+            # Abandoned upload, give its reservation back.
+            quota.cancel(file.uploaded_by, file.reserved_size)
+            file.reserved_size = None
+
+        if variants.has_variants(file):
+            # Listing and deleting the variants is slow, keep it out of the
+            # transaction and skip it when the delete is rolled back.
+            transaction.on_commit(lambda: variants.delete_variants(file))
+
+    file.is_deleted = True
+    file.save()
+
+    return file
+
+
+@contextmanager
+def _local_file(s3_key: str) -> Iterator[Optional[str]]:
+    """
+    Yield a local path for the object: the cached copy when the object cache
+    is enabled, otherwise a temporary file holding the downloaded content.
+    """
+    with ExitStack() as stack:
+        with stage("download"):
+            local_path = stack.enter_context(
+                storage_service.open_file_path(s3_key))
+            if local_path is None:
+                content = storage_service.get_file_content(s3_key)
+
+        if local_path is not None:
+            yield local_path
+            return
+
+    if content is None:
+        yield None
+        return
+
+    with tempfile.NamedTemporaryFile(delete=True) as temp_file:
+        temp_file.write(content)
+        temp_file.flush()
+
+        yield temp_file.name
+
+
+def create_placeholder(img: Image.Image) -> Optional[str]:
+    """
+    Encode an already decoded image as a tiny JPEG data URI (LQIP).
+    """
+    try:
+        with stage("placeholder"):
+            tiny = img.convert("RGB")
+            tiny.thumbnail(PLACEHOLDER_SIZE, Image.Resampling.BILINEAR)
+
+            buffer = BytesIO()
+            tiny.save(
+                buffer, format="JPEG", quality=PLACEHOLDER_QUALITY, optimize=True
+            )
+
+            encoded = base64.b64encode(buffer.getvalue()).decode("ascii")
+
+            return f"data:image/jpeg;base64,{encoded}"
+
+    except Exception as e:
+        logging.error(f"Error creating placeholder: {str(e)}", exc_info=True)
+
+        return None
+
+
+def _thumbnail_data(
+    thumbnail_s3_path: Optional[str], placeholder: Optional[str] = None
+) -> Optional[ThumbnailData]:
+    if thumbnail_s3_path is None:
+        return None
+
+    return {"thumbnail": thumbnail_s3_path, "placeholder": placeholder}
+
+
 def create_thumbnail(
-    s3_key: str, size: Tuple[int, int] = (128, 128)
-) -> Optional[str]:
+    s3_key: str, size: Tuple[int, int] = (128, 128), source: Optional[Any] = None
+) -> Optional[ThumbnailData]:
+    """
+    `source` is the object content when the caller has it open already
+    (`open_file_buffer`), otherwise it is downloaded here.
+    """
     try:
+        with ExitStack() as stack:
+            if source is None:
+                if not storage_service.file_exists(s3_key):
+                    logging.error(f"File does not exist in S3: {s3_key}")
+                    return None
 
-        if not s3_service.file_exists(s3_key):
-            logging.error(f"File does not exist in S3: {s3_key}")
-            return None
+                with stage("download"):
+                    source = stack.enter_context(
+                        storage_service.open_file_buffer(s3_key))
 
-        image_data = s3_service.get_file_content(s3_key)
-        if image_data is None:
-            return None
+            if source is None:
+                return None
 
-        mime = magic.Magic(mime=True)
-        mime_type = mime.from_buffer(image_data)
+            with stage("sniff"):
+                mime = magic.Magic(mime=True)
+                mime_type = mime.from_buffer(source[:MIME_SNIFF_SIZE])
 
-        if mime_type.startswith("image/"):
-            return create_thumbnail_from_image(
-                image_data, s3_key, mime_type, size
-            )
-        elif mime_type.startswith("video/"):
+            if mime_type.startswith("image/"):
+                return create_thumbnail_from_image(
+                    source, s3_key, mime_type, size
+                )
+            elif mime_type == "application/pdf":
+                return create_pdf_thumbnail(s3_key, size, source)
+
+        if mime_type.startswith("video/"):
             return create_thumbnail_from_video(s3_key, size)
-        elif mime_type == "application/pdf":
-            return create_pdf_thumbnail(s3_key, size)
         else:
-            logging.error(f"Unsupported MIME type: {mime_type}")
-            return generate_random_thumbnail(size)
+            # No preview, share the icon of the file type.
+            return _thumbnail_data(icons.get_icon(mime_type, size))
 
     except Exception as e:
         logging.error(f"Error creating thumbnail: {str(e)}", exc_info=True)
@@ -247,43 +472,60 @@ def create_thumbnail(
 
 
 def create_thumbnail_from_image(
-    image_data: bytes, s3_key: str, mime_type: str, size: Tuple[int, int]
+    image_data: Union[bytes, mmap.mmap],
+    s3_key: str,
+    mime_type: str,
+    size: Tuple[int, int],
 ):
     try:
-        img = Image.open(BytesIO(image_data))
+        with stage("decode"):
+            if isinstance(image_data, mmap.mmap):
+                # Memory-mapped cache entries are file-like, decode in place.
+                image_data.seek(0)
+                img = Image.open(image_data)
+            else:
+                img = Image.open(BytesIO(image_data))
 
-        if img.mode in ("RGBA", "LA") or (
-            img.mode == "P" and "transparency" in img.info
-        ):
-            img = img.convert("RGB")
-        img.thumbnail(size, Image.Resampling.LANCZOS)
-
-        buffer = BytesIO()
-        if mime_type == "image/jpeg":
-            img.save(buffer, format="JPEG", quality=85, optimize=True)
-        elif mime_type == "image/png":
-            img.save(buffer, format="PNG", quality=85, optimize=True)
-        elif mime_type == "image/gif":
-            img.save(buffer, format="GIF", optimize=True)
-        else:
-            logging.error(f"Unsupported image MIME type: {mime_type}")
-            return None
+            if img.mode in ("RGBA", "LA") or (
+                img.mode == "P" and "transparency" in img.info
+            ):
+                img = img.convert("RGB")
+            else:
+                # Same reduced-size decode `thumbnail` would request, done
+                # up front so decoding and resizing are timed separately.
+                img.draft(None, (size[0] * 2, size[1] * 2))
+                img.load()
 
-        buffer.seek(0)
+        with stage("resize"):
+            img.thumbnail(size, Image.Resampling.LANCZOS)
 
-        thumbnail_filename = "{}.jpg".format(
-            s3_key.split("/")[-1].rsplit(".", 1)[0]
-        )
-        thumbnail_s3_path = f"thumbnails/{thumbnail_filename}"
+        placeholder = create_placeholder(img)
 
-        success = s3_service.upload_fileobj(
-            buffer, thumbnail_s3_path, content_type="image/jpeg"
-        )
+        with stage("encode"):
+            buffer = BytesIO()
+            if mime_type == "image/jpeg":
+                img.save(buffer, format="JPEG", quality=85, optimize=True)
+            elif mime_type == "image/png":
+                img.save(buffer, format="PNG", quality=85, optimize=True)
+            elif mime_type == "image/gif":
+                img.save(buffer, format="GIF", optimize=True)
+            else:
+                logging.error(f"Unsupported image MIME type: {mime_type}")
+                return None
+
+            buffer.seek(0)
+
+        thumbnail_s3_path = thumbnail_generate_path(s3_key)
+
+        with stage("upload"):
+            success = storage_service.upload_fileobj(
+                buffer, thumbnail_s3_path, content_type="image/jpeg"
+            )
         if not success:
             logging.error("Failed to upload thumbnail to S3.")
             return None
 
-        return thumbnail_s3_path
+        return _thumbnail_data(thumbnail_s3_path, placeholder)
 
     except Exception as e:
         message = f"Error creating image thumbnail: {str(e)}"
@@ -294,38 +536,38 @@ def create_thumbnail_from_image(
 
 def create_thumbnail_from_video(s3_key: str, size: Tuple[int, int]):
     try:
-        video_data = s3_service.get_file_content(s3_key)
-        if video_data is None:
-            return None
+        with _local_file(s3_key) as video_path:
+            if video_path is None:
+                return None
 
-        with tempfile.NamedTemporaryFile(delete=True) as temp_video_file:
-            temp_video_file.write(video_data)
-            temp_video_file.flush()
+            with VideoFileClip(video_path) as clip:
+                with stage("decode"):
+                    frame_time = clip.duration * 0.2
+                    frame = clip.get_frame(frame_time)
 
-            with VideoFileClip(temp_video_file.name) as clip:
-                frame_time = clip.duration * 0.2
-                frame = clip.get_frame(frame_time)
+                    img = Image.fromarray(frame)
 
-                img = Image.fromarray(frame)
-                img.thumbnail(size, Image.Resampling.LANCZOS)
+                with stage("resize"):
+                    img.thumbnail(size, Image.Resampling.LANCZOS)
 
-                buffer = BytesIO()
-                img.save(buffer, format="JPEG", quality=85, optimize=True)
-                buffer.seek(0)
+                placeholder = create_placeholder(img)
 
-                thumbnail_filename = "{}.jpg".format(
-                    s3_key.split("/")[-1].rsplit(".", 1)[0]
-                )
-                thumbnail_s3_path = f"thumbnails/{thumbnail_filename}"
+                with stage("encode"):
+                    buffer = BytesIO()
+                    img.save(buffer, format="JPEG", quality=85, optimize=True)
+                    buffer.seek(0)
 
-                success = s3_service.upload_fileobj(
-                    buffer, thumbnail_s3_path, content_type="image/jpeg"
-                )
+                thumbnail_s3_path = thumbnail_generate_path(s3_key)
+
+                with stage("upload"):
+                    success = storage_service.upload_fileobj(
+                        buffer, thumbnail_s3_path, content_type="image/jpeg"
+                    )
                 if not success:
                     logging.error("Failed to upload video thumbnail to S3.")
                     return None
 
-                return thumbnail_s3_path
+                return _thumbnail_data(thumbnail_s3_path, placeholder)
 
     except Exception as e:
         message = f"Error creating video thumbnail: {str(e)}"
@@ -334,35 +576,36 @@ def create_thumbnail_from_video(s3_key: str, size: Tuple[int, int]):
         return None
 
 
-def create_pdf_thumbnail(s3_key: str, size):
-    file_content = s3_service.get_file_content(s3_key)
-    if file_content is None:
-        return
-
+def create_pdf_thumbnail(s3_key: str, size, source: Union[bytes, mmap.mmap]):
     try:
-        pdf_file = fitz.open(stream=file_content, filetype="pdf")
-        first_page = pdf_file.load_page(0)
-        pix = first_page.get_pixmap(matrix=fitz.Matrix(2, 2))
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        img.thumbnail((300, 300))
-
-        buffer = io.BytesIO()
-        img.save(buffer, format="PNG")
-        buffer.seek(0)
-
-        thumbnail_filename = "{}.jpg".format(
-            s3_key.split("/")[-1].rsplit(".", 1)[0]
-        )
-        thumbnail_s3_path = f"thumbnails/{thumbnail_filename}"
+        with stage("decode"):
+            pdf_file = open_pdf(source)
+            first_page = pdf_file.load_page(0)
+            pix = first_page.get_pixmap(matrix=fitz.Matrix(2, 2))
+            img = Image.frombytes(
+                "RGB", [pix.width, pix.height], pix.samples)
 
-        success = s3_service.upload_fileobj(
-            buffer, thumbnail_s3_path, content_type="image/png"
-        )
+        with stage("resize"):
+            img.thumbnail((300, 300))
+
+        placeholder = create_placeholder(img)
+
+        with stage("encode"):
+            buffer = io.BytesIO()
+            img.save(buffer, format="PNG")
+            buffer.seek(0)
+
+        thumbnail_s3_path = thumbnail_generate_path(s3_key)
+
+        with stage("upload"):
+            success = storage_service.upload_fileobj(
+                buffer, thumbnail_s3_path, content_type="image/png"
+            )
         if not success:
             logging.error("Failed to upload PDF thumbnail to S3.")
             return None
 
-        return thumbnail_s3_path
+        return _thumbnail_data(thumbnail_s3_path, placeholder)
 
     except Exception as e:
         message = f"Error creating PDF thumbnail: {str(e)}"
@@ -370,26 +613,3 @@ def create_pdf_thumbnail(s3_key: str, size):
 
         return None
 
-
-def generate_random_thumbnail(self, size: Tuple[int, int]) -> str:
-    img = Image.new("RGB", size, color=self.random_color())
-
-    buffer = BytesIO()
-    img.save(buffer, format="JPEG", quality=85, optimize=True)
-    buffer.seek(0)
-
-    thumbnail_filename = f"{random.randint(1000, 9999)}.jpg"
-    thumbnail_s3_path = f"thumbnails/{thumbnail_filename}"
-
-    success = s3_service.upload_fileobj(
-        buffer, thumbnail_s3_path, content_type="image/jpeg"
-    )
-    if not success:
-        logging.error("Failed to upload random thumbnail to S3.")
-        return None
-
-    return thumbnail_s3_path
-
-
-def random_color(self) -> Tuple[int, int, int]:
-    return random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)
@@ -0,0 +1,30 @@
+from contextlib import contextmanager
+from typing import Iterator
+from typing import Optional
+
+from ktg_storage.instrumentation import S3CallCounter
+from ktg_storage.instrumentation import count_s3_calls
+
+
+class S3CallAssertionsMixin:
+    """
+    `TestCase` mixin asserting the number of `S3Service` calls, like
+    `assertNumQueries`:
+
+        with self.assertNumS3Calls(1, operation="get_file_metadata"):
+            self.client.get(url)
+    """
+
+    @contextmanager
+    def assertNumS3Calls(
+        self, num: int, operation: Optional[str] = None
+    ) -> Iterator[S3CallCounter]:
+        with count_s3_calls() as counter:
+            yield counter
+
+        calls = counter.calls[operation] if operation else counter.total
+        self.assertEqual(
+            calls, num,
+            f"{calls} S3 calls{f' to {operation}' if operation else ''} were "
+            f"made, {num} expected: {dict(counter.calls)}",
+        )
@@ -1,14 +1,69 @@
 
+import datetime
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+from unittest import skipUnless
+
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.contrib import admin
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.test import RequestFactory
 from django.test import TestCase
+from django.test import override_settings
+from freezegun import freeze_time
+from moto import mock_s3
+from moto import mock_sqs
 from rest_framework import status
+from rest_framework.generics import ListAPIView
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIClient
+from ktg_storage import cdn
+from ktg_storage import compression
+from ktg_storage import expiry
+from ktg_storage import icons
+from ktg_storage.admin import AttachmentAdmin
+from ktg_storage import tiering
+from ktg_storage import utils
+from ktg_storage import variants
+from ktg_storage.access import AccessTracker
+from ktg_storage import instrumentation
+from ktg_storage import notifications
+from ktg_storage import partitioning
+from ktg_storage import routers
+from ktg_storage.backends import BaseStorageService
+from ktg_storage.backends import LocalStorageService
+from ktg_storage.cache import S3ObjectCache
+from ktg_storage.client import S3Service
+from ktg_storage.client import get_s3_client
+from ktg_storage.client import s3_service
+from ktg_storage.metadata import _image_metadata
+from ktg_storage.middleware import S3CallBudgetMiddleware
+from ktg_storage import quota
 from ktg_storage.models import Storage
+from ktg_storage import renderers
+from ktg_storage.renderers import ORJSONRenderer
+from ktg_storage.signer import PresignedUrlSigner
+from ktg_storage.serializers import FileSerializer
+from ktg_storage.testing import S3CallAssertionsMixin
+from ktg_storage.views import ConditionalGetMixin
+from ktg_storage.services import FileDirectUploadService
+from ktg_storage.services import create_placeholder
+from ktg_storage.services import create_thumbnail
+from ktg_storage.services import soft_delete_file
 from ktg_storage.factories import StorageFactory, UserFactory
 from django.urls import reverse
 from django.utils import timezone
 
 
-class StorageApiTests(TestCase):
+class StorageApiTests(S3CallAssertionsMixin, TestCase):
     def setUp(self):
         self.user = UserFactory.create()
         self.client = APIClient()
@@ -31,6 +86,104 @@ class StorageApiTests(TestCase):
         self.assertEqual(str(files[1]["uploaded_by"][0]["id"]), str(
             self.user.id))
 
+    def test_get_files_sparse_fieldset(self):
+        url = reverse('ktg_storage:list')
+
+        with mock.patch.object(
+            FileSerializer, "get_file", side_effect=AssertionError
+        ), self.assertNumS3Calls(0):
+            response = self.client.get(url, {"fields": "id,uploaded_by"})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            response.json()[0], {
+                "id": str(self.file2.id), "uploaded_by": self.user.id})
+
+        response = self.client.get(
+            url, {"fields": "id,uploaded_by", "expand": "uploaded_by"})
+        self.assertEqual(
+            response.json()[0]["uploaded_by"]["username"], self.user.username)
+
+    @skipUnless(renderers.orjson, "orjson is not installed")
+    def test_orjson_renderer_matches_json_renderer(self):
+        data = FileSerializer(
+            Storage.objects.select_related("uploaded_by"), many=True).data
+
+        self.assertEqual(
+            json.loads(ORJSONRenderer().render(data)),
+            json.loads(JSONRenderer().render(data)),
+        )
+
+    def test_get_all_files_not_modified(self):
+        url = reverse('ktg_storage:list')
+        response = self.client.get(url)
+        etag = response["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        StorageFactory.create(uploaded_by=self.user)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_file_detail_not_modified(self):
+        url = reverse('ktg_storage:update', kwargs={'pk': self.file1.id})
+        etag = self.client.get(url)["ETag"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.client.patch(url, {"expire_at": timezone.now()})
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_list_has_no_last_modified(self):
+        url = reverse('ktg_storage:list')
+        response = self.client.get(url)
+
+        self.assertNotIn("Last-Modified", response)
+
+        soft_delete_file(self.file1)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_file_detail_if_modified_since(self):
+        url = reverse('ktg_storage:update', kwargs={'pk': self.file1.id})
+        last_modified = self.client.get(url)["Last-Modified"]
+
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_conditional_views_require_get_version(self):
+        class View(ConditionalGetMixin, ListAPIView):
+            pass
+
+        with self.assertRaises(TypeError):
+            View()
+
+    def test_search_files(self):
+        StorageFactory.create(
+            uploaded_by=self.user,
+            original_file_name="Holiday photo.jpg",
+            file_type="image/jpeg",
+        )
+        StorageFactory.create(
+            original_file_name="Holiday photo of someone else.jpg")
+
+        url = reverse('ktg_storage:search')
+        response = self.client.get(url, {"q": "day pho", "file_type": "image/"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        results = response.json()["results"]
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]["original_file_name"], "Holiday photo.jpg")
+
+        response = self.client.get(url, {"q": "photo", "match": "prefix"})
+        self.assertEqual(response.json()["results"], [])
+
     def test_get_expired_files(self):
         url = reverse('ktg_storage:expired-files')
         response = self.client.get(url)
@@ -59,6 +212,43 @@ class StorageApiTests(TestCase):
 
         self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
 
+    def test_download_local_file(self):
+        url = reverse('ktg_storage:download', kwargs={"pk": str(self.file1.id)})
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            b"".join(response.streaming_content), self.file1.file.read())
+
+        with override_settings(STORAGE_LOCAL_SENDFILE="x-accel-redirect"):
+            response = self.client.get(url)
+        self.assertEqual(
+            response["X-Accel-Redirect"], f"/protected/{self.file1.file.name}")
+
+    def test_image_variant(self):
+        from PIL import Image
+
+        buffer = io.BytesIO()
+        Image.new("RGB", (800, 600)).save(buffer, format="JPEG")
+        image = StorageFactory.create(
+            uploaded_by=self.user,
+            file=ContentFile(buffer.getvalue(), name="photo.jpg"),
+            file_type="image/jpeg",
+        )
+        url = reverse('ktg_storage:image_variant', kwargs={"pk": str(image.id)})
+
+        response = self.client.get(url, {"w": 64, "fmt": "webp"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertEqual(Image.open(io.BytesIO(response.content)).size, (64, 48))
+
+        response = self.client.get(
+            url, {"w": 64, "fmt": "webp"}, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        response = self.client.get(url, {"w": 65})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_file_presigned_url(self):
         url = reverse('ktg_storage:create_presigned_url')
         data = {
@@ -94,3 +284,1312 @@ class StorageApiTests(TestCase):
 
         file = Storage.objects.get(id=self.file1.id)
         self.assertIsNotNone(file.upload_finished_at)
+
+
+class LocalStorageServiceTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.service = LocalStorageService(self.directory.name, "/media/")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_upload_read_and_delete(self):
+        self.service.upload_fileobj(
+            io.BytesIO(b"0123456789"), "files/ab/a.txt", "text/plain")
+
+        metadata = self.service.get_file_metadata("files/ab/a.txt")
+        self.assertEqual(metadata["Size"], 10)
+        self.assertEqual(self.service.get_file_range("files/ab/a.txt", 2, 4), b"234")
+        with self.service.open_file_buffer("files/ab/a.txt") as buffer:
+            self.assertEqual(buffer[:3], b"012")
+
+        self.assertTrue(self.service.copy_file("files/ab/a.txt", "files/b.txt"))
+        self.assertEqual(self.service.delete_files(["files/ab/a.txt"]), [])
+        self.assertFalse(self.service.file_exists("files/ab/a.txt"))
+        self.assertTrue(self.service.file_exists("files/b.txt"))
+
+    def test_keys_can_not_escape_root(self):
+        self.assertFalse(self.service.file_exists("../etc/passwd"))
+        self.assertIsNone(self.service.get_file_content("../etc/passwd"))
+
+
+class BaseStorageServiceTests(TestCase):
+    def test_backends_must_implement_every_operation(self):
+        class PartialService(BaseStorageService):
+            def file_exists(self, key):
+                return True
+
+        with self.assertRaises(TypeError):
+            PartialService()
+
+        self.assertIn(
+            "open_file_buffer", BaseStorageService.__abstractmethods__)
+
+
+class ImageVariantTests(TestCase):
+    def test_concurrent_misses_render_once(self):
+        flight = variants.SingleFlight()
+        calls = []
+
+        def render():
+            calls.append(1)
+            time.sleep(0.05)
+            return b"variant"
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(flight.do("k", render)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [b"variant"] * 5)
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = variants.VariantCache(max_size=10)
+        cache.put("a", b"aaaa")
+        cache.put("b", b"bbbb")
+        cache.get("a")
+        cache.put("c", b"cccc")
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"aaaa")
+        self.assertEqual(cache.size, 8)
+
+    def test_variants_are_deleted_with_the_file(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        service = LocalStorageService(directory.name, "/media/")
+        patcher = mock.patch.object(variants, "storage_service", service)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        file = StorageFactory.create(file_type="image/png")
+        other = StorageFactory.create(file_type="image/png")
+        for source, width in ((file, 64), (file, 128), (other, 64)):
+            service.upload_fileobj(
+                io.BytesIO(b"x"), variants.variant_key(source, width, "jpeg"),
+                "image/jpeg")
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            soft_delete_file(file)
+            self.assertEqual(len(service.list_files(utils.VARIANTS_PREFIX)), 3)
+
+        self.assertEqual(len(callbacks), 1)
+
+        self.assertEqual(
+            service.list_files(utils.VARIANTS_PREFIX),
+            [variants.variant_key(other, 64, "jpeg")])
+
+    def test_files_without_variants_are_not_listed(self):
+        file = StorageFactory.create(file_type="text/csv")
+
+        with mock.patch.object(variants, "storage_service") as service:
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                soft_delete_file(file)
+
+        self.assertEqual(callbacks, [])
+        service.list_files.assert_not_called()
+
+    def test_upload_again_deletes_variants(self):
+        file = StorageFactory.create(etag='"old"')
+
+        with mock.patch.object(variants, "delete_variants") as delete:
+            FileDirectUploadService(file.uploaded_by).finish(
+                file=file, metadata={"Size": 11, "ETag": '"new"'})
+
+        delete.assert_called_once()
+
+
+class S3ObjectCacheTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = S3ObjectCache(self.directory.name, max_size=100)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_entries_are_keyed_by_etag(self):
+        self.assertIsNone(self.cache.get_path("files/a.txt", '"v1"'))
+
+        self.cache.put_stream("files/a.txt", '"v1"', io.BytesIO(b"hello"))
+
+        self.assertIsNotNone(self.cache.get_path("files/a.txt", '"v1"'))
+        self.assertIsNone(self.cache.get_path("files/a.txt", '"v2"'))
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(self.cache.stats()["misses"], 2)
+
+    def test_open_buffer_memory_maps_entry(self):
+        self.cache.put_stream("files/a.txt", '"v1"', io.BytesIO(b"hello"))
+
+        with self.cache.open_buffer("files/a.txt", '"v1"') as buffer:
+            self.assertEqual(buffer[:5], b"hello")
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.cache.put_stream("files/a.txt", '"v1"', io.BytesIO(b"a" * 60))
+        self.cache.put_stream("files/b.txt", '"v1"', io.BytesIO(b"b" * 60))
+
+        self.assertIsNone(self.cache.get_path("files/a.txt", '"v1"'))
+        self.assertIsNotNone(self.cache.get_path("files/b.txt", '"v1"'))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_pinned_entries_outlive_eviction(self):
+        path = self.cache.put_stream("files/a.txt", '"v1"', io.BytesIO(b"a" * 60))
+
+        with self.cache.pin(path) as pinned:
+            self.cache.put_stream(
+                "files/b.txt", '"v1"', io.BytesIO(b"b" * 60))
+            self.assertFalse(os.path.exists(path))
+
+            with open(pinned, "rb") as f:
+                self.assertEqual(f.read(), b"a" * 60)
+
+        self.assertFalse(os.path.exists(pinned))
+        with self.cache.pin(path) as pinned:
+            self.assertIsNone(pinned)
+
+
+@mock_s3
+class S3CachedReadTests(TestCase):
+    def setUp(self):
+        self.service = S3Service()
+        self.service.client.create_bucket(
+            Bucket=self.service.bucket_name,
+            CreateBucketConfiguration={
+                "LocationConstraint": self.service.client.meta.region_name},
+        )
+        self.service.client.put_object(
+            Bucket=self.service.bucket_name, Key="files/a.txt", Body=b"a" * 95)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.service.cache = S3ObjectCache(directory.name, max_size=100)
+
+    def test_entries_over_the_eviction_target_are_not_cached(self):
+        self.assertIsNone(self.service.get_cached_file_path("files/a.txt"))
+        self.assertEqual(
+            self.service.get_file_content("files/a.txt"), b"a" * 95)
+
+    def test_only_requests_are_counted(self):
+        counter = instrumentation.count_s3_calls()
+        self.service.cache.max_size = 1000
+
+        with counter:
+            self.service.get_file_content("files/a.txt")
+            self.service.get_file_content("files/a.txt")
+            self.service.create_presigned_url("files/a.txt")
+
+        self.assertEqual(
+            counter.calls, {"get_file_metadata": 2, "cache_object": 1})
+
+    def test_evicted_entry_is_read_from_s3(self):
+        self.service.cache.max_size = 1000
+
+        with mock.patch.object(
+            self.service, "get_cached_file_path",
+            return_value=os.path.join(self.service.cache.directory, "gone"),
+        ):
+            content = self.service.get_file_content("files/a.txt")
+
+        self.assertEqual(content, b"a" * 95)
+
+
+class InstrumentationTests(TestCase):
+    class RecordingInstrument(instrumentation.Instrument):
+        def __init__(self):
+            self.operations = []
+            self.stages = []
+
+        def record_operation(self, record):
+            self.operations.append(record)
+
+        def record_stage(self, record):
+            self.stages.append(record)
+
+    def setUp(self):
+        self.instrument = instrumentation.register(self.RecordingInstrument())
+
+    def tearDown(self):
+        instrumentation.unregister(self.instrument)
+
+    def test_operations_record_bytes_and_errors(self):
+        @instrumentation.instrumented("download")
+        def download():
+            instrumentation.record_bytes(42)
+            raise ValueError("boom")
+
+        with self.assertRaises(ValueError):
+            download()
+
+        record = self.instrument.operations[0]
+        self.assertEqual(record.operation, "download")
+        self.assertEqual(record.bytes_transferred, 42)
+        self.assertEqual(record.error, "ValueError")
+
+    def test_stages_are_timed(self):
+        with instrumentation.stage("resize"):
+            pass
+
+        self.assertEqual(self.instrument.stages[0].stage, "resize")
+        self.assertGreaterEqual(self.instrument.stages[0].duration, 0)
+
+
+class S3CallAccountingTests(S3CallAssertionsMixin, TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.service = LocalStorageService(self.directory.name, "/media/")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_calls_are_counted_per_operation(self):
+        with self.assertNumS3Calls(2) as counter:
+            self.service.file_exists("files/a.txt")
+            with self.assertNumS3Calls(1, operation="file_exists"):
+                self.service.file_exists("files/b.txt")
+
+        self.assertEqual(counter.calls, {"file_exists": 2})
+
+    @override_settings(STORAGE_S3_CALL_BUDGET=1)
+    def test_middleware_reports_requests_over_budget(self):
+        def view(request):
+            self.service.file_exists("files/a.txt")
+            self.service.file_exists("files/b.txt")
+            return "response"
+
+        request = RequestFactory().get("/files/")
+        middleware = S3CallBudgetMiddleware(view)
+
+        with self.assertLogs(level="WARNING") as logs:
+            self.assertEqual(middleware(request), "response")
+        self.assertIn("made 2 S3 calls (budget 1)", logs.output[0])
+
+        with override_settings(DEBUG=True, STORAGE_S3_CALL_BUDGET_RAISE=True):
+            with self.assertRaises(instrumentation.S3CallBudgetExceeded):
+                middleware(request)
+
+
+class MetadataBackfillTests(TestCase):
+    def setUp(self):
+        self.file = StorageFactory.create(
+            file_name="report.txt", file_size=None, file_type="")
+
+    def test_inventory_backfill(self):
+        key = self.file.file.name
+        with tempfile.TemporaryDirectory() as directory:
+            with gzip.open(f"{directory}/part-0.csv.gz", "wt") as f:
+                f.write(f'"bucket","{key}","","false","1","old"\n')
+                f.write(f'"bucket","{key}","","true","42","abc"\n')
+                f.write('"bucket","files/other.txt","","true","7","def"\n')
+            with open(f"{directory}/manifest.json", "w") as f:
+                json.dump({
+                    "fileFormat": "CSV",
+                    "fileSchema": "Bucket, Key, VersionId, IsLatest, Size, ETag",
+                    "files": [{"key": "inventory/data/part-0.csv.gz"}],
+                }, f)
+
+            call_command(
+                "backfill_metadata", inventory=f"{directory}/manifest.json",
+                prefix="", stdout=io.StringIO())
+
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.file_size, 42)
+        self.assertEqual(self.file.stored_size, 42)
+        self.assertEqual(self.file.etag, '"abc"')
+        self.assertEqual(self.file.file_type, "")
+
+    def test_head_backfill(self):
+        call_command("backfill_metadata", head=True, stdout=io.StringIO())
+
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.file_size, self.file.file.size)
+        self.assertIsNotNone(self.file.etag)
+        self.assertEqual(self.file.file_type, "text/plain")
+
+
+class PresignedUrlSignerTests(S3CallAssertionsMixin, TestCase):
+    KEYS = [
+        "files/ab/cd/0123456789abcdef.pdf",
+        "files/a b+c~(1)!*'.txt",
+        "thumbnails/ünïcode/%20already-encoded?.jpg",
+    ]
+
+    def test_urls_match_botocore(self):
+        for region in ("eu-west-3", "us-east-1"):
+            with override_settings(
+                AWS_S3_REGION_NAME=region,
+                AWS_ACCESS_KEY_ID="AKIDEXAMPLE",
+                AWS_SECRET_ACCESS_KEY="wJalrXUtnFEMI/K7MDENG+bPxRfiCYEXAMPLEKEY",
+            ):
+                client = get_s3_client()
+            credentials = client._request_signer._credentials
+            self.assertEqual(credentials.access_key, "AKIDEXAMPLE")
+            signer = PresignedUrlSigner.from_client(
+                client, access_key_id=credentials.access_key,
+                secret_access_key=credentials.secret_key,
+                bucket_name="test-bucket")
+
+            # The signing key is cached per day, sign across midnight.
+            for now in ("2024-02-29 23:59:59", "2024-03-01 00:00:01"):
+                with freeze_time(now):
+                    urls = signer.sign_many(self.KEYS, 10)
+                    for key, url in zip(self.KEYS, urls):
+                        self.assertEqual(url, client.generate_presigned_url(
+                            "get_object",
+                            Params={"Bucket": "test-bucket", "Key": key},
+                            ExpiresIn=10,
+                        ))
+
+    @override_settings(IS_USING_LOCAL_STORAGE=False)
+    def test_list_is_signed_in_one_call(self):
+        files = StorageFactory.create_batch(3)
+
+        with freeze_time("2024-03-01 12:00:00"):
+            # Signing is local, it makes no S3 call.
+            with self.assertNumS3Calls(0), mock.patch.object(
+                s3_service.signer, "sign_many",
+                wraps=s3_service.signer.sign_many,
+            ) as sign_many:
+                data = FileSerializer(files, many=True).data
+
+            sign_many.assert_called_once()
+
+            self.assertEqual(
+                [row["file"] for row in data],
+                s3_service.create_presigned_urls(
+                    [file.file.name for file in files]),
+            )
+
+
+@skipUnless(cdn.serialization, "cryptography is not installed")
+class CDNCookieTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        cls.private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048)
+        cls.pem = cls.private_key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        ).decode()
+
+    def setUp(self):
+        self.user = UserFactory.create()
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+        # Uploaded before CDN delivery was enabled.
+        self.legacy_file = StorageFactory.create(uploaded_by=self.user)
+
+        settings = override_settings(
+            IS_USING_LOCAL_STORAGE=False,
+            STORAGE_CDN_DOMAIN="cdn.example.com",
+            STORAGE_CDN_KEY_PAIR_ID="K2JCJMDEHXQW5F",
+            STORAGE_CDN_PRIVATE_KEY=self.pem,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.file = StorageFactory.create(uploaded_by=self.user)
+
+    def test_cookie_signature_verifies(self):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import padding
+
+        cookies = cdn.signed_cookies(self.user, expires_at=1700000000)
+        policy = cdn._decode(cookies[cdn.POLICY_COOKIE])
+
+        self.assertEqual(policy, (
+            b'{"Statement":[{"Resource":"https://cdn.example.com/files/users/'
+            + str(self.user.pk).encode() + b'/*",'
+            b'"Condition":{"DateLessThan":{"AWS:EpochTime":1700000000}}}]}'
+        ))
+        self.private_key.public_key().verify(
+            cdn._decode(cookies[cdn.SIGNATURE_COOKIE]), policy,
+            padding.PKCS1v15(), hashes.SHA1())
+        self.assertEqual(cdn.cookie_expiry(cookies, self.user), 1700000000)
+        # Another user's session gets their own cookies.
+        self.assertIsNone(cdn.cookie_expiry(cookies, UserFactory.create()))
+
+    def test_uploads_are_stored_under_the_user_prefix(self):
+        self.assertTrue(self.file.file.name.startswith(
+            f"files/users/{self.user.pk}/"))
+        self.assertTrue(cdn.delivers(self.file))
+        self.assertFalse(cdn.delivers(self.legacy_file))
+
+    def test_legacy_files_keep_presigned_urls(self):
+        data = FileSerializer([self.legacy_file, self.file], many=True).data
+
+        self.assertIn("X-Amz-Signature=", data[0]["file"])
+        self.assertEqual(
+            data[1]["file"], f"https://cdn.example.com/{self.file.file.name}")
+
+    def test_list_returns_cdn_urls_and_sets_cookies_once(self):
+        url = reverse("ktg_storage:list")
+        soft_delete_file(self.legacy_file)
+
+        with mock.patch.object(
+            s3_service, "create_presigned_urls", side_effect=AssertionError
+        ):
+            response = self.client.get(url)
+
+        self.assertEqual(
+            response.json()[0]["file"],
+            f"https://cdn.example.com/{self.file.file.name}")
+        self.assertIn(cdn.SIGNATURE_COOKIE, response.cookies)
+        self.assertTrue(response.cookies[cdn.POLICY_COOKIE]["httponly"])
+
+        # The client now sends the cookies, they are not signed again.
+        response = self.client.get(url)
+        self.assertNotIn(cdn.SIGNATURE_COOKIE, response.cookies)
+
+
+class UploadEventTests(TestCase):
+    def setUp(self):
+        self.file = StorageFactory.create(
+            file_name="notes.txt", file_type="text/plain",
+            upload_finished_at=None)
+        self.key = self.file.file.name
+        self.etag = LocalStorageService().get_file_metadata(self.key)["ETag"]
+        self.queue = notifications.LocalQueue()
+
+    def _event(self, key, etag, name="ObjectCreated:Post"):
+        return json.dumps({"Records": [{
+            "eventName": name,
+            "s3": {"object": {
+                "key": key.replace(" ", "+"), "size": 11,
+                "eTag": etag.strip('"')}},
+        }]})
+
+    def test_event_finishes_upload_once(self):
+        self.queue.send(self._event(self.key, self.etag))
+        self.queue.send(self._event("thumbnails/unknown.jpg", "abc"))
+
+        with mock.patch(
+            "ktg_storage.services.storage_service.get_file_metadata",
+            side_effect=AssertionError,
+        ):
+            finished = notifications.handle_messages(
+                self.queue, self.queue.receive())
+
+        self.assertEqual(finished, 1)
+        self.assertEqual(self.queue.in_flight, {})
+        self.file.refresh_from_db()
+        self.assertIsNotNone(self.file.upload_finished_at)
+        self.assertEqual(self.file.file_size, 11)
+        self.assertEqual(self.file.etag, self.etag)
+        self.assertEqual(self.file.thumbnail_source_etag, self.etag)
+
+        # The client's finish call (and a redelivered event) change nothing.
+        with mock.patch("ktg_storage.services.create_thumbnail") as thumbnail:
+            FileDirectUploadService(self.file.uploaded_by).finish(file=self.file)
+            self.queue.send(self._event(self.key, self.etag))
+            finished = notifications.handle_messages(
+                self.queue, self.queue.receive())
+
+        self.assertEqual(finished, 0)
+        thumbnail.assert_not_called()
+
+    def test_copy_event_does_not_finish_again(self):
+        finished_at = timezone.now() - timezone.timedelta(days=40)
+        Storage.objects.filter(pk=self.file.pk).update(
+            upload_finished_at=finished_at, etag='"old"', file_size=11,
+            stored_size=5, content_encoding="gzip",
+            storage_class="STANDARD_IA")
+        # Tiering copied the object in place, with a new multipart ETag.
+        self.queue.send(self._event(
+            self.key, "new-2", name="ObjectCreated:Copy"))
+
+        with mock.patch("ktg_storage.services.create_thumbnail") as thumbnail:
+            finished = notifications.handle_messages(
+                self.queue, self.queue.receive())
+
+        self.assertEqual(finished, 0)
+        self.assertEqual(self.queue.in_flight, {})
+        thumbnail.assert_not_called()
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.upload_finished_at, finished_at)
+        self.assertEqual(self.file.etag, '"old"')
+        self.assertEqual(self.file.file_size, 11)
+        self.assertEqual(self.file.content_encoding, "gzip")
+        self.assertEqual(self.file.storage_class, "STANDARD_IA")
+
+    def test_sns_wrapped_event(self):
+        body = json.dumps({
+            "Type": "Notification",
+            "Message": self._event("files/a b.txt", '"abc"'),
+        })
+
+        self.assertEqual(
+            notifications.parse_events(body),
+            [notifications.ObjectCreated("files/a b.txt", 11, "abc")])
+
+    @mock_sqs
+    def test_sqs_queue(self):
+        import boto3
+
+        client = boto3.client("sqs", region_name="eu-west-3")
+        queue_url = client.create_queue(QueueName="uploads")["QueueUrl"]
+        client.send_message(QueueUrl=queue_url, MessageBody="{}")
+
+        queue = notifications.SQSQueue(queue_url, client)
+        messages = queue.receive(wait_seconds=0)
+        queue.delete([message.receipt for message in messages])
+
+        self.assertEqual([message.body for message in messages], ["{}"])
+        self.assertEqual(queue.receive(wait_seconds=0), [])
+
+
+@mock_s3
+@override_settings(IS_USING_LOCAL_STORAGE=False, STORAGE_COMPRESS_TYPES=["text/csv"])
+class CompressedUploadTests(TestCase):
+    KEY = "files/report.csv"
+
+    def setUp(self):
+        self.s3 = S3Service()
+        self.s3.client.create_bucket(
+            Bucket=self.s3.bucket_name,
+            CreateBucketConfiguration={
+                "LocationConstraint": self.s3.client.meta.region_name},
+        )
+        for target in (
+            "services", "compression", "metadata", "icons", "variants", "views",
+            "management.commands.regenerate_thumbnails",
+        ):
+            patcher = mock.patch(
+                f"ktg_storage.{target}.storage_service", self.s3)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        icons._known_icons.clear()
+        self.addCleanup(icons._known_icons.clear)
+
+        self.data = b"id,name\n" * 10000
+        self.s3.client.put_object(
+            Bucket=self.s3.bucket_name, Key=self.KEY, Body=self.data,
+            ContentType="text/csv")
+        self.file = StorageFactory.create(
+            file=self.KEY, file_name=self.KEY, file_type="text/csv",
+            upload_finished_at=None)
+
+    def stored_object(self):
+        return self.s3.client.get_object(
+            Bucket=self.s3.bucket_name, Key=self.KEY)
+
+    def test_upload_event_after_client_finish(self):
+        upload_etag = self.s3.get_file_metadata(self.KEY)["ETag"]
+
+        file = FileDirectUploadService(self.file.uploaded_by).finish(
+            file=self.file)
+        self.assertEqual(file.content_encoding, compression.GZIP)
+        self.assertNotEqual(file.etag, upload_etag)
+
+        # The event of the original upload arrives after the client's call.
+        queue = notifications.LocalQueue()
+        queue.send(json.dumps({"Records": [{
+            "eventName": "ObjectCreated:Post",
+            "s3": {"object": {
+                "key": self.KEY, "size": len(self.data),
+                "eTag": upload_etag.strip('"')}},
+        }]}))
+        with mock.patch("ktg_storage.services.create_thumbnail") as thumbnail:
+            finished = notifications.handle_messages(queue, queue.receive())
+
+        self.assertEqual(finished, 0)
+        thumbnail.assert_not_called()
+        stored = self.stored_object()
+        self.assertEqual(stored["ContentEncoding"], compression.GZIP)
+        self.assertEqual(gzip.decompress(stored["Body"].read()), self.data)
+        self.assertEqual(
+            Storage.objects.get(pk=file.pk).stored_size, file.stored_size)
+
+    def test_compress_object(self):
+        self.file.file_size = len(self.data)
+
+        self.assertTrue(compression.compress_object(self.file))
+
+        stored = self.stored_object()
+        self.assertEqual(stored["ContentEncoding"], compression.GZIP)
+        self.assertEqual(gzip.decompress(stored["Body"].read()), self.data)
+        self.assertEqual(self.file.content_encoding, compression.GZIP)
+        self.assertEqual(self.file.stored_size, stored["ContentLength"])
+        # An encoded object is never compressed again.
+        self.assertFalse(compression.compress_object(self.file))
+
+    def test_incompressible_object_is_kept(self):
+        import os
+
+        data = os.urandom(10000)
+        self.s3.client.put_object(
+            Bucket=self.s3.bucket_name, Key=self.KEY, Body=data)
+        self.file.file_size = len(data)
+
+        self.assertFalse(compression.compress_object(self.file))
+        self.assertIsNone(self.file.content_encoding)
+        self.assertEqual(self.stored_object()["Body"].read(), data)
+
+    def test_finish_again_keeps_the_encoding(self):
+        service = FileDirectUploadService(self.file.uploaded_by)
+        file = service.finish(file=self.file)
+        stored_size = file.stored_size
+        # Forget the ETags, as if the object had been replaced.
+        Storage.objects.filter(pk=file.pk).update(etag=None, upload_etag=None)
+
+        file = service.finish(file=file)
+
+        self.assertEqual(file.content_encoding, compression.GZIP)
+        self.assertEqual(file.file_size, len(self.data))
+        self.assertEqual(file.stored_size, stored_size)
+        self.assertNotIn("zip", file.thumbnail)
+        self.assertEqual(
+            gzip.decompress(self.stored_object()["Body"].read()), self.data)
+
+    def test_regenerated_thumbnail_reads_decoded_content(self):
+        from ktg_storage.management.commands import regenerate_thumbnails
+
+        file = FileDirectUploadService(self.file.uploaded_by).finish(
+            file=self.file)
+
+        result = regenerate_thumbnails._regenerate(
+            (file.id, self.KEY, None, None, file.content_encoding),
+            (128, 128), True)
+
+        self.assertEqual(result[1], regenerate_thumbnails.REGENERATED)
+        self.assertNotIn("zip", result[2])
+
+    def test_download_decompresses_for_clients_without_the_encoding(self):
+        file = FileDirectUploadService(self.file.uploaded_by).finish(
+            file=self.file)
+        client = APIClient()
+        client.force_authenticate(user=file.uploaded_by)
+        url = reverse("ktg_storage:download", kwargs={"pk": file.pk})
+
+        response = client.get(url, HTTP_ACCEPT_ENCODING="br")
+        self.assertNotIn("Content-Encoding", response)
+        self.assertEqual(b"".join(response.streaming_content), self.data)
+
+        response = client.get(url, HTTP_ACCEPT_ENCODING="gzip, br")
+        self.assertEqual(response["Content-Encoding"], compression.GZIP)
+        self.assertEqual(
+            gzip.decompress(b"".join(response.streaming_content)), self.data)
+
+
+class MediaMetadataTests(TestCase):
+    def test_image_dimensions_are_read_from_header(self):
+        from PIL import Image
+
+        buffer = io.BytesIO()
+        Image.new("RGB", (300, 200)).save(buffer, format="PNG")
+
+        metadata = _image_metadata("files/image.png", buffer.getvalue()[:1024])
+
+        self.assertEqual(metadata["width"], 300)
+        self.assertEqual(metadata["height"], 200)
+        self.assertEqual(metadata["format"], "PNG")
+
+
+class PdfFinishTests(TestCase):
+    def setUp(self):
+        import fitz
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.service = LocalStorageService(self.directory.name, "/media/")
+        for target in ("services", "metadata", "icons"):
+            patcher = mock.patch(
+                f"ktg_storage.{target}.storage_service", self.service)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        document = fitz.open()
+        document.new_page(width=200, height=100)
+        self.service.upload_fileobj(
+            io.BytesIO(document.tobytes()), "files/doc.pdf", "application/pdf")
+        self.file = StorageFactory.create(
+            file="files/doc.pdf", file_type="application/pdf",
+            upload_finished_at=None)
+
+    def test_pdf_is_read_once(self):
+        with mock.patch.object(
+            self.service, "open_file_buffer",
+            wraps=self.service.open_file_buffer,
+        ) as open_buffer, mock.patch.object(
+            self.service, "get_file_content", side_effect=AssertionError
+        ), mock.patch.object(
+            self.service, "get_cached_file_path",
+            wraps=self.service.get_cached_file_path,
+        ) as cached_path:
+            file = FileDirectUploadService(self.file.uploaded_by).finish(
+                file=self.file)
+
+        open_buffer.assert_called_once_with("files/doc.pdf")
+        # Only by open_file_buffer.
+        cached_path.assert_called_once_with("files/doc.pdf")
+        self.assertEqual(file.media_metadata["page_count"], 1)
+        self.assertEqual(file.media_metadata["width"], 200)
+        self.assertIsNotNone(file.thumbnail)
+
+
+class PlaceholderTests(TestCase):
+    def test_placeholder_is_tiny_jpeg_data_uri(self):
+        from PIL import Image
+
+        placeholder = create_placeholder(Image.new("RGBA", (1200, 800)))
+
+        self.assertTrue(placeholder.startswith("data:image/jpeg;base64,"))
+        self.assertLess(len(placeholder), 512)
+
+
+class IconThumbnailTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.service = LocalStorageService(self.directory.name, "/media/")
+        for target in ("ktg_storage.services", "ktg_storage.icons"):
+            patcher = mock.patch(f"{target}.storage_service", self.service)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        icons._known_icons.clear()
+        self.addCleanup(icons._known_icons.clear)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_unsupported_files_share_one_icon(self):
+        for name in ("files/a.txt", "files/b.txt"):
+            self.service.upload_fileobj(
+                io.BytesIO(b"plain text"), name, "text/plain")
+
+        with mock.patch.object(
+            self.service, "upload_fileobj", wraps=self.service.upload_fileobj
+        ) as upload:
+            first = create_thumbnail("files/a.txt")
+            second = create_thumbnail("files/b.txt")
+
+        self.assertEqual(first["thumbnail"], "icons/doc-128x128.png")
+        self.assertEqual(second["thumbnail"], first["thumbnail"])
+        self.assertEqual(upload.call_count, 1)
+        self.assertTrue(self.service.file_exists(first["thumbnail"]))
+
+    def test_icon_categories(self):
+        self.assertEqual(icons.icon_category("audio/mpeg"), "audio")
+        self.assertEqual(icons.icon_category("application/zip"), "zip")
+        self.assertEqual(icons.icon_category(
+            "application/vnd.openxmlformats-officedocument."
+            "wordprocessingml.document"), "doc")
+        self.assertEqual(
+            icons.icon_category("application/octet-stream"), icons.GENERIC)
+
+
+class RegenerateThumbnailsTests(TestCase):
+    def test_failing_row_returns_failed_result(self):
+        from botocore.exceptions import EndpointConnectionError
+        from ktg_storage.management.commands import regenerate_thumbnails
+
+        with mock.patch.object(
+            regenerate_thumbnails.storage_service, "get_file_metadata",
+            side_effect=EndpointConnectionError(endpoint_url="https://s3"),
+        ):
+            result = regenerate_thumbnails._regenerate(
+                ("id", "files/a.png", None, None, None), (128, 128), False)
+
+        self.assertEqual(result[:2], ("id", regenerate_thumbnails.FAILED))
+        self.assertIn("EndpointConnectionError", result[5])
+
+    def test_workers_are_forked_before_rows_are_read(self):
+        from concurrent.futures import Future
+        from ktg_storage.management.commands import regenerate_thumbnails
+
+        calls = []
+        future = Future()
+        future.set_result(None)
+        executor = mock.MagicMock()
+        executor.__enter__.return_value = executor
+        executor.submit.side_effect = lambda *args: calls.append("submit") or future
+        queryset = mock.Mock()
+        queryset.iterator.side_effect = lambda **kwargs: calls.append("rows") or []
+
+        with mock.patch.object(
+            regenerate_thumbnails, "ProcessPoolExecutor", return_value=executor,
+        ), mock.patch.object(
+            regenerate_thumbnails.Command, "get_queryset", return_value=queryset,
+        ):
+            call_command("regenerate_thumbnails", stdout=io.StringIO())
+
+        self.assertEqual(calls, ["submit", "rows"])
+
+
+class CompressionTests(TestCase):
+    def test_gzip_round_trip_is_streamed(self):
+        data = b"id,name\n" * 100000
+        chunks = compression.iter_chunks(io.BytesIO(data), chunk_size=4096)
+
+        compressed = list(compression.compress_chunks(chunks, compression.GZIP))
+        restored = b"".join(
+            compression.decompress_chunks(compressed, compression.GZIP))
+
+        self.assertEqual(restored, data)
+        self.assertLess(sum(map(len, compressed)), len(data) // 10)
+
+    @override_settings(
+        IS_USING_LOCAL_STORAGE=False,
+        STORAGE_COMPRESS_TYPES=["text/*", "application/json"],
+    )
+    def test_should_compress_matches_configured_types(self):
+        self.assertTrue(compression.should_compress("text/csv; charset=utf-8"))
+        self.assertTrue(compression.should_compress("application/json"))
+        self.assertFalse(compression.should_compress("image/jpeg"))
+
+    @override_settings(IS_USING_LOCAL_STORAGE=True, STORAGE_COMPRESS_TYPES=["text/*"])
+    def test_local_storage_is_not_compressed(self):
+        self.assertFalse(compression.should_compress("text/csv"))
+
+    def test_accepts_encoding(self):
+        self.assertTrue(compression.accepts_encoding("gzip, br", "gzip"))
+        self.assertFalse(compression.accepts_encoding("gzip;q=0, br", "gzip"))
+        self.assertFalse(compression.accepts_encoding("br", "zstd"))
+
+
+class AccessTrackingTests(TestCase):
+    def test_reads_are_flushed_in_one_update(self):
+        file = StorageFactory.create()
+        updated_at = file.updated_at
+        tracker = AccessTracker(flush_interval=3600)
+
+        tracker.record(file.file_name)
+        tracker.record(file.file_name)
+        file.refresh_from_db()
+        self.assertIsNone(file.last_accessed_at)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(tracker.flush(), 1)
+
+        file.refresh_from_db()
+        self.assertIsNotNone(file.last_accessed_at)
+        self.assertEqual(file.updated_at, updated_at)
+
+    def test_cold_files_use_last_access(self):
+        now = timezone.now()
+        cold = StorageFactory.create(
+            last_accessed_at=now - timezone.timedelta(days=40))
+        StorageFactory.create(last_accessed_at=now - timezone.timedelta(days=1))
+
+        files = tiering.cold_files(30, "STANDARD_IA")
+
+        self.assertEqual(list(files.values_list("id", flat=True)), [cold.id])
+
+    def test_storage_class_change_bumps_updated_at(self):
+        file = StorageFactory.create()
+        updated_at = file.updated_at
+
+        tiering.mark_storage_class([file.id], "GLACIER")
+
+        file.refresh_from_db()
+        self.assertEqual(file.storage_class, "GLACIER")
+        self.assertGreater(file.updated_at, updated_at)
+
+
+class KeyShardingTests(TestCase):
+    def test_keys_are_sharded_by_name_hash(self):
+        with override_settings(STORAGE_KEY_SHARD_DEPTH=2):
+            key = utils.reshard_key("files/report.csv")
+            thumbnail = utils.thumbnail_generate_path(key)
+
+        self.assertRegex(key, r"^files/[0-9a-f]{2}/[0-9a-f]{2}/report\.csv$")
+        self.assertRegex(
+            thumbnail, r"^thumbnails/[0-9a-f]{2}/[0-9a-f]{2}/report\.jpg$")
+        self.assertEqual(utils.reshard_key(key, 0), "files/report.csv")
+
+    def test_user_prefix_is_kept(self):
+        with override_settings(STORAGE_KEY_SHARD_DEPTH=1):
+            key = utils.reshard_key("files/users/7/report.csv")
+
+        self.assertRegex(key, r"^files/users/7/[0-9a-f]{2}/report\.csv$")
+        self.assertEqual(
+            utils.reshard_key(key, 0), "files/users/7/report.csv")
+
+    def test_variants_follow_the_shards_of_the_file_key(self):
+        with override_settings(STORAGE_KEY_SHARD_DEPTH=2):
+            key = utils.reshard_key("files/users/7/photo.png")
+
+        shards = key.split("/")[3:5]
+        with override_settings(STORAGE_KEY_SHARD_DEPTH=1):
+            self.assertEqual(
+                utils.variants_generate_prefix(key),
+                f"variants/{shards[0]}/{shards[1]}/photo/")
+            self.assertEqual(
+                utils.variants_generate_prefix("files/photo.png"),
+                "variants/photo/")
+
+    @override_settings(STORAGE_KEY_SHARD_DEPTH=2)
+    def test_legacy_keys_resolve_to_sharded_file(self):
+        key = utils.reshard_key("files/report.csv")
+        StorageFactory.create(file=key, file_name=key)
+
+        self.assertEqual(Storage.objects.resolve_key("files/report.csv"), key)
+        self.assertEqual(Storage.objects.resolve_key(key), key)
+
+
+@mock_s3
+@override_settings(IS_USING_LOCAL_STORAGE=False, STORAGE_LIFECYCLE_EXPIRY=True)
+class LifecycleExpiryTests(TestCase):
+    def setUp(self):
+        self.s3 = S3Service()
+        self.s3.client.create_bucket(
+            Bucket=self.s3.bucket_name,
+            CreateBucketConfiguration={
+                "LocationConstraint": self.s3.client.meta.region_name},
+        )
+        patcher = mock.patch.object(expiry, "s3_service", self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.file = StorageFactory.create(
+            file="files/report.csv",
+            upload_finished_at=timezone.now(),
+            expire_at=timezone.now() + timezone.timedelta(days=20),
+        )
+        self.s3.client.put_object(
+            Bucket=self.s3.bucket_name, Key="files/report.csv", Body=b"x")
+
+    def object_tags(self):
+        return self.s3.get_object_tags("files/report.csv")
+
+    def test_tags_object_with_expiry_bucket(self):
+        self.assertTrue(expiry.apply_expiry_tag(self.file))
+        self.assertEqual(self.object_tags(), {expiry.EXPIRY_TAG: "30d"})
+
+        self.file.expire_at = timezone.now() + timezone.timedelta(days=5000)
+        expiry.apply_expiry_tag(self.file)
+
+        self.file.refresh_from_db()
+        self.assertIsNone(self.file.expiry_tag)
+        self.assertEqual(self.object_tags(), {})
+
+    def test_expiry_tag_is_not_part_of_the_api(self):
+        expiry.apply_expiry_tag(self.file)
+
+        client = APIClient()
+        client.force_authenticate(user=self.file.uploaded_by)
+        response = client.patch(
+            reverse("ktg_storage:update", kwargs={"pk": self.file.pk}),
+            {"expiry_tag": "1d", "reserved_size": 1}, format="json")
+
+        self.assertNotIn("expiry_tag", response.json())
+        self.assertNotIn("reserved_size", response.json())
+        self.file.refresh_from_db()
+        self.assertEqual(self.file.expiry_tag, "30d")
+        self.assertIsNone(self.file.reserved_size)
+
+    def test_variants_carry_the_expiry_tag(self):
+        from PIL import Image
+
+        buffer = io.BytesIO()
+        Image.new("RGB", (300, 200)).save(buffer, format="PNG")
+        self.s3.client.put_object(
+            Bucket=self.s3.bucket_name, Key="files/report.csv",
+            Body=buffer.getvalue())
+        rendered = variants.variant_key(self.file, 64, "png")
+        self.s3.client.put_object(
+            Bucket=self.s3.bucket_name, Key=rendered, Body=b"x")
+
+        expiry.apply_expiry_tag(self.file)
+
+        self.assertEqual(
+            self.s3.get_object_tags(rendered), {expiry.EXPIRY_TAG: "30d"})
+
+        with mock.patch.object(variants, "storage_service", self.s3):
+            variants.get_variant(self.file, 128, "png")
+
+        self.assertEqual(
+            self.s3.get_object_tags(variants.variant_key(self.file, 128, "png")),
+            {expiry.EXPIRY_TAG: "30d"})
+
+    def test_install_rules_keeps_other_rules(self):
+        other = {
+            "ID": "abort-uploads",
+            "Filter": {"Prefix": ""},
+            "Status": "Enabled",
+            "AbortIncompleteMultipartUpload": {"DaysAfterInitiation": 1},
+        }
+        self.s3.put_lifecycle_rules([other])
+
+        expiry.install_rules()
+        expiry.install_rules()
+
+        rule_ids = [rule["ID"] for rule in self.s3.get_lifecycle_rules()]
+        self.assertEqual(
+            rule_ids,
+            ["abort-uploads"] + [
+                f"{expiry.RULE_ID_PREFIX}{days}d" for days in expiry.DEFAULT_BUCKETS
+            ],
+        )
+
+    def test_mark_expired_soft_deletes_tagged_files(self):
+        expiry.apply_expiry_tag(self.file)
+        Storage.objects.filter(pk=self.file.pk).update(
+            expire_at=timezone.now() - timezone.timedelta(minutes=1))
+        untagged = StorageFactory.create(
+            expire_at=timezone.now() - timezone.timedelta(minutes=1))
+
+        ids = list(expiry.expired_files().values_list("id", flat=True))
+        self.assertEqual(ids, [self.file.id])
+        self.assertEqual(expiry.mark_expired(ids), 1)
+
+        self.assertFalse(Storage.objects.filter(pk=self.file.pk).exists())
+        self.assertTrue(Storage.objects.filter(pk=untagged.pk).exists())
+
+
+@mock_s3
+@override_settings(IS_USING_LOCAL_STORAGE=False)
+class StorageTieringTests(TestCase):
+    def setUp(self):
+        self.s3 = S3Service()
+        self.s3.client.create_bucket(
+            Bucket=self.s3.bucket_name,
+            CreateBucketConfiguration={
+                "LocationConstraint": self.s3.client.meta.region_name},
+        )
+        for module in ("tiering", "expiry", "views", "serializers"):
+            patcher = mock.patch(f"ktg_storage.{module}.s3_service", self.s3)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.user = UserFactory.create()
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def create_file(self, body: bytes, **kwargs) -> Storage:
+        self.s3.client.put_object(
+            Bucket=self.s3.bucket_name, Key="files/report.csv", Body=body,
+            Tagging=f"{expiry.EXPIRY_TAG}=30d")
+        etag = self.s3.get_file_metadata("files/report.csv")["ETag"]
+
+        return StorageFactory.create(
+            file="files/report.csv", file_name="files/report.csv",
+            uploaded_by=self.user, stored_size=len(body), etag=etag,
+            thumbnail_source_etag=etag, expiry_tag="30d", **kwargs)
+
+    def test_archived_files_have_no_url(self):
+        file = self.create_file(b"x", storage_class="GLACIER")
+
+        self.assertIsNone(FileSerializer(file).data["file"])
+
+        with mock.patch.object(self.s3, "create_presigned_urls") as sign:
+            response = self.client.get(reverse("ktg_storage:list"))
+
+        self.assertIsNone(response.json()[0]["file"])
+        sign.assert_not_called()
+
+    def test_download_only_requests_the_restore(self):
+        file = self.create_file(b"x", storage_class="GLACIER")
+        url = reverse("ktg_storage:download", kwargs={"pk": file.id})
+
+        with mock.patch.object(
+            tiering, "request_restore", return_value=False
+        ) as request_restore, mock.patch.object(
+            self.s3, "set_storage_class"
+        ) as set_storage_class:
+            response = self.client.get(url)
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        request_restore.assert_called_once_with("files/report.csv")
+        set_storage_class.assert_not_called()
+        file.refresh_from_db()
+        self.assertEqual(file.storage_class, "GLACIER")
+
+    def test_multipart_copy_keeps_etag_and_expiry_tag(self):
+        file = self.create_file(b"x" * (tiering.MULTIPART_COPY_THRESHOLD + 1))
+        uploaded_etag = file.etag
+
+        self.assertTrue(tiering.transition(file, "STANDARD_IA"))
+
+        etag = self.s3.get_file_metadata("files/report.csv")["ETag"]
+        self.assertNotEqual(etag, uploaded_etag)
+        file.refresh_from_db()
+        self.assertEqual(file.etag, etag)
+        self.assertEqual(file.thumbnail_source_etag, etag)
+        self.assertEqual(
+            self.s3.get_object_tags("files/report.csv"),
+            {expiry.EXPIRY_TAG: "30d"})
+
+
+@override_settings(STORAGE_READ_REPLICAS=["replica"])
+class ReplicaRouterTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory.create()
+        self.router = routers.StorageReplicaRouter()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_reads_go_to_replica_until_the_user_writes(self):
+        self.assertIsNone(self.router.db_for_read(Storage))
+
+        with routers.read_replica(self.user):
+            self.assertEqual(self.router.db_for_read(Storage), "replica")
+            self.assertIsNone(self.router.db_for_read(type(self.user)))
+
+        routers.mark_recent_write(self.user)
+
+        with routers.read_replica(self.user):
+            self.assertIsNone(self.router.db_for_read(Storage))
+
+    def test_writes_through_views_make_user_sticky(self):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        file = StorageFactory.create(uploaded_by=self.user)
+        url = reverse('ktg_storage:update', kwargs={'pk': file.id})
+
+        # Single database here, the router is not installed.
+        client.get(url)
+        self.assertFalse(routers.reads_from_primary(self.user))
+
+        client.patch(url, {"expire_at": timezone.now()})
+        self.assertTrue(routers.reads_from_primary(self.user))
+
+
+class PartitioningTests(TestCase):
+    def test_monthly_partition_names(self):
+        start = partitioning.add_months(datetime.date(2024, 11, 15), 2)
+
+        self.assertEqual(start, datetime.date(2025, 1, 1))
+        self.assertEqual(
+            partitioning.partition_name("ktg_storage_storage", start),
+            "ktg_storage_storage_p2025_01",
+        )
+
+    def test_expiry_scan_is_bounded_by_created_at(self):
+        expire_at = timezone.now()
+        recent = StorageFactory.create(expire_at=expire_at)
+        old = StorageFactory.create(expire_at=expire_at)
+        Storage.objects.filter(pk=old.pk).update(
+            created_at=expire_at - timezone.timedelta(days=40))
+
+        self.assertEqual(Storage.objects.get_files_that_expire_today().count(), 2)
+
+        with override_settings(STORAGE_MAX_RETENTION_DAYS=30):
+            self.assertEqual(
+                list(Storage.objects.get_files_that_expire_today()), [recent])
+
+
+class StorageAdminTests(TestCase):
+    def setUp(self):
+        self.admin_user = UserFactory.create(is_staff=True, is_superuser=True)
+        self.user = UserFactory.create()
+        self.file = StorageFactory.create(
+            uploaded_by=self.user, thumbnail="https://bucket/thumb.jpg")
+        StorageFactory.create(uploaded_by=self.admin_user)
+
+    def changelist(self, **params):
+        request = RequestFactory().get("/", params)
+        request.user = self.admin_user
+        model_admin = AttachmentAdmin(Storage, admin.site)
+
+        return model_admin.get_changelist_instance(request)
+
+    def test_filters_by_username_and_created_range(self):
+        changelist = self.changelist(uploaded_by=self.user.username)
+        self.assertEqual(list(changelist.result_list), [self.file])
+
+        changelist = self.changelist(created="today")
+        self.assertEqual(changelist.result_count, 2)
+
+        changelist = self.changelist(created="2000-01")
+        self.assertEqual(changelist.result_count, 0)
+
+    def test_thumbnail_preview_uses_stored_url(self):
+        model_admin = AttachmentAdmin(Storage, admin.site)
+
+        self.assertIn(
+            'src="https://bucket/thumb.jpg"',
+            model_admin.thumbnail_preview(self.file),
+        )
+
+
+@override_settings(STORAGE_USER_QUOTA=1000)
+class StorageQuotaTests(TestCase):
+    def setUp(self):
+        self.user = UserFactory.create()
+
+    def start(self, file_size):
+        return FileDirectUploadService(self.user).start({
+            "file_name": "report.pdf",
+            "file_type": "application/pdf",
+            "user": self.user,
+            "file_size": file_size,
+        })["file"]
+
+    def test_start_reserves_declared_size(self):
+        file = self.start(600)
+
+        usage = quota.get_usage(self.user)
+        self.assertEqual(usage.reserved_bytes, 600)
+        self.assertEqual(file.reserved_size, 600)
+
+    def test_start_rejects_uploads_over_quota(self):
+        self.start(600)
+
+        with self.assertRaises(ValidationError):
+            self.start(600)
+
+    def test_commit_and_release_update_usage(self):
+        file = self.start(600)
+
+        quota.commit(self.user, file.reserved_size, 500)
+        file.upload_finished_at = timezone.now()
+        file.file_size = 500
+        file.save()
+
+        usage = quota.get_usage(self.user)
+        self.assertEqual((usage.used_bytes, usage.reserved_bytes), (500, 0))
+
+        soft_delete_file(file)
+
+        usage.refresh_from_db()
+        self.assertEqual(usage.used_bytes, 0)
+
+    def test_file_size_is_read_only(self):
+        quota.charge(self.user, 300)
+        file = self.start(600)
+        quota.commit(self.user, file.reserved_size, 500)
+        file.upload_finished_at = timezone.now()
+        file.file_size = 500
+        file.save()
+
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        url = reverse("ktg_storage:update", kwargs={"pk": file.pk})
+        client.patch(url, {"file_size": 1000000000}, format="json")
+
+        file.refresh_from_db()
+        self.assertEqual(file.file_size, 500)
+
+        client.delete(url)
+        self.assertEqual(quota.get_usage(self.user).used_bytes, 300)
+
+    def test_etag_is_read_only(self):
+        file = StorageFactory.create(uploaded_by=self.user, etag='"abc"')
+
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        client.patch(
+            reverse("ktg_storage:update", kwargs={"pk": file.pk}),
+            {"etag": '"forged"'}, format="json")
+
+        file.refresh_from_db()
+        self.assertEqual(file.etag, '"abc"')
+
+    def test_deleting_abandoned_upload_releases_reservation(self):
+        file = self.start(600)
+
+        soft_delete_file(file)
+
+        self.assertEqual(quota.get_usage(self.user).reserved_bytes, 0)
+        self.assertIsNone(file.reserved_size)
@@ -0,0 +1,167 @@
+"""
+Access-aware storage-class tiering.
+
+S3 lifecycle rules can only transition on object age, not on when an object
+was last read, so tiering is driven by `Storage.last_accessed_at` (see
+`ktg_storage.access`) instead. `STORAGE_TIERING_RULES` maps days without a
+read to a storage class; the `tier_storage` command applies them in batches
+and moves files read again since they were tiered back to STANDARD.
+
+Archived objects (GLACIER, DEEP_ARCHIVE) can not be read until they are
+restored: requests only ask for a restore (`request_restore`) and serve the
+temporary restored copy, the copy back to STANDARD is left to `tier_storage`.
+"""
+from datetime import timedelta
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+from django.conf import settings
+from django.db.models import F
+from django.db.models import Q
+from django.db.models import QuerySet
+from django.utils import timezone
+from django.utils.cache import quote_etag
+
+from ktg_storage import expiry
+from ktg_storage.client import s3_service
+from ktg_storage.enums import StorageClass
+from ktg_storage.models import Storage
+
+DEFAULT_RULES = [
+    (30, StorageClass.STANDARD_IA),
+    (90, StorageClass.GLACIER_IR),
+]
+
+# How long a restored copy of an archived object stays readable.
+RESTORE_DAYS = 7
+
+# boto3's managed copy is a multipart copy above this size, which gives the
+# object a new ETag and does not copy its tags.
+MULTIPART_COPY_THRESHOLD = 8 * 1024 * 1024
+
+
+def get_rules() -> List[Tuple[int, str]]:
+    """
+    Rules ordered coldest first, so a file that qualifies for several
+    classes is moved once, straight to the coldest one.
+    """
+    rules = getattr(settings, "STORAGE_TIERING_RULES", DEFAULT_RULES)
+
+    return sorted(rules, key=lambda rule: rule[0], reverse=True)
+
+
+def _tiered_files() -> QuerySet[Storage]:
+    return Storage.objects.filter(
+        upload_finished_at__isnull=False,
+    ).exclude(file="").exclude(file__isnull=True).order_by()
+
+
+def cold_files(days: int, storage_class: str) -> QuerySet[Storage]:
+    """
+    Files not read for `days` that are still in a warmer class.
+    """
+    cutoff = timezone.now() - timedelta(days=days)
+    warmer = StorageClass.TIERS[:StorageClass.TIERS.index(storage_class)]
+
+    return _tiered_files().filter(storage_class__in=warmer).filter(
+        Q(last_accessed_at__lt=cutoff)
+        | Q(last_accessed_at__isnull=True, upload_finished_at__lt=cutoff)
+    )
+
+
+def files_to_restore() -> QuerySet[Storage]:
+    """
+    Tiered files that have been read again since they were moved.
+    """
+    return _tiered_files().exclude(
+        storage_class=StorageClass.STANDARD,
+    ).filter(last_accessed_at__gt=F("storage_class_changed_at"))
+
+
+def refresh_copy(
+    s3_key: str, stored_size: Optional[int], expiry_tag: Optional[str]
+) -> Optional[str]:
+    """
+    Tag a multipart copy again and return its new ETag. Returns None when
+    the copy kept the ETag and tags of its source.
+    """
+    if stored_size is not None and stored_size < MULTIPART_COPY_THRESHOLD:
+        return None
+
+    metadata = s3_service.get_file_metadata(s3_key)
+    if metadata is None:
+        return None
+
+    if expiry_tag:
+        expiry.tag_object(s3_key, expiry_tag)
+
+    return quote_etag(metadata["ETag"])
+
+
+def _copied(file: Storage) -> None:
+    etag = refresh_copy(file.file.name, file.stored_size, file.expiry_tag)
+    if etag is None or etag == file.etag:
+        return
+
+    updates = {"etag": etag}
+    if file.thumbnail_source_etag == file.etag:
+        # The thumbnail was rendered from the same content.
+        updates["thumbnail_source_etag"] = etag
+    Storage.objects.filter(pk=file.pk).update(**updates)
+
+
+def transition(file: Storage, storage_class: str) -> bool:
+    if not s3_service.set_storage_class(file.file.name, storage_class):
+        return False
+
+    _copied(file)
+
+    return True
+
+
+def request_restore(s3_key: str) -> bool:
+    """
+    Request a temporary restored copy of an archived object, once. Returns
+    whether the restored copy can be read already.
+    """
+    metadata = s3_service.get_file_metadata(s3_key)
+    if metadata is None:
+        return False
+
+    restore_status = metadata["Restore"]
+    if not restore_status:
+        s3_service.restore_object(s3_key, RESTORE_DAYS)
+        return False
+
+    return 'ongoing-request="true"' not in restore_status
+
+
+def restore(file: Storage) -> bool:
+    """
+    Move a file back to STANDARD. Archived objects are restored first: the
+    first call requests the restore and returns False, later calls copy
+    the restored object once it is available. Returns whether the object is
+    now in STANDARD.
+    """
+    if file.storage_class == StorageClass.STANDARD:
+        return True
+
+    if (
+        file.storage_class in StorageClass.ARCHIVED
+        and not request_restore(file.file.name)
+    ):
+        return False
+
+    return transition(file, StorageClass.STANDARD)
+
+
+def mark_storage_class(file_ids: Iterable, storage_class: str) -> int:
+    now = timezone.now()
+
+    return Storage.objects.filter(id__in=list(file_ids)).update(
+        storage_class=storage_class,
+        storage_class_changed_at=now,
+        updated_at=now,
+    )
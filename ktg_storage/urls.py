@@ -19,7 +19,12 @@ urlpatterns = [
         name="direct_local_upload",
     ),
     path("all/", views.GetAllFileView.as_view(), name="list"),
+    path("search/", views.FileSearchView.as_view(), name="search"),
     path("files/<str:pk>/", views.FileUpdateView.as_view(), name="update"),
+    path("files/<str:pk>/download/", views.FileDownloadView.as_view(),
+         name="download"),
+    path("files/<str:pk>/image/", views.FileImageVariantView.as_view(),
+         name="image_variant"),
     path("expired-files/", views.ExpiredFileListView.as_view(), name="expired-files"),
     path("generate-presigned-url/", views.CreatePresignedUrl.as_view(),
          name="create_presigned_url"),
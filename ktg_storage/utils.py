@@ -1,3 +1,4 @@
+import hashlib
 import pathlib
 from uuid import uuid4
 import typing
@@ -7,6 +8,13 @@ from django.urls import reverse
 if typing.TYPE_CHECKING:
     from ktg_storage.models import Storage
 
+FILES_PREFIX = "files"
+THUMBNAILS_PREFIX = "thumbnails"
+ICONS_PREFIX = "icons"
+VARIANTS_PREFIX = "variants"
+# Per-user directory under FILES_PREFIX, used with CDN delivery.
+USERS_DIR = "users"
+
 
 def file_generate_name(original_file_name):
     extension = pathlib.Path(original_file_name).suffix
@@ -14,8 +22,96 @@ def file_generate_name(original_file_name):
     return f"{uuid4().hex}{extension}"
 
 
+def shard_depth() -> int:
+    return getattr(settings, "STORAGE_KEY_SHARD_DEPTH", 0)
+
+
+def key_shard(name: str, depth: typing.Optional[int] = None) -> str:
+    """
+    Hash-derived prefix such as "ab/cd/" for `name`, spreading keys over
+    256 ** depth prefixes so bursts are not throttled on a single one.
+    Hashing keeps shards even for names that are not random, like
+    thumbnails named after their source.
+    """
+    depth = shard_depth() if depth is None else depth
+    digest = hashlib.sha1(name.encode()).hexdigest()
+
+    return "".join(f"{digest[index * 2:index * 2 + 2]}/" for index in range(depth))
+
+
+def sharded_key(prefix: str, name: str, depth: typing.Optional[int] = None) -> str:
+    return f"{prefix}/{key_shard(name, depth)}{name}"
+
+
+def _split_key(key: str) -> typing.Tuple[str, str]:
+    """
+    Split `key` into its prefix and the "<shards>/<name>" part, e.g.
+    "files/users/7/ab/<name>" -> ("files/users/7", "ab/<name>").
+    """
+    prefix, _, rest = key.partition("/")
+
+    owner, _, owned = rest.partition("/")
+    if prefix == FILES_PREFIX and owner == USERS_DIR and "/" in owned:
+        # Keep the owner's directory, files/users/<id>/<shards>/<name>.
+        user_id, _, rest = owned.partition("/")
+        prefix = user_files_prefix(user_id)
+
+    return prefix, rest
+
+
+def reshard_key(key: str, depth: typing.Optional[int] = None) -> str:
+    """
+    The key `key` would have at shard `depth`, e.g. "files/<name>" ->
+    "files/ab/cd/<name>". Depth 0 gives the legacy, unsharded key.
+    """
+    prefix, rest = _split_key(key)
+    if not rest:
+        return key
+
+    return sharded_key(prefix, rest.rsplit("/", 1)[-1], depth)
+
+
+def user_files_prefix(user_id) -> str:
+    return f"{FILES_PREFIX}/{USERS_DIR}/{user_id}"
+
+
 def file_generate_upload_path(instance: "Storage", filename):
-    return f"files/{instance.file_name}"
+    prefix = FILES_PREFIX
+    # With CDN delivery each user's files live under their own prefix, the
+    # resource their signed cookies grant (ktg_storage.cdn).
+    if getattr(settings, "STORAGE_CDN_DOMAIN", None) and instance.uploaded_by_id:
+        prefix = user_files_prefix(instance.uploaded_by_id)
+
+    return sharded_key(prefix, instance.file_name)
+
+
+def thumbnail_generate_path(s3_key: str) -> str:
+    thumbnail_filename = "{}.jpg".format(
+        s3_key.split("/")[-1].rsplit(".", 1)[0]
+    )
+
+    return sharded_key(THUMBNAILS_PREFIX, thumbnail_filename)
+
+
+def variants_generate_prefix(s3_key: str) -> str:
+    """
+    Prefix shared by every image variant of the object (ktg_storage.variants).
+    It reuses the shards of the object's own key rather than the current
+    STORAGE_KEY_SHARD_DEPTH, so the variants are found for as long as the
+    object keeps its key.
+    """
+    _, rest = _split_key(s3_key)
+    shards, _, name = (rest or s3_key).rpartition("/")
+    stem = name.rsplit(".", 1)[0]
+    if shards:
+        stem = f"{shards}/{stem}"
+
+    return f"{VARIANTS_PREFIX}/{stem}/"
+
+
+def icon_generate_path(category: str, size: typing.Tuple[int, int]) -> str:
+    # Shared by every file of the category, so never sharded.
+    return f"{ICONS_PREFIX}/{category}-{size[0]}x{size[1]}.png"
 
 
 def file_generate_local_upload_url(*, file_id: str):
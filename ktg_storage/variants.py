@@ -0,0 +1,264 @@
+"""
+On-the-fly image variants (resized / re-encoded copies of `Storage` images).
+
+Variants are rendered on first request and stored under a deterministic
+derived key (`variant_key`), so every later request, from any process, is a
+plain read. Each process also keeps recently served variants in a bounded
+in-memory LRU, and concurrent misses for the same variant are coalesced so
+it is rendered only once per process.
+
+Widths and formats are restricted to `STORAGE_VARIANT_WIDTHS` and
+`STORAGE_VARIANT_FORMATS`, which bounds the number of objects a file can
+produce. All variants of a file share one prefix: they carry the file's
+lifecycle expiry tag and are deleted with the file, when it is uploaded
+again and when shard_storage_keys moves it (`delete_variants`).
+"""
+import logging
+import mmap
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+from django.conf import settings
+from PIL import Image
+from PIL import ImageOps
+
+from ktg_storage import compression
+from ktg_storage import expiry
+from ktg_storage.client import storage_service
+from ktg_storage.instrumentation import stage
+from ktg_storage.utils import variants_generate_prefix
+
+DEFAULT_WIDTHS = [64, 128, 256, 512, 1024, 2048]
+
+# format name -> (PIL format, content type)
+FORMATS: Dict[str, Tuple[str, str]] = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+    "png": ("PNG", "image/png"),
+}
+
+QUALITY = 82
+
+
+def allowed_widths():
+    return getattr(settings, "STORAGE_VARIANT_WIDTHS", DEFAULT_WIDTHS)
+
+
+def allowed_formats():
+    return getattr(settings, "STORAGE_VARIANT_FORMATS", list(FORMATS))
+
+
+def variant_key(file, width: int, image_format: str) -> str:
+    """
+    Derived key of a variant. The upload time is part of the name, so a
+    re-uploaded file never serves variants of its previous content.
+    """
+    version = int(file.upload_finished_at.timestamp())
+
+    return (
+        f"{variants_generate_prefix(file.file.name)}"
+        f"{version}-w{width}.{image_format}"
+    )
+
+
+def has_variants(file) -> bool:
+    """
+    Whether variants may have been rendered for the file, only finished
+    image uploads have them.
+    """
+    return bool(
+        file.file
+        and file.upload_finished_at
+        and (file.file_type or "").startswith("image/")
+    )
+
+
+def delete_variants(file) -> List[str]:
+    """
+    Delete every stored variant of the file. Returns the keys that could
+    not be deleted.
+    """
+    if not has_variants(file):
+        return []
+
+    keys = storage_service.list_files(variants_generate_prefix(file.file.name))
+
+    return storage_service.delete_files(keys) if keys else []
+
+
+class VariantCache:
+    """
+    Thread-safe LRU of rendered variants, bounded by total size in bytes.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            content = self._entries.get(key)
+            if content is not None:
+                self._entries.move_to_end(key)
+
+            return content
+
+    def put(self, key: str, content: bytes) -> None:
+        if len(content) > self.max_size:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+
+            self._entries[key] = content
+            self.size += len(content)
+
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key: the first caller runs the
+    function, the others wait for and share its result.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, func: Callable):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            try:
+                call.result = func()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+
+        return call.result
+
+
+variant_cache = VariantCache(
+    getattr(settings, "STORAGE_VARIANT_CACHE_SIZE", 64 * 1024 * 1024))
+_renders = SingleFlight()
+
+
+def render_variant(
+    source: Union[bytes, mmap.mmap], width: int, image_format: str
+) -> bytes:
+    pil_format, _ = FORMATS[image_format]
+
+    with stage("decode"):
+        if isinstance(source, mmap.mmap):
+            source.seek(0)
+            img = Image.open(source)
+        else:
+            img = Image.open(BytesIO(source))
+        # Let JPEG decode at a reduced scale when the target is small.
+        img.draft(None, (width * 2, width * 2))
+        img = ImageOps.exif_transpose(img)
+
+    with stage("resize"):
+        if img.width > width:
+            height = max(round(img.height * width / img.width), 1)
+            img = img.resize((width, height), Image.Resampling.LANCZOS)
+
+    with stage("encode"):
+        if pil_format == "JPEG" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+
+        buffer = BytesIO()
+        options = {"optimize": True}
+        if pil_format in ("JPEG", "WEBP"):
+            options["quality"] = QUALITY
+        img.save(buffer, format=pil_format, **options)
+
+    return buffer.getvalue()
+
+
+def _load_or_render(file, key: str, width: int, image_format: str):
+    if storage_service.file_exists(key):
+        with stage("download"):
+            content = storage_service.get_file_content(key)
+        if content is not None:
+            return content
+
+    with storage_service.open_file_buffer(file.file.name) as source:
+        if source is None:
+            return None
+        content = render_variant(
+            compression.decode(source, file.content_encoding),
+            width, image_format)
+
+    with stage("upload"):
+        storage_service.upload_fileobj(
+            BytesIO(content), key, content_type=FORMATS[image_format][1])
+        if file.expiry_tag:
+            # Expire with the source under the lifecycle rules.
+            expiry.tag_object(key, file.expiry_tag)
+
+    return content
+
+
+def get_variant(file, width: int, image_format: str) -> Optional[bytes]:
+    """
+    Return the rendered variant, rendering and storing it on first use.
+    Returns None when the source can not be read or decoded.
+    """
+    key = variant_key(file, width, image_format)
+
+    content = variant_cache.get(key)
+    if content is not None:
+        return content
+
+    try:
+        content = _renders.do(
+            key, lambda: _load_or_render(file, key, width, image_format))
+    except Exception as e:
+        message = f"Error rendering variant {key}: {str(e)}"
+        logging.error(message, exc_info=True)
+
+        return None
+
+    if content is not None:
+        variant_cache.put(key, content)
+
+    return content
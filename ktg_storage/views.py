@@ -1,43 +1,225 @@
+import abc
+import hashlib
+import time
+from urllib.parse import quote
+from datetime import datetime
+from typing import Any
+from typing import Optional
+from typing import Tuple
+
 from ktg_storage.auth_mixin import ApiAuthMixin
 from ktg_storage.serializers import FileSerializer
 from ktg_storage.serializers import FinishFileUploadSerializer
 from ktg_storage.serializers import StartDirectFileUploadSerializer, CreatePresignedUrl
+from ktg_storage.serializers import FileSearchSerializer
+from ktg_storage.serializers import ImageVariantSerializer
+from django.conf import settings
+from django.db.models import Count
+from django.db.models import Max
+from django.http import FileResponse
+from django.http import Http404
+from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+from django.http.response import HttpResponseBase
 from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_vary_headers
+from django.utils.cache import get_conditional_response
+from django.utils.cache import quote_etag
+from django.utils.http import content_disposition_header
+from django.utils.http import http_date
 from django.utils import timezone
 from rest_framework import status
+from rest_framework.permissions import SAFE_METHODS
 from rest_framework.generics import CreateAPIView
 from rest_framework.generics import ListAPIView
 from rest_framework.generics import RetrieveUpdateDestroyAPIView
+from rest_framework.pagination import CursorPagination
 from rest_framework.response import Response
 from rest_framework.views import APIView
+from ktg_storage import cdn
+from ktg_storage import compression
+from ktg_storage import routers
+from ktg_storage import tiering
+from ktg_storage import variants
+from ktg_storage.access import record_access
+from ktg_storage.backends import LocalStorageService
 from ktg_storage.client import s3_service
+from ktg_storage.client import storage_service
+from ktg_storage.enums import StorageClass
 from ktg_storage.models import Storage
 from ktg_storage.services import FileDirectUploadService
+from ktg_storage.services import soft_delete_file
+
+
+class ConditionalGetMixin(abc.ABC):
+    """
+    Answer GET requests with `304 Not Modified` when the client's ETag (or
+    Last-Modified) validator is still current, before any serialization or
+    URL signing happens. Views provide the validator inputs through
+    `get_version`.
+    """
+
+    @abc.abstractmethod
+    def get_version(self) -> Tuple[Any, Optional[datetime]]:
+        """
+        The version of the response, hashed into the ETag, and its
+        Last-Modified time, or None when no time changes with every version.
+        """
+
+    def get_validators(self) -> Tuple[str, Optional[datetime]]:
+        version, last_modified = self.get_version()
+
+        parts = [
+            str(self.request.user.pk),
+            self.request.get_full_path(),
+            str(version),
+        ]
+
+        if not settings.IS_USING_LOCAL_STORAGE:
+            # Responses embed presigned URLs (also in CDN mode, for files
+            # outside the user prefixes). Rolling the ETag once per
+            # expiry window guarantees a 304 is never sent for a response
+            # whose URLs have already expired. Last-Modified can not express
+            # that, so it is only used for local storage.
+            parts.append(str(int(time.time() // s3_service.expiry)))
+            last_modified = None
+
+        digest = hashlib.sha1("|".join(parts).encode()).hexdigest()
+
+        return quote_etag(digest), last_modified
+
+    def get(self, request, *args, **kwargs):
+        etag, last_modified = self.get_validators()
+        # HTTP dates have a one second resolution.
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(
+            request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+
+        response["ETag"] = etag
+        if timestamp is not None:
+            response["Last-Modified"] = http_date(timestamp)
+        response["Cache-Control"] = "private, no-cache"
+
+        return response
+
+
+class ReplicaReadMixin:
+    """
+    Run the storage queries of safe requests on a read replica
+    (ktg_storage.routers), and keep the user on the primary for a short
+    window after any other request.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        self._replica_token = None
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            if self._replica_token is not None:
+                routers.reset_replica(self._replica_token)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+
+        # Authentication has run, the replica choice depends on the user.
+        if request.method in SAFE_METHODS:
+            self._replica_token = routers.use_replica(request.user)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            routers.mark_recent_write(request.user)
+
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+class CDNCookieMixin:
+    """
+    Issue or renew the CloudFront signed cookies (ktg_storage.cdn) covering
+    the unsigned CDN URLs returned by the view.
+    """
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+
+        if (
+            cdn.cdn_enabled()
+            and response.status_code < 400
+            and request.user.is_authenticated
+            and cdn.needs_renewal(request.COOKIES, request.user)
+        ):
+            cdn.set_signed_cookies(response, request.user)
+
+        return response
 
 
 class FileDirectUploadStartApi(ApiAuthMixin, CreateAPIView):
     serializer_class = StartDirectFileUploadSerializer
 
 
-class GetAllFileView(ApiAuthMixin, ListAPIView):
+class GetAllFileView(CDNCookieMixin, ReplicaReadMixin, ConditionalGetMixin, ApiAuthMixin, ListAPIView):
     serializer_class = FileSerializer
 
     def get_queryset(self):
 
-        return Storage.objects.get_user_files(self.request.user)
+        return Storage.objects.get_user_files(
+            self.request.user).select_related("uploaded_by")
+
+    def get_version(self):
+        # Any create, update or soft-delete changes either the newest
+        # updated_at or the number of rows. Soft-deleting an older row does
+        # not change the newest updated_at, so there is no Last-Modified.
+        version = self.filter_queryset(self.get_queryset()).aggregate(
+            last_modified=Max("updated_at"), count=Count("id")
+        )
+
+        return (version["last_modified"], version["count"]), None
+
+
+class FileCursorPagination(CursorPagination):
+    # Keyset pagination over the (uploaded_by, -created_at) index, so deep
+    # pages cost the same as the first one.
+    ordering = ("-created_at", "-id")
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 200
+
+
+class FileSearchView(CDNCookieMixin, ReplicaReadMixin, ApiAuthMixin, ListAPIView):
+    serializer_class = FileSerializer
+    pagination_class = FileCursorPagination
+
+    def get_queryset(self):
+        params = FileSearchSerializer(data=self.request.query_params)
+        params.is_valid(raise_exception=True)
+        filters = params.validated_data
+
+        return Storage.objects.search_user_files(
+            self.request.user,
+            query=filters.get("q", ""),
+            match=filters["match"],
+            file_type=filters.get("file_type", ""),
+            created_after=filters.get("created_after"),
+            created_before=filters.get("created_before"),
+            expire_after=filters.get("expire_after"),
+            expire_before=filters.get("expire_before"),
+        ).select_related("uploaded_by")
 
 
-class ExpiredFileListView(ApiAuthMixin, ListAPIView):
+class ExpiredFileListView(CDNCookieMixin, ReplicaReadMixin, ApiAuthMixin, ListAPIView):
     serializer_class = FileSerializer
 
     def get_queryset(self):
         # Get the queryset of all files uploaded by the user
         user_documents = Storage.objects.get_user_files(self.request.user)
         # Filter the queryset to get the expired documents
-        return user_documents.filter(expire_at__lte=timezone.now())
+        return user_documents.filter(
+            expire_at__lte=timezone.now()).select_related("uploaded_by")
 
 
-class FileDirectUploadFinishApi(ApiAuthMixin, CreateAPIView):
+class FileDirectUploadFinishApi(CDNCookieMixin, ReplicaReadMixin, ApiAuthMixin, CreateAPIView):
     serializer_class = FinishFileUploadSerializer
 
     def get_queryset(self):
@@ -56,36 +238,189 @@ class FileDirectUploadLocalApi(ApiAuthMixin, APIView):
         return Response({"id": file.id})
 
 
-class FileUpdateView(ApiAuthMixin, RetrieveUpdateDestroyAPIView):
+class FileUpdateView(CDNCookieMixin, ReplicaReadMixin, ConditionalGetMixin, ApiAuthMixin, RetrieveUpdateDestroyAPIView):
     serializer_class = FileSerializer
 
     def get_queryset(self):
         return Storage.objects.get_user_files(self.request.user)
 
+    def get_object(self):
+        # The conditional GET and the retrieve share a single lookup.
+        if not hasattr(self, "_object"):
+            self._object = super().get_object()
+        return self._object
+
+    def get_version(self):
+        file = self.get_object()
+        return file.updated_at, file.updated_at
+
     def get_category(self):
         return
 
     def delete(self, request, *args, **kwargs):
         file = self.get_object()
-        file.is_deleted = True
-        file.save()
+        soft_delete_file(file)
         return Response(
             {"message": "File deleted successfully."},
             status=status.HTTP_204_NO_CONTENT,
         )
 
 
+class FileDownloadView(ApiAuthMixin, APIView):
+    """
+    Serve a file through the application without holding it in memory.
+
+    Local files are handed to the web server (X-Accel-Redirect / X-Sendfile,
+    see `STORAGE_LOCAL_SENDFILE`) or sent with `FileResponse`, which uses the
+    server's sendfile-based `wsgi.file_wrapper`. S3 objects are streamed in
+    chunks. Compressed objects are passed through when the client accepts
+    their encoding and decompressed on the fly otherwise.
+    """
+
+    def get(self, request, pk):
+        file = get_object_or_404(
+            Storage.objects.get_user_files(request.user), pk=pk)
+
+        record_access(file.file_name, file.last_accessed_at)
+
+        # Serve the restored copy of archived files; tier_storage moves them
+        # back to STANDARD since they were read again.
+        if (
+            file.storage_class in StorageClass.ARCHIVED
+            and not tiering.request_restore(file.file.name)
+        ):
+            return Response(
+                {"message": "File is being restored, try again later."},
+                status=status.HTTP_202_ACCEPTED,
+            )
+
+        encoding = file.content_encoding
+        if encoding and not compression.accepts_encoding(
+            request.META.get("HTTP_ACCEPT_ENCODING", ""), encoding
+        ):
+            response = self.streamed_response(file, decompress=True)
+            encoding = None
+        elif isinstance(storage_service, LocalStorageService):
+            response = self.local_response(file)
+        else:
+            response = self.streamed_response(file)
+
+        if response is None:
+            raise Http404
+
+        if encoding:
+            response["Content-Encoding"] = encoding
+        response["Content-Disposition"] = content_disposition_header(
+            True, file.original_file_name)
+        patch_vary_headers(response, ("Accept-Encoding",))
+
+        return response
+
+    def local_response(self, file: Storage) -> Optional[HttpResponseBase]:
+        if not storage_service.file_exists(file.file.name):
+            return None
+
+        content_type = file.file_type or "application/octet-stream"
+        path = storage_service.path(file.file.name)
+        mode = getattr(settings, "STORAGE_LOCAL_SENDFILE", None)
+
+        if mode == "x-accel-redirect":
+            prefix = getattr(settings, "STORAGE_LOCAL_ACCEL_PREFIX", "/protected/")
+            response = HttpResponse(content_type=content_type)
+            response["X-Accel-Redirect"] = quote(f"{prefix}{file.file.name}")
+        elif mode == "x-sendfile":
+            response = HttpResponse(content_type=content_type)
+            response["X-Sendfile"] = path
+        else:
+            response = FileResponse(open(path, "rb"), content_type=content_type)
+
+        return response
+
+    def streamed_response(
+        self, file: Storage, decompress: bool = False
+    ) -> Optional[HttpResponseBase]:
+        body = storage_service.get_file_stream(file.file.name)
+        if body is None:
+            return None
+
+        chunks = compression.iter_chunks(body)
+        size = file.stored_size if file.content_encoding else file.file_size
+
+        if decompress:
+            chunks = compression.decompress_chunks(
+                chunks, file.content_encoding)
+            size = file.file_size
+
+        response = StreamingHttpResponse(
+            chunks, content_type=file.file_type or "application/octet-stream")
+        if size is not None:
+            response["Content-Length"] = size
+
+        return response
+
+
+class FileImageVariantView(ApiAuthMixin, APIView):
+    """
+    Serve an image resized to an allow-listed width and format
+    (`?w=256&fmt=webp`), rendered on first request. The parameter is not
+    called `format`, DRF reserves that one for renderer selection.
+    """
+
+    def get(self, request, pk):
+        params = ImageVariantSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        width = params.validated_data["w"]
+        image_format = params.validated_data["fmt"]
+
+        file = get_object_or_404(
+            Storage.objects.get_user_files(request.user), pk=pk)
+        if not file.file_type.startswith("image/"):
+            raise Http404
+
+        # Variant content only depends on its derived key.
+        etag = quote_etag(hashlib.sha1(
+            variants.variant_key(file, width, image_format).encode()
+        ).hexdigest())
+
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            content = variants.get_variant(file, width, image_format)
+            if content is None:
+                raise Http404
+
+            record_access(file.file_name, file.last_accessed_at)
+            response = HttpResponse(
+                content, content_type=variants.FORMATS[image_format][1])
+
+        response["ETag"] = etag
+        response["Cache-Control"] = "private, max-age=86400"
+
+        return response
+
+
 class CreatePresignedUrl(ApiAuthMixin, CreateAPIView):
     serializer_class = CreatePresignedUrl
 
     def create(self, request, *args, **kwargs):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        file_name = serializer.validated_data.get("file_name")
+        file_name = Storage.objects.resolve_key(
+            serializer.validated_data.get("file_name"))
         expires = serializer.validated_data.get("expires", True)
 
+        archived = Storage.objects.filter(
+            file_name=file_name, storage_class__in=StorageClass.ARCHIVED,
+        ).exists()
+        if archived and not tiering.request_restore(file_name):
+            return Response(
+                {"message": "File is being restored, try again later."},
+                status=status.HTTP_202_ACCEPTED,
+            )
+
+        record_access(file_name)
+
         return Response(
-            data=s3_service.create_presigned_url(
+            data=storage_service.create_presigned_url(
                 object_name=file_name, expires=expires),
             status=status.HTTP_201_CREATED,
         )
@@ -22,6 +22,16 @@ setup(
         "PyMuPDF==1.24.14",
         "python-magic==0.4.27",
     ],
+    extras_require={
+        # ktg_storage.renderers.ORJSONRenderer
+        "orjson": ["orjson>=3.8"],
+        # STORAGE_COMPRESSION = "zstd"
+        "zstd": ["zstandard>=0.21"],
+        # CloudFront signed cookies (STORAGE_CDN_DOMAIN)
+        "cdn": ["cryptography>=41.0"],
+        # Parquet inventory reports for backfill_metadata
+        "parquet": ["pyarrow>=14.0"],
+    },
     description='A reusable Django app for managing storage functionality',
 
     long_description=open('README.md').read(),